@@ -0,0 +1,505 @@
+# -*- coding: utf-8 -*-
+"""benchmark
+
+Benchmarks of the pllay hot paths on synthetic data. Every case runs in a
+fresh process, so that its peak memory can be read from the resource usage
+of that process alone.
+
+  python benchmark.py knn dtm_grad persistence hofer svd_mapper --json results.json
+  python benchmark.py hofer --param n_samples=4096 --json new.json --baseline results.json
+
+--param overrides a keyword of the suites and their cases, except the
+case keywords a suite varies itself, which are set through the suite's
+own, e.g. rs=(1., 3.) instead of r=3. for knn. --json saves
+the measurements with the commit and versions they were taken at, and
+--baseline compares them to an earlier --json file, exiting with status 1
+when a case got slower by more than --threshold.
+"""
+
+import os
+import sys
+import json
+import time
+import ast
+import argparse
+import inspect
+import platform
+import subprocess
+import multiprocessing
+from importlib import metadata
+from queue import Empty
+import numpy as np
+
+import memory
+
+
+CASES = {}
+
+def case(fn):
+  """Register a benchmark case.
+
+  A case builds its inputs from keyword parameters and returns the function
+  to time, taking no arguments. When the function has an n_items attribute,
+  the throughput in items per second is reported as well.
+  """
+  CASES[fn.__name__] = fn
+  return fn
+
+def _peak_rss_mb():
+  # not ru_maxrss, which the auto batch size probe of pllay resets
+  return memory.max_rss_bytes() / 2.**20
+
+def _run_case(name, params, repeat, queue):
+  try:
+    fn = CASES[name](**params)
+    peak_before = _peak_rss_mb()
+    fn()  # warm up, traces tf.functions
+    times = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      fn()
+      times.append(time.perf_counter() - start)
+    result = {'case': name, 'params': params, 'repeat': repeat,
+              'seconds_min': min(times), 'seconds_median': float(np.median(times)),
+              'peak_rss_mb': _peak_rss_mb(), 'peak_rss_increase_mb': _peak_rss_mb() - peak_before}
+    if hasattr(fn, 'n_items'):
+      result['items_per_second'] = fn.n_items / result['seconds_median']
+    queue.put(result)
+  except Exception as e:
+    queue.put({'case': name, 'params': params, 'error': repr(e)})
+
+def run(name, repeat=5, **params):
+  """Run one case in a fresh process and return its measurements."""
+  context = multiprocessing.get_context('spawn')
+  queue = context.Queue()
+  process = context.Process(target=_run_case, args=(name, params, repeat, queue))
+  process.start()
+  while True:
+    try:
+      result = queue.get(timeout=1.)
+      break
+    except Empty:
+      # e.g. killed for running out of memory
+      if not process.is_alive():
+        result = {'case': name, 'params': params, 'error': 'exited with code %s' % process.exitcode}
+        break
+  process.join()
+  return result
+
+
+@case
+def knn(r=2., tiled=False, batch_size=16, n_points=200, by=0.05, k=20):
+  """tf_knn / tf_knn_tiled of the grid of a DTM layer against point clouds."""
+  import tensorflow as tf
+  import pllay
+
+  X = tf.constant(np.random.default_rng(0).normal(scale=0.5, size=(batch_size, n_points, 2)).astype('float32'))
+  grid, _ = pllay.tf_gridBy([[-1., 1.], [-1., 1.]], by)
+  knn_fn = pllay.tf_knn_tiled if tiled else pllay.tf_knn
+  fn = lambda: knn_fn(X, grid, k, r=r)
+  fn.n_items = batch_size
+  return fn
+
+
+def compare_knn(rs=(1., 2., float('inf')), **params):
+  """tf_knn against tf_knn_tiled for every r-norm."""
+  results = []
+  for r in rs:
+    for tiled in [False, True]:
+      results.append(run('knn', r=r, tiled=tiled, **params))
+  return results
+
+
+@case
+def dtm_grad(layer='dtm', custom_grad=True, backward=True, batch_size=16, n_points=200, by=0.05, m0=0.1):
+  """Forward (and backward) pass of DTMLayer / DTMWeightLayer / GridDTMWeightLayer."""
+  import tensorflow as tf
+  import pllay
+
+  rng = np.random.default_rng(0)
+  X = tf.constant(rng.normal(scale=0.5, size=(batch_size, n_points, 2)).astype('float32'))
+  W = tf.constant(rng.random((batch_size, n_points)).astype('float32'))
+  if layer == 'dtm':
+    dtm_layer = pllay.DTMLayer(m0=m0, by=by, custom_grad=custom_grad)
+    forward = lambda: dtm_layer(X)
+  elif layer == 'dtmweight':
+    dtm_layer = pllay.DTMWeightLayer(m0=m0, by=by, custom_grad=custom_grad)
+    forward = lambda: dtm_layer(X, W)
+  else:
+    # weights on the grid itself, as for images
+    dtm_layer = pllay.GridDTMWeightLayer(m0=m0, by=by, custom_grad=custom_grad)
+    W = tf.constant(rng.random((batch_size, dtm_layer.grid.shape[0])).astype('float32'))
+    forward = lambda: dtm_layer(W)
+
+  def fn():
+    if not backward:
+      return forward()
+    with tf.GradientTape() as tape:
+      tape.watch(X)
+      tape.watch(W)
+      loss = tf.reduce_sum(forward())
+    return tape.gradient(loss, [X, W])
+  fn.n_items = batch_size
+  return fn
+
+
+def compare_dtm_grad(**params):
+  """Sparse custom gradient against autodiff for the DTM layers, and the forward pass alone."""
+  results = []
+  for layer in ['dtm', 'dtmweight', 'grid']:
+    results.append(run('dtm_grad', layer=layer, backward=False, **params))
+    for custom_grad in [False, True]:
+      results.append(run('dtm_grad', layer=layer, custom_grad=custom_grad, **params))
+  return results
+
+
+@case
+def persistence(layer='landscape', backend='thread', backward=False, batch_size=16, grid=28, nmax_diag=32, n_tseq=25):
+  """PersistenceLandscapeLayer / PersistenceDiagramLayer on random grid filtrations.
+
+  layer is 'landscape', 'diagram', 'ragged' for the unpadded diagrams, or
+  'fused' for the diagram and landscape from one complex.
+  """
+  import tensorflow as tf
+  import pllay
+
+  # smooth random filtrations, closer to a DTM than white noise
+  rng = np.random.default_rng(0)
+  noise = rng.normal(size=(batch_size, grid + 4, grid + 4)).astype('float32')
+  fun_values = sum(noise[:, i:i + grid, j:j + grid] for i in range(5) for j in range(5)) / 25.
+  fun_values = tf.constant(fun_values.reshape(batch_size, grid * grid))
+  kwargs = dict(grid_size=[grid, grid], dimensions=[0, 1], backend=backend)
+  landscape_layer = pllay.PersistenceLandscapeLayer(tseq=np.linspace(-0.5, 0.5, n_tseq), KK=[0, 1], **kwargs)
+  diagram_layer = pllay.PersistenceDiagramLayer(nmax_diag=nmax_diag, **kwargs)
+  forward = {'landscape': lambda: landscape_layer(fun_values),
+             'diagram': lambda: diagram_layer(fun_values),
+             'ragged': lambda: diagram_layer.ragged_diagram(fun_values),
+             'fused': lambda: landscape_layer.diagram_landscape(fun_values, nmax_diag)[1]}[layer]
+
+  def fn():
+    if not backward:
+      return forward()
+    with tf.GradientTape() as tape:
+      tape.watch(fun_values)
+      loss = tf.reduce_sum(forward())
+    return tape.gradient(loss, fun_values)
+  fn.n_items = batch_size
+  return fn
+
+
+def compare_persistence(backends=('serial', 'thread', 'process'), **params):
+  """Persistence layers for every backend, and the landscape gradient."""
+  results = []
+  for backend in backends:
+    for layer in ['landscape', 'diagram', 'ragged', 'fused']:
+      results.append(run('persistence', layer=layer, backend=backend, **params))
+  results.append(run('persistence', layer='landscape', backward=True, **params))
+  return results
+
+
+@case
+def hofer(num_units=32, mask_zeros=False, compiled=True, backward=True, n_samples=256, n_pairs=100):
+  """HoferLayer on padded synthetic diagrams, forward and backward."""
+  import tensorflow as tf
+  import pllay
+
+  rng = np.random.default_rng(0)
+  diag = rng.random((n_samples, n_pairs, 2)).astype('float32') * 0.5
+  diag[..., 1] += diag[..., 0]
+  # zero padding after a random number of pairs, as in compute_diagram
+  diag[np.arange(n_pairs) >= rng.integers(1, n_pairs + 1, size=(n_samples, 1))] = 0
+  diag = tf.constant(diag)
+  layer = pllay.HoferLayer(num_units, nu=0.1, mask_zeros=mask_zeros)
+
+  def step():
+    if not backward:
+      return layer(diag)
+    with tf.GradientTape() as tape:
+      loss = tf.reduce_sum(layer(diag))
+    return tape.gradient(loss, layer.trainable_weights)
+  fn = tf.function(step) if compiled else step
+  fn.n_items = n_samples
+  return fn
+
+
+def compare_hofer(num_units=(8, 32, 128), **params):
+  """HoferLayer against its number of units, with and without masking."""
+  results = []
+  for units in num_units:
+    for mask_zeros in [False, True]:
+      results.append(run('hofer', num_units=units, mask_zeros=mask_zeros, **params))
+  return results
+
+
+@case
+def svd_mapper(stage='all', n_samples=1000, batch_size=64, lens='pca', k=5):
+  """SVD features to mapper graph as in main.experiment, on synthetic inputs.
+
+  stage is 'features' (CNN activations to singular values), 'lens',
+  'graph', or 'all' of them; the inputs of a later stage are computed
+  once beforehand.
+  """
+  import sklearn.cluster
+  import pllay
+  import main
+  import lens as lens_module
+  from features import stream_svd_features
+  from mapper_graph import build_graph, SparseNerve
+
+  x = np.random.default_rng(0).random((n_samples, main.input_dim)).astype('float32')
+  dataset = pllay.make_tf_dataset(x, batch_size=batch_size)
+  predict = main.compiled_predict(main.MNIST_CNN())
+  features = lambda: stream_svd_features(predict, dataset, n_samples=n_samples, k=k)
+  projection = lambda X: lens_module.compute_lens(X, lens=lens)
+  graph = lambda X, Y: build_graph(Y, X, clusterer=sklearn.cluster.KMeans(n_init=10), nerve=SparseNerve(),
+                                   projection=lens, scaler='MinMaxScaler()')
+
+  if stage == 'all':
+    def fn():
+      X = features()
+      return graph(X, projection(X))
+  elif stage == 'features':
+    fn = lambda: features()
+  else:
+    X = features()
+    if stage == 'lens':
+      fn = lambda: projection(X)
+    else:
+      Y = projection(X)
+      fn = lambda: graph(X, Y)
+  fn.n_items = n_samples
+  return fn
+
+
+def compare_svd_mapper(stages=('features', 'lens', 'graph', 'all'), **params):
+  """Every stage of the SVD to mapper pipeline, and all of them together."""
+  return [run('svd_mapper', repeat=params.pop('repeat', 3), stage=stage, **params) for stage in stages]
+
+
+@case
+def mapper_lens(lens='pca', n_samples=1000, n_features=160, n_clusters=10):
+  """Mapper lens of synthetic singular value features, without the cache."""
+  import lens as lens_module
+
+  # clustered positive features, roughly like the singular values of the mnist activations
+  rng = np.random.default_rng(0)
+  centers = rng.gamma(2., size=(n_clusters, n_features))
+  labels = rng.integers(n_clusters, size=n_samples)
+  X = (centers[labels] + 0.3 * rng.normal(size=(n_samples, n_features))).astype('float32')
+  return lambda: lens_module.compute_lens(X, lens=lens)
+
+
+def compare_mapper_lens(sizes=(1000, 10000, 60000), max_tsne_samples=10000, **params):
+  """Time of every lens against the number of samples.
+
+  t-SNE is only run up to max_tsne_samples, beyond that it takes tens of
+  minutes.
+  """
+  import lens as lens_module
+  results = []
+  for n_samples in sizes:
+    for lens in lens_module.LENSES:
+      if lens == 'tsne' and n_samples > max_tsne_samples:
+        continue
+      results.append(run('mapper_lens', repeat=1, lens=lens, n_samples=n_samples, **params))
+  return results
+
+
+@case
+def model_predict(model='cnn', batch_size=16, n_samples=4096, compiled=True):
+  """Inference of a main.py model over n_samples synthetic inputs."""
+  import tensorflow as tf
+  import main
+
+  models = {'cnn': main.MNIST_CNN, 'cnn_pllay_input': main.MNIST_CNN_PLLay_Input, 'cnn_pllay': main.MNIST_CNN_PLLay}
+  keras_model = models[model]()
+  x = np.random.default_rng(0).random((n_samples, main.input_dim)).astype('float32')
+  predict = main.compiled_predict(keras_model) if compiled else lambda xb: keras_model(xb, training=False)
+
+  def fn():
+    for start in range(0, n_samples, batch_size):
+      predict(tf.constant(x[start:start + batch_size]))
+  fn.n_items = n_samples
+  return fn
+
+
+def compare_model_predict(batch_sizes=(16, 64, 256, 1024), **params):
+  """Inference throughput of the main.py models against the batch size."""
+  results = []
+  for batch_size in batch_sizes:
+    results.append(run('model_predict', model='cnn', batch_size=batch_size, compiled=False, **params))
+    results.append(run('model_predict', model='cnn', batch_size=batch_size, **params))
+    results.append(run('model_predict', model='cnn_pllay_input', batch_size=batch_size, **params))
+    results.append(run('model_predict', repeat=1, model='cnn_pllay', batch_size=batch_size, n_samples=1024))
+  return results
+
+
+def print_results(results):
+  for result in results:
+    params = ', '.join('%s=%s' % item for item in sorted(result['params'].items()))
+    if 'error' in result:
+      print('%-14s %-60s error: %s' % (result['case'], params, result['error']))
+    else:
+      throughput = '  %10.1f items/s' % result['items_per_second'] if 'items_per_second' in result else ''
+      print('%-14s %-60s %9.4f s  %8.1f MB peak  %+8.1f MB%s' % (
+          result['case'], params, result['seconds_median'], result['peak_rss_mb'], result['peak_rss_increase_mb'], throughput))
+
+
+def environment():
+  """Commit, versions and machine the results were measured on."""
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                     stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  versions = {}
+  # first distribution found, tensorflow is also packaged as tensorflow-cpu
+  for package, distributions in [('numpy', ['numpy']), ('tensorflow', ['tensorflow', 'tensorflow-cpu']),
+                                 ('gudhi', ['gudhi']), ('scikit-learn', ['scikit-learn']), ('kmapper', ['kmapper'])]:
+    versions[package] = None
+    for distribution in distributions:
+      try:
+        versions[package] = metadata.version(distribution)
+        break
+      except metadata.PackageNotFoundError:
+        pass
+  return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+          'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'versions': versions}
+
+def save_results(path, results):
+  with open(path, 'w') as f:
+    json.dump({'environment': environment(), 'results': results}, f, indent=2)
+
+def _result_key(result):
+  return (result['case'], json.dumps(result['params'], sort_keys=True))
+
+def compare_results(baseline, results, threshold=0.1):
+  """Print the change of every case measured in both runs.
+
+  Args:
+    baseline: results of an earlier run, e.g. the 'results' of a --json file
+    results: results of this run
+    threshold: relative increase of the median time reported as a regression
+
+  Returns:
+    regressions: list of (result, baseline result) slower by more than threshold
+  """
+  previous = {_result_key(result): result for result in baseline if 'error' not in result}
+  regressions = []
+  for result in results:
+    old = previous.get(_result_key(result))
+    if old is None or 'error' in result:
+      continue
+    ratio = result['seconds_median'] / old['seconds_median']
+    flag = ''
+    if ratio > 1 + threshold:
+      regressions.append((result, old))
+      flag = '  REGRESSION'
+    params = ', '.join('%s=%s' % item for item in sorted(result['params'].items()))
+    print('%-14s %-60s %9.4f s -> %9.4f s  x%5.2f  %+8.1f MB peak%s' % (
+        result['case'], params, old['seconds_median'], result['seconds_median'], ratio,
+        result['peak_rss_mb'] - old['peak_rss_mb'], flag))
+  return regressions
+
+
+# suite name: (suite, case it runs, case parameters the suite sets itself)
+SUITES = {'knn': (compare_knn, 'knn', ('r', 'tiled')),
+          'dtm_grad': (compare_dtm_grad, 'dtm_grad', ('layer', 'custom_grad', 'backward')),
+          'persistence': (compare_persistence, 'persistence', ('layer', 'backend', 'backward')),
+          'hofer': (compare_hofer, 'hofer', ('num_units', 'mask_zeros')),
+          'svd_mapper': (compare_svd_mapper, 'svd_mapper', ('stage',)),
+          'mapper_lens': (compare_mapper_lens, 'mapper_lens', ('repeat', 'lens', 'n_samples')),
+          'model_predict': (compare_model_predict, 'model_predict', ('model', 'batch_size', 'compiled'))}
+
+def _accepted(params, *fns):
+  # the keywords of params that one of fns takes, so --param can name the
+  # parameters of several suites at once
+  names = set(['repeat'])
+  for fn in fns:
+    names.update(inspect.signature(fn).parameters)
+  return {name: value for name, value in params.items() if name in names}
+
+def _suite_params(name, params):
+  """Keywords of params for the suite name.
+
+  Returns:
+    suite_params: the keywords the suite or its case take, without the case
+      parameters the suite sets itself. A single value for a suite
+      parameter taking a sequence, e.g. num_units=64, is a sequence of one
+    bound: the keywords left out
+  """
+  suite, case_name, bound = SUITES[name]
+  suite_signature = inspect.signature(suite).parameters
+  suite_params = _accepted(params, suite, CASES[case_name])
+  bound = [key for key in suite_params if key in bound and key not in suite_signature]
+  for key in bound:
+    del suite_params[key]
+  for key, value in suite_params.items():
+    if key in suite_signature and isinstance(suite_signature[key].default, tuple) and not isinstance(value, (tuple, list)):
+      suite_params[key] = (value,)
+  return suite_params, bound
+
+def _bound_message(key, names):
+  message = []
+  for name in names:
+    suite = SUITES[name][0]
+    choices = [parameter for parameter in inspect.signature(suite).parameters if parameter != 'params']
+    message.append('suite %s sets %s itself%s' % (name, key, ', it takes %s' % ', '.join(choices) if choices else ''))
+  return '; '.join(message)
+
+def _parse_param(text):
+  name, _, value = text.partition('=')
+  try:
+    return name, ast.literal_eval(value)
+  except (ValueError, SyntaxError):
+    return name, value
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmarks of the pllay hot paths on synthetic data.')
+  parser.add_argument('names', nargs='*', default=['dtm_grad'],
+                      help='suites (%s) or single cases' % ', '.join(SUITES))
+  parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                      help='keyword passed to the suites and cases, e.g. batch_size=64')
+  parser.add_argument('--json', help='save the results to this file')
+  parser.add_argument('--baseline', help='results file of an earlier run to compare with')
+  parser.add_argument('--threshold', type=float, default=0.1, help='slowdown reported as a regression')
+  args = parser.parse_args()
+  params = dict(_parse_param(text) for text in args.param)
+
+  # keywords checked before any case runs
+  plans = []
+  used = set()
+  bound = {}
+  for name in args.names:
+    if name in SUITES:
+      suite_params, suite_bound = _suite_params(name, params)
+      plans.append((SUITES[name][0], suite_params))
+      for key in suite_bound:
+        bound.setdefault(key, []).append(name)
+    elif name in CASES:
+      suite_params = _accepted(params, CASES[name])
+      plans.append((lambda name=name, **case_params: [run(name, **case_params)], suite_params))
+    else:
+      parser.error('unknown suite or case %r' % name)
+    used.update(suite_params)
+  # a keyword a suite sets itself is only dropped when another suite uses it
+  rejected = sorted(set(bound) - used)
+  if rejected:
+    parser.error('; '.join(_bound_message(key, bound[key]) for key in rejected))
+  if set(params) - used:
+    print('unused --param: %s' % ', '.join(sorted(set(params) - used)))
+
+  results = []
+  for fn, suite_params in plans:
+    suite_results = fn(**suite_params)
+    print_results(suite_results)
+    results.extend(suite_results)
+  if args.json:
+    save_results(args.json, results)
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare_results(json.load(f)['results'], results, args.threshold)
+    if regressions:
+      print('%d regression(s) against %s' % (len(regressions), args.baseline))
+      sys.exit(1)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""features
+
+Reduction of convolutional activations to the fixed length feature vectors
+that are fed to the mapper.
+"""
+
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+import tensorflow.compat.v2 as tf
+
+import tracing
+
+
+def tf_randomized_singular_values(A, k, n_iter=2, oversample=5, seed=0):
+  """Top k singular values by batched randomized subspace iteration.
+
+  Args:
+    A: Tensor of shape [..., H, W]
+    k: number of singular values
+    n_iter: number of power iterations, more is more accurate for slowly
+      decaying spectra
+    oversample: extra columns of the random subspace
+    seed: seed of the random test matrix, so results are reproducible
+
+  Returns:
+    s: Tensor of shape [..., k], in descending order
+  """
+  H, W = A.shape[-2], A.shape[-1]
+  l = min(k + oversample, H, W)
+  Omega = tf.random.stateless_normal([W, l], seed=[seed, 0], dtype=A.dtype)
+  Q, _ = tf.linalg.qr(tf.linalg.matmul(A, Omega))  # [..., H, l]
+  for _ in range(n_iter):
+    Z, _ = tf.linalg.qr(tf.linalg.matmul(A, Q, transpose_a=True))  # [..., W, l]
+    Q, _ = tf.linalg.qr(tf.linalg.matmul(A, Z))  # [..., H, l]
+  B = tf.linalg.matmul(Q, A, transpose_a=True)  # [..., l, W]
+  s = tf.linalg.svd(B, compute_uv=False)
+  return s[..., :k]
+
+
+@tracing.traced('svd')
+def svd_features(activations, k=5, solver='full', chunk_size=1024, out=None, **solver_kwargs):
+  """Top k singular values of every channel of a batch of activations.
+
+  Every [H, W] channel of every sample is treated as a matrix, and the
+  whole chunk of B*C matrices goes through a single batched SVD.
+
+  Args:
+    activations: array of shape [B, H, W, C]
+    k: number of singular values kept per channel
+    solver: 'full' for the exact tf.linalg.svd, 'randomized' for
+      tf_randomized_singular_values
+    chunk_size: number of samples per batched call, bounds the temporary
+      memory of the solver
+    out: optional preallocated float32 array of shape [B, C*k], e.g. a
+      np.memmap, filled in place
+    solver_kwargs: passed to tf_randomized_singular_values
+
+  Returns:
+    out: float32 array of shape [B, C*k], channel major, i.e. out[:, j*k:(j+1)*k]
+      are the singular values of channel j
+  """
+  B, H, W, C = activations.shape
+  if k > min(H, W):
+    raise ValueError('k = %d exceeds min(H, W) = %d' % (k, min(H, W)))
+  if solver not in ['full', 'randomized']:
+    raise ValueError('unknown solver %r' % solver)
+  if out is None:
+    out = np.empty([B, C * k], dtype=np.float32)
+  elif out.shape != (B, C * k):
+    raise ValueError('out has shape %s, expected %s' % (out.shape, (B, C * k)))
+
+  for start in range(0, B, chunk_size):
+    stop = min(start + chunk_size, B)
+    A = tf.transpose(tf.convert_to_tensor(activations[start:stop], dtype=tf.float32), [0, 3, 1, 2])  # [b, C, H, W]
+    if solver == 'full':
+      s = tf.linalg.svd(A, compute_uv=False)[..., :k]
+    else:
+      s = tf_randomized_singular_values(A, k, **solver_kwargs)
+    out[start:stop] = tf.reshape(s, [stop - start, C * k]).numpy()
+  return out
+
+
+def stream_svd_features(model, dataset, n_samples=None, k=5, path=None, **svd_kwargs):
+  """Run model batch by batch and reduce every batch to svd_features at once.
+
+  Only one batch of activations is alive at a time, so peak memory depends
+  on the batch size and not on the size of the dataset.
+
+  Args:
+    model: callable mapping an input batch to activations [b, H, W, C], e.g.
+      a keras model or a compiled predict function
+    dataset: iterable of input batches, or of (input, label) batches, e.g.
+      the output of to_tf_dataset
+    n_samples: number of samples to extract, inference stops once they are
+      done, and padding rows of the last batch are left out. Defaults to
+      every sample of an unpadded dataset with known cardinality
+    k: number of singular values kept per channel
+    path: optional .npy file the features are written to through a memmap,
+      instead of an array in memory
+    svd_kwargs: passed to svd_features
+
+  Returns:
+    out: float32 array (np.memmap if path is given) of shape [n_samples, C*k]
+  """
+  if n_samples is None:
+    n_batches = int(tf.data.experimental.cardinality(dataset))
+    if n_batches < 0:
+      raise ValueError('n_samples is required when the dataset has unknown cardinality')
+  out = None
+  start = 0
+  for batch in dataset:
+    x = batch[0] if isinstance(batch, tuple) else batch
+    with tracing.span('inference'):
+      activations = np.asarray(model(x))
+    if out is None:
+      B, _, _, C = activations.shape
+      if n_samples is None:
+        n_samples = n_batches * B
+      if path is None:
+        out = np.empty([n_samples, C * k], dtype=np.float32)
+      else:
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_samples, C * k))
+    stop = min(start + activations.shape[0], n_samples)
+    svd_features(activations[:stop - start], k=k, out=out[start:stop], **svd_kwargs)
+    start = stop
+    if start == n_samples:
+      break
+  if out is None or start < n_samples:
+    raise ValueError('dataset ran out after %d of %d samples' % (start, n_samples))
+  if path is not None:
+    out.flush()
+  return out
+
+
+def file_checksum(*paths):
+  """blake2b digest of the content of the given files, in order."""
+  digest = hashlib.blake2b(digest_size=20)
+  for path in paths:
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(2**20), b''):
+        digest.update(block)
+  return digest.hexdigest()
+
+def array_checksum(array, chunk_rows=65536):
+  """blake2b digest of the dtype, shape and values of array.
+
+  The array is hashed by chunks of rows, so a memmap is never read into
+  memory as a whole.
+  """
+  digest = hashlib.blake2b(digest_size=20)
+  digest.update(repr((array.dtype.str, array.shape)).encode())
+  for start in range(0, array.shape[0], chunk_rows):
+    digest.update(np.ascontiguousarray(array[start:start + chunk_rows]).tobytes())
+  return digest.hexdigest()
+
+def checkpoint_checksum(prefix):
+  """Checksum of the weights saved by model.save_weights(prefix).
+
+  The files on disk are hashed rather than the weights of a loaded model,
+  since a subclassed model only restores its weights once it is built.
+  """
+  paths = sorted(path for path in glob.glob(glob.escape(prefix) + '*') if os.path.isfile(path))
+  if not paths:
+    raise FileNotFoundError('no checkpoint files for %s' % prefix)
+  return file_checksum(*paths)
+
+
+class FeatureStore(object):
+  """On-disk store of extracted features, one .npy file per key.
+
+  A key covers everything the features depend on: the model weights, the
+  input data, the layer and the reduction parameters, so a changed weight
+  file or a different k gives a new entry instead of stale features.
+  Features are loaded back as read-only memmaps.
+
+  Args:
+    directory: directory of the store
+  """
+
+  def __init__(self, directory='feature_store'):
+    self.directory = directory
+    self.hits = 0
+    self.misses = 0
+    os.makedirs(directory, exist_ok=True)
+
+  def key(self, **fields):
+    config = sorted((name, np.asarray(value).tolist()) for name, value in fields.items())
+    return hashlib.blake2b(repr(config).encode(), digest_size=20).hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key + '.npy')
+
+  def get(self, key, mmap_mode='r'):
+    """Stored features for key, or None."""
+    if not os.path.exists(self._path(key)):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return np.load(self._path(key), mmap_mode=mmap_mode)
+
+  def get_or_compute(self, key, compute, metadata=None, mmap_mode='r'):
+    """Stored features for key, calling compute(path) to write them on a miss.
+
+    Args:
+      key: key from FeatureStore.key
+      compute: function writing the features as a .npy file to the path
+        it is given, e.g. stream_svd_features with path=path
+      metadata: optional dict saved next to the features as .json, for
+        finding out what an entry holds
+      mmap_mode: mode of the returned memmap
+    """
+    features = self.get(key, mmap_mode=mmap_mode)
+    if features is None:
+      tmp_path = '%s.%d.tmp' % (self._path(key), os.getpid())
+      compute(tmp_path)
+      os.replace(tmp_path, self._path(key))
+      if metadata is not None:
+        with open(os.path.join(self.directory, key + '.json'), 'w') as f:
+          json.dump(metadata, f, indent=2, sort_keys=True)
+      features = np.load(self._path(key), mmap_mode=mmap_mode)
+    return features
+
+  def stats(self):
+    """Hit and miss counters."""
+    lookups = self.hits + self.misses
+    return {'hits': self.hits, 'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.}
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""lens
+
+Projections of the feature space (lenses) used by the mapper, with an
+on-disk cache keyed by the features, so that iterating on the cover and
+clustering parameters does not recompute the projection.
+"""
+
+import numpy as np
+from sklearn import decomposition, manifold, random_projection
+from sklearn.preprocessing import MinMaxScaler
+from sklearn.utils.extmath import randomized_svd
+
+import tracing
+from features import array_checksum
+
+
+def pca_lens(X, n_components=2, seed=0):
+  """Exact PCA, O(N D^2)."""
+  return decomposition.PCA(n_components=n_components, random_state=seed).fit_transform(X)
+
+def randomized_svd_lens(X, n_components=2, seed=0, n_iter=4):
+  """Leading principal components by randomized SVD, O(N D n_components)."""
+  X = X - X.mean(axis=0)
+  U, S, _ = randomized_svd(X, n_components, n_iter=n_iter, random_state=seed)
+  return U * S
+
+def random_projection_lens(X, n_components=2, seed=0):
+  """Gaussian random projection, O(N D n_components), no fitting."""
+  return random_projection.GaussianRandomProjection(n_components=n_components, random_state=seed).fit_transform(X)
+
+def spectral_lens(X, n_components=2, seed=0, n_neighbors=15, eigen_solver='lobpcg'):
+  """Laplacian eigenmap of the sparse kNN graph of X.
+
+  lobpcg only needs products with the sparse laplacian, the default arpack
+  solver factorizes it and runs out of memory at tens of thousands of
+  samples.
+  """
+  return manifold.SpectralEmbedding(n_components=n_components, affinity='nearest_neighbors', n_neighbors=n_neighbors,
+                                    eigen_solver=eigen_solver, random_state=seed, n_jobs=-1).fit_transform(X)
+
+def tsne_lens(X, n_components=2, seed=0, **kwargs):
+  """Barnes-Hut t-SNE, the projection main.experiment used originally."""
+  return manifold.TSNE(n_components=n_components, random_state=seed, **kwargs).fit_transform(X)
+
+LENSES = {'pca': pca_lens, 'randomized_svd': randomized_svd_lens, 'random_projection': random_projection_lens,
+          'spectral': spectral_lens, 'tsne': tsne_lens}
+
+
+def compute_lens(X, lens='pca', n_components=2, seed=0, scale=True, store=None, **lens_kwargs):
+  """Project X with one of LENSES, as mapper.fit_transform would.
+
+  Args:
+    X: array of shape [N, D]
+    lens: name of the lens in LENSES
+    n_components: dimension of the projection
+    seed: random state of the lens, fixed so that cached lenses are valid
+    scale: min-max scale every component to [0, 1], the default scaler of
+      KeplerMapper.fit_transform
+    store: optional FeatureStore the projection is cached in, keyed by the
+      checksum of X and the lens configuration
+    lens_kwargs: passed to the lens
+
+  Returns:
+    lens: float array of shape [N, n_components]
+  """
+  if lens not in LENSES:
+    raise ValueError('unknown lens %r, expected one of %s' % (lens, sorted(LENSES)))
+
+  @tracing.traced('lens')
+  def project():
+    projected = LENSES[lens](np.asarray(X), n_components=n_components, seed=seed, **lens_kwargs)
+    if scale:
+      projected = MinMaxScaler().fit_transform(projected)
+    return projected
+
+  if store is None:
+    return project()
+
+  def compute(path):
+    with open(path, 'wb') as f:
+      np.save(f, project())
+
+  config = dict(data=array_checksum(X), lens=lens, n_components=n_components, seed=seed, scale=scale, **lens_kwargs)
+  return store.get_or_compute(store.key(**config), compute, metadata=config)
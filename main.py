@@ -1,11 +1,16 @@
+import os
 import numpy as np
 import tensorflow.compat.v2 as tf
 import time
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-import kmapper as km
-import sklearn
 from pllay import *
+from features import stream_svd_features, FeatureStore, checkpoint_checksum
+from processed_data import convert_processed, load_split, load_meta
+from lens import compute_lens
+from mapper_graph import build_graph, size_adaptive_clusterer, SparseNerve, save_graph, load_graph
+from scheduler import expand_jobs, run_jobs
+import tracing
 
 tf.enable_v2_behavior()
 
@@ -17,6 +22,7 @@ noise_prob_list = [0.1]
 nCn = len(corrupt_prob_list)
 batch_size = 16
 nTimes=1
+input_dim = 784 + 100 + 162 + 8*nmax_diag
 
 
 class MNIST_CNN(tf.keras.Model):
@@ -26,7 +32,7 @@ class MNIST_CNN(tf.keras.Model):
 
     def call(self, x):
         xg, xl1, xl2, xd = tf.split(x, [784, 100, 162, 8*nmax_diag], axis=-1)
-        xg = tf.reshape(xg, [16, 28, 28, 1])
+        xg = tf.reshape(xg, [-1, 28, 28, 1])
         xg1 = self.layer1_1(xg)
         x = xg1
         return x
@@ -44,16 +50,15 @@ class MNIST_CNN_PLLay_Input(tf.keras.Model):
 
     def call(self, x):
         xg, xl1, xl2, xd = tf.split(x, [784, 100, 162, 8*nmax_diag], axis=-1)
-        xg = tf.reshape(xg, [16, 28, 28, 1])
+        xg = tf.reshape(xg, [-1, 28, 28, 1])
         xg1 = self.layer1_1(xg)
         xg1 = self.layer1_2(xg1)
-        xg1 = tf.reshape(xg1, [16, 784])
+        xg1 = tf.reshape(xg1, [-1, 784])
         xl1 = tf.nn.relu(self.layer2_1(xl1))
         xl2 = tf.nn.relu(self.layer2_2(xl2))
         x = tf.concat((xg1, xl1, xl2), -1)
         x = self.layer3(x)
         x = self.layer4(x)
-        print(x.shape)
         return x
 
 
@@ -70,10 +75,10 @@ class MNIST_CNN_PLLay(tf.keras.Model):
 
     def call(self, x):
         xg, xl1, xl2, xd = tf.split(x, [784, 100, 162, 8*nmax_diag], axis=-1)
-        xg = tf.reshape(xg, [16, 28, 28, 1])
+        xg = tf.reshape(xg, [-1, 28, 28, 1])
         xg1 = self.layer1_1(xg)
         xg1 = self.layer1_2(xg1)
-        xg1 = tf.reshape(xg1, [16, 784])
+        xg1 = tf.reshape(xg1, [-1, 784])
         xg1_1 = tf.nn.relu(self.layer1_3(xg1))
         xg1 = tf.concat((xg1, xg1_1), -1)
         xl1 = tf.nn.relu(self.layer2_1(xl1))
@@ -84,6 +89,18 @@ class MNIST_CNN_PLLay(tf.keras.Model):
         return x
 
 
+def compiled_predict(model):
+    """
+    Inference of model as a tf.function for
+    any batch size: the input signature leaves
+    the batch dimension unknown, so it is traced
+    once (twice if the model is not built yet)
+    and never retraced.
+    """
+    return tf.function(lambda x: model(x, training=False),
+        input_signature=[tf.TensorSpec([None, input_dim], tf.float32)])
+
+
 def preprocess() :
     """
     Generating necessary weight files 
@@ -125,68 +142,118 @@ def preprocess() :
     return x_processed_file_list, y_file, model_cnn_file_array, model_cnn_pllay_file_array, model_cnn_pllay_input_file_array
 
 
-def experiment(nTimes, corrupt_prob_list, noise_prob_list,
-      x_processed_file_list, y_file, model_cnn_file_array,
-      model_cnn_pllay_file_array, model_cnn_pllay_input_file_array,
-      batch_size=16):
+def prepare_dataset(x_file, y_file):
+    """
+    Memory-mapped splits of a processed
+    input file, converted on first use.
+    """
+    #The pickled splits are converted once to memory-mapped arrays, after that only the rows in use are read
+    dataset_dir = os.path.splitext(x_file)[0]
+    if not os.path.exists(os.path.join(dataset_dir, 'meta.json')):
+        convert_processed(x_file, y_file, dataset_dir, nmax_diag=nmax_diag)
+    return dataset_dir
 
-    print("nTimes = ", nTimes)
-    (y_train, y_test) = np.load(y_file, allow_pickle=True)
 
-    for iCn in range(nCn):
-        start_time = time.time() 
-        (x_train_processed, x_test_processed) = np.load(
-              x_processed_file_list[iCn], allow_pickle=True)
-        test_dataset = to_tf_dataset(x=x_test_processed, y=y_test,
-              batch_size=batch_size)
-
-        for iTime in range(nTimes):
-  
-            # CNN
-            start_time_inside = time.time()
-            print("CNN")
-            model_cnn = MNIST_CNN()
-            model_cnn.compile(optimizer=tf.keras.optimizers.RMSprop(),  # Optimizer
-                  loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
-                  metrics=['sparse_categorical_accuracy'])
-            model_cnn.load_weights(
-                  model_cnn_file_array[iCn][iTime])
-            
-            output = model_cnn.predict(test_dataset)
-            print("Dimension of Feature Space taken from the first layer:", output.shape)
-
-
-            singular_values_list = []
-
-            loop1 = 1000    #Should be output.shape[0] for final experiment;
-            for i in range(loop1) :
-
-              img_list = []
-              for j in range(output.shape[3]) :
-                s = tf.linalg.svd(output[i,:,:,j], compute_uv=False)
-                img_list.append(s[:5])
-            
-              singular_values_list.append(img_list)
-
-            singular_values_list = np.asarray(singular_values_list, dtype=np.float32)
-            print("Singular Value List Shape: ", singular_values_list.shape)
-
-            #Reshaping the list. Only an array of dimension 2 can be passed through mapper algorithm due to scaling reasons
-            nsamples, nx, ny = singular_values_list.shape
-            singular_values_list = singular_values_list.reshape((nsamples,nx*ny))
-
-            mapper = km.KeplerMapper(verbose=2)
-            projected_data = mapper.fit_transform(singular_values_list, projection=sklearn.manifold.TSNE())
-
-            graph = mapper.map(
+def run_job(job, job_dir, batch_size=16, feature_store_dir='feature_store', lens='tsne', trace=False):
+    """
+    One configuration of the experiment, as
+    given by scheduler.expand_jobs: features
+    of the CNN, lens and mapper graph, all
+    saved to job_dir.
+    """
+    start_time_inside = time.time()
+    #Named spans of every stage (knn, dtm, persistence, svd, lens, clustering, ...) are recorded and saved to job_dir
+    if trace:
+        tracing.reset()
+        tracing.enable()
+    feature_store = FeatureStore(feature_store_dir)
+    lens_store = FeatureStore(os.path.join(feature_store_dir, 'lens'))
+    model_file = job['model_files']['cnn']
+
+    dataset_dir = prepare_dataset(job['x_file'], job['y_file'])
+    x_test_processed, y_test = load_split(dataset_dir, 'test')
+    #Last batch is padded rather than dropped, so no test sample is left out
+    test_dataset = make_tf_dataset(x=x_test_processed, y=y_test,
+          batch_size=batch_size)
+    x_checksum = load_meta(dataset_dir)['source_checksum']
+
+    # CNN
+    loop1 = 1000    #Should be None (the whole test set) for final experiment;
+    n_samples = loop1 or len(y_test)
+
+    #Features only depend on the weights, the data and the reduction, so when none of them changed the stored ones are reused and inference is skipped
+    feature_config = dict(weights=checkpoint_checksum(model_file),
+          data=x_checksum, split='test', layer='layer1_1', reduction='svd', k=5,
+          n_samples=n_samples, batch_size=batch_size)
+    feature_key = feature_store.key(**feature_config)
+
+    def extract_features(path):
+        print("CNN")
+        model_cnn = MNIST_CNN()
+        model_cnn.compile(optimizer=tf.keras.optimizers.RMSprop(),  # Optimizer
+              loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+              metrics=['sparse_categorical_accuracy'])
+        model_cnn.load_weights(model_file)
+
+        #Runs the first layer batch by batch and keeps only the top 5 singular values of every channel, flattened to [n_samples, 32*5] since only an array of dimension 2 can be passed through mapper algorithm
+        stream_svd_features(compiled_predict(model_cnn), test_dataset, n_samples=n_samples, k=5, path=path)
+
+    try:
+        with tracing.span('features'):
+            singular_values_list = feature_store.get_or_compute(feature_key, extract_features,
+                  metadata=dict(feature_config, model=model_file, x_file=job['x_file']))
+        print("Singular Value List Shape: ", singular_values_list.shape)
+
+        #Projection is cached by the features it was computed from; 'pca', 'randomized_svd', 'random_projection' and 'spectral' scale to the whole dataset
+        projected_data = compute_lens(singular_values_list, lens=lens, store=lens_store)
+
+        #Same graph as mapper.map, with the hypercubes clustered in parallel
+        with tracing.span('mapper_graph'):
+            graph = build_graph(
                 projected_data,
                 singular_values_list,
-                clusterer=sklearn.cluster.KMeans()
-            )            
+                clusterer=size_adaptive_clusterer(n_clusters=8),
+                nerve=SparseNerve(),
+                projection=lens,
+                scaler='MinMaxScaler()'
+            )
+
+        #Compact graph bundle with per-node statistics; the html only shows its largest nodes with sampled members
+        graph_dir = os.path.join(job_dir, "kepler-mapper-output")
+        html_file = os.path.join(job_dir, "kepler-mapper-output.html")
+        with tracing.span('save_graph'):
+            save_graph(graph_dir, graph, X=singular_values_list, lens=projected_data, lens_meta={'lens': lens})
+        html = load_graph(graph_dir).visualize(path_html=html_file)
+    finally:
+        if trace:
+            tracing.disable()
+            tracing.save_json(os.path.join(job_dir, 'trace.json'))
+            tracing.save_chrome_trace(os.path.join(job_dir, 'chrome_trace.json'))
+            tracing.print_summary()
+
+    print("--- %s seconds ---" % (time.time() - start_time_inside))
+    return {'graph': graph_dir, 'html': html_file, 'features': feature_key, 'n_samples': n_samples}
+
 
-            html = mapper.visualize(graph, path_html="kepler-mapper-output.html")
-                       
-            print("--- %s seconds ---" % (time.time() - start_time_inside))
+def experiment(nTimes, corrupt_prob_list, noise_prob_list,
+      x_processed_file_list, y_file, model_cnn_file_array,
+      model_cnn_pllay_file_array, model_cnn_pllay_input_file_array,
+      batch_size=16, feature_store_dir='feature_store', lens='tsne', trace=False,
+      output_dir='experiments', n_workers=None, cpus_per_job=None, threads_per_job=None):
+
+    print("nTimes = ", nTimes)
+    #Every (corruption, noise, time) configuration is an independent job writing to output_dir/<job_id>; finished jobs are checkpointed and skipped when the experiment is run again
+    jobs = expand_jobs(nTimes, corrupt_prob_list, noise_prob_list, x_processed_file_list, y_file,
+          {'cnn': model_cnn_file_array, 'cnn_pllay': model_cnn_pllay_file_array,
+           'cnn_pllay_input': model_cnn_pllay_input_file_array})
+    #Converted here, so that concurrent jobs never convert the same file
+    for x_file in sorted(set(job['x_file'] for job in jobs)):
+        prepare_dataset(x_file, y_file)
+
+    #n_workers=None runs the jobs one after another in this process, otherwise each worker is pinned to cpus_per_job cpus
+    return run_jobs(run_job, jobs, output_dir=output_dir, n_workers=n_workers,
+          cpus_per_job=cpus_per_job, threads_per_job=threads_per_job,
+          batch_size=batch_size, feature_store_dir=feature_store_dir, lens=lens, trace=trace)
 
 
 if __name__ == '__main__' :
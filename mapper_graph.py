@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""mapper_graph
+
+Mapper graph construction, producing the same graph dict as
+KeplerMapper.map, with the per-cube clustering spread over a pool of
+workers, and a compact on-disk format for the graphs.
+"""
+
+import os
+import mmap
+import json
+import itertools
+import multiprocessing
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from scipy import sparse
+from sklearn import cluster
+from sklearn.base import clone
+from kmapper import KeplerMapper, Cover, GraphNerve
+from kmapper.nerve import Nerve
+
+import tracing
+from persistence import _attach_shared, available_cpus
+
+
+def _min_cluster_samples(clusterer):
+  # cubes with fewer points than the clusterer asks for are skipped, as in
+  # KeplerMapper.map
+  params = clusterer.get_params()
+  for parameter in ['n_clusters', 'min_cluster_size', 'min_samples']:
+    value = params.get(parameter)
+    if value and isinstance(value, int):
+      return value
+  return 2
+
+def size_adaptive_clusterer(n_clusters=8, small_cube_size=64, large_cube_size=4096, seed=0):
+  """Clusterer chosen by the number of points in the cube.
+
+  Ward linkage on small cubes, where k-means restarts cost more than the
+  clustering itself, k-means on medium cubes and mini-batch k-means on
+  large ones. Ward minimizes the same within-cluster variance as k-means,
+  whereas single linkage with a fixed n_clusters splits outliers off as
+  singleton nodes.
+
+  Returns:
+    clusterer_for: function n_points -> sklearn clusterer, to be passed as
+      the clusterer of build_graph
+  """
+  def clusterer_for(n_points):
+    if n_points <= small_cube_size:
+      return cluster.AgglomerativeClustering(n_clusters=n_clusters, linkage='ward')
+    if n_points <= large_cube_size:
+      return cluster.KMeans(n_clusters=n_clusters, random_state=seed)
+    return cluster.MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, batch_size=1024)
+  return clusterer_for
+
+
+class SparseNerve(Nerve):
+  """Nerve of the mapper nodes from a sparse samples x nodes membership matrix.
+
+  GraphNerve intersects the member lists of every pair of nodes, which is
+  quadratic in the number of nodes. Here all pairwise intersection sizes
+  come out of a single sparse product M^T M, and only overlapping pairs are
+  ever visited. links and simplices are the same as GraphNerve's.
+
+  Args:
+    min_intersection: minimum number of common samples for nodes to be
+      linked, as in GraphNerve
+    max_dimension: dimension of the largest simplices, 1 gives the graph,
+      2 adds the triangles of nodes with min_intersection common samples,
+      and so on
+  """
+
+  def __init__(self, min_intersection=1, max_dimension=1):
+    self.min_intersection = min_intersection
+    self.max_dimension = max_dimension
+
+  def __repr__(self):
+    return 'SparseNerve(min_intersection={}, max_dimension={})'.format(self.min_intersection, self.max_dimension)
+
+  def membership(self, nodes):
+    """Sparse [n_samples, n_nodes] 0/1 csr matrix, columns in the order of nodes."""
+    members = [np.unique(np.asarray(nodes[node_id], dtype=np.int64)) for node_id in nodes]
+    rows = np.concatenate(members) if members else np.zeros(0, dtype=np.int64)
+    cols = np.repeat(np.arange(len(members)), [len(m) for m in members])
+    n_samples = rows.max() + 1 if len(rows) else 0
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(n_samples, len(members)))
+
+  def compute(self, nodes):
+    """Links and simplices of the nerve.
+
+    Args:
+      nodes: dict {node id: list of sample ids}
+
+    Returns:
+      links: dict {node id: list of later node ids it is linked to}
+      simplices: list of the vertices, edges and higher simplices, each a
+        list of node ids
+    """
+    names = list(nodes)
+    M = self.membership(nodes)
+    if self.min_intersection > 0:
+      overlap = sparse.triu(M.T.dot(M).tocsr(), k=1).tocoo()
+      keep = overlap.data >= self.min_intersection
+      first, second = overlap.row[keep], overlap.col[keep]
+    else:
+      # every pair, as GraphNerve
+      first, second = np.triu_indices(len(names), k=1)
+    order = np.lexsort((second, first))
+
+    links = defaultdict(list)
+    for iFirst, iSecond in zip(first[order], second[order]):
+      links[names[iFirst]].append(names[iSecond])
+    simplices = [[node_id] for node_id in names] + [[x, end] for x in links for end in links[x]]
+
+    # a simplex is counted once per sample in all of its nodes, a sample
+    # is in a handful of nodes at most
+    for dimension in range(2, self.max_dimension + 1):
+      counts = Counter()
+      for iSample in range(M.shape[0]):
+        sample_nodes = M.indices[M.indptr[iSample]:M.indptr[iSample + 1]]
+        if len(sample_nodes) > dimension:
+          counts.update(itertools.combinations(np.sort(sample_nodes).tolist(), dimension + 1))
+      simplices += [[names[iNode] for iNode in simplex] for simplex in sorted(counts)
+                    if counts[simplex] >= max(self.min_intersection, 1)]
+    return links, simplices
+
+
+_worker_data = {}
+
+def _share(X, blocks):
+  # a .npy memmap is reopened by name in the workers, any other array is
+  # copied once into shared memory
+  if isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap) and X.flags['C_CONTIGUOUS']:
+    return ('memmap', X.filename, X.offset, tuple(X.shape), X.dtype.str)
+  X = np.ascontiguousarray(X)
+  block = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+  blocks.append(block)
+  np.ndarray(X.shape, dtype=X.dtype, buffer=block.buf)[:] = X
+  return ('shared', block.name, tuple(X.shape), X.dtype.str)
+
+def _get_data(spec):
+  if spec not in _worker_data:
+    # only the array of the current build_graph call stays attached
+    for block, _ in _worker_data.values():
+      if block is not None:
+        block.close()
+    _worker_data.clear()
+    if spec[0] == 'memmap':
+      _, filename, offset, shape, dtype = spec
+      _worker_data[spec] = (None, np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape))
+    else:
+      _worker_data[spec] = _attach_shared(spec[1:])
+  return _worker_data[spec][1]
+
+@tracing.traced('clustering')
+def _cluster_cube(data, ids, clusterer):
+  # KeplerMapper.map prepends the integer ids to the data, which makes
+  # float32 data float64, and the clusterers do not give the same clusters
+  # in both precisions
+  return clusterer.fit_predict(data[ids].astype(np.result_type(data.dtype, np.int_), copy=False))
+
+def _cluster_cube_shared(spec, ids, clusterer):
+  return _cluster_cube(_get_data(spec), ids, clusterer)
+
+
+_executors = {}
+
+def _get_executor(backend, n_workers):
+  # kept across calls, starting spawned workers costs seconds
+  key = (backend, n_workers)
+  if key not in _executors:
+    if backend == 'thread':
+      _executors[key] = ThreadPoolExecutor(max_workers=n_workers)
+    else:
+      # spawn, as forking a process that already runs tensorflow threads is unsafe
+      _executors[key] = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'))
+  return _executors[key]
+
+
+def build_graph(lens, X=None, clusterer=None, cover=None, nerve=None, backend='thread', n_workers=None,
+                remove_duplicate_nodes=False, projection='custom', scaler=None):
+  """Mapper graph of X over lens, clustering the cover hypercubes in parallel.
+
+  The nodes, links and simplices are the same as KeplerMapper.map with the
+  same (deterministic) clusterer, only the clustering of the hypercubes is
+  done by a pool of workers.
+
+  Args:
+    lens: array of shape [N, n_components]
+    X: array of shape [N, D] clustered in every cube, defaults to lens. A
+      .npy memmap is shared with process workers by file, any other array
+      through shared memory
+    clusterer: sklearn clusterer used on every cube, or a function
+      n_points -> clusterer such as size_adaptive_clusterer. Defaults to
+      DBSCAN(eps=0.5, min_samples=3), as in KeplerMapper.map
+    cover: kmapper Cover, defaults to Cover(n_cubes=10, perc_overlap=0.1)
+    nerve: kmapper nerve, defaults to GraphNerve(), SparseNerve() gives the
+      same graph and scales to many overlapping nodes
+    backend: 'serial', 'thread' or 'process'. The sklearn k-means release the
+      GIL, so threads already scale across cores; processes also scale
+      clusterers that hold it, e.g. DBSCAN or agglomerative clustering, but their
+      workers take seconds to start on the first call
+    n_workers: number of workers, defaults to available_cpus()
+    remove_duplicate_nodes: merge nodes with the same members
+    projection: description of the lens, stored in the graph meta data
+    scaler: description of the lens scaler, stored in the graph meta data
+
+  Returns:
+    graph: dict with nodes, links, simplices, meta_data and meta_nodes, as
+      consumed by KeplerMapper.visualize
+  """
+  if backend not in ('serial', 'thread', 'process'):
+    raise ValueError("backend must be 'serial', 'thread' or 'process', got %r" % (backend,))
+  clusterer = clusterer if clusterer is not None else cluster.DBSCAN(eps=0.5, min_samples=3)
+  cover = cover or Cover(n_cubes=10, perc_overlap=0.1)
+  nerve = nerve or GraphNerve()
+  n_workers = n_workers or available_cpus()
+  X = lens if X is None else X
+  # a fresh copy per cube, thread workers would otherwise fit the same estimator at once
+  clusterer_for = clusterer if callable(clusterer) and not hasattr(clusterer, 'fit_predict') else lambda n_points: clone(clusterer)
+
+  # the cover works on the lens prefixed with the sample ids
+  lens = np.c_[np.arange(lens.shape[0]), lens]
+  cover.fit(lens)
+  tasks = []
+  for iCube, hypercube in enumerate(cover.transform(lens)):
+    ids = hypercube[:, 0].astype(int)
+    cube_clusterer = clusterer_for(len(ids))
+    if len(ids) >= _min_cluster_samples(cube_clusterer):
+      tasks.append((iCube, ids, cube_clusterer))
+
+  predictions = {}
+  if backend == 'serial' or n_workers == 1 or len(tasks) <= 1:
+    for iCube, ids, cube_clusterer in tasks:
+      predictions[iCube] = _cluster_cube(X, ids, cube_clusterer)
+  else:
+    # largest cubes first, so that no worker is left with a big one at the end
+    tasks_by_size = sorted(tasks, key=lambda task: -len(task[1]))
+    executor = _get_executor(backend, n_workers)
+    blocks = []
+    try:
+      if backend == 'thread':
+        futures = {iCube: executor.submit(_cluster_cube, X, ids, cube_clusterer)
+                   for iCube, ids, cube_clusterer in tasks_by_size}
+      else:
+        spec = _share(X, blocks)
+        futures = {iCube: executor.submit(tracing.call_collecting, tracing.is_enabled(), _cluster_cube_shared,
+                                          spec, ids, cube_clusterer)
+                   for iCube, ids, cube_clusterer in tasks_by_size}
+      predictions = {iCube: future.result() for iCube, future in futures.items()}
+      if backend == 'process':
+        for iCube, (cluster_predictions, events) in predictions.items():
+          tracing.merge(events)
+          predictions[iCube] = cluster_predictions
+    finally:
+      for block in blocks:
+        block.close()
+        block.unlink()
+
+  # nodes in cube order, as in KeplerMapper.map
+  nodes = defaultdict(list)
+  for iCube, ids, _ in tasks:
+    cluster_predictions = predictions[iCube]
+    for pred in np.unique(cluster_predictions):
+      if pred != -1 and not np.isnan(pred):
+        nodes['cube{}_cluster{}'.format(iCube, int(pred))] = ids[cluster_predictions == pred].tolist()
+
+  if remove_duplicate_nodes:
+    deduped_items = defaultdict(list)
+    for node_id, items in nodes.items():
+      deduped_items[frozenset(items)].append(node_id)
+    nodes = {'-'.join(node_id_list): list(items) for items, node_id_list in deduped_items.items()}
+
+  with tracing.span('nerve'):
+    links, simplices = nerve.compute(nodes)
+  return {'nodes': nodes, 'links': links, 'simplices': simplices,
+          'meta_data': {'projection': projection, 'n_cubes': cover.n_cubes, 'perc_overlap': cover.perc_overlap,
+                        'clusterer': str(clusterer), 'scaler': str(scaler),
+                        'nerve_min_intersection': nerve.min_intersection},
+          'meta_nodes': defaultdict(list)}
+
+
+def save_graph(directory, graph, X=None, lens=None, lens_meta=None):
+  """Write a mapper graph as a directory of .npy arrays plus meta.json.
+
+  Every array can be memory-mapped back by load_graph, unlike the members
+  of an .npz. The bundle holds:
+    indptr, indices: membership of the nodes as a csr [n_nodes, n_samples]
+      matrix, node i has members indices[indptr[i]:indptr[i+1]]
+    edges: int32 [n_edges, 2] node indices of the links
+    simplices_<d>: int32 [n_simplices, d+1] for every dimension d >= 2
+    size: number of members of every node
+    lens_mean, lens_std: per-node mean and standard deviation of the lens,
+      when lens is given
+    x_mean: per-node mean of X [n_nodes, D], when X is given
+
+  Args:
+    directory: output directory, created if needed
+    graph: graph dict of build_graph or KeplerMapper.map
+    X: optional features [N, D] the graph was built on
+    lens: optional lens [N, n_components] the graph was built on
+    lens_meta: optional dict describing the lens, e.g. the configuration
+      passed to compute_lens, saved in meta.json
+  """
+  os.makedirs(directory, exist_ok=True)
+  node_ids = list(graph['nodes'])
+  index = {node_id: iNode for iNode, node_id in enumerate(node_ids)}
+  members = SparseNerve().membership(graph['nodes']).T.tocsr()  # [n_nodes, n_samples]
+  n_samples = max(members.shape[1], 0 if X is None else len(X), 0 if lens is None else len(lens))
+  members.resize((len(node_ids), n_samples))
+  size = np.diff(members.indptr)
+
+  index_dtype = np.int32 if n_samples < 2**31 else np.int64
+  arrays = {'indptr': members.indptr.astype(np.int64), 'indices': members.indices.astype(index_dtype), 'size': size}
+  edges = [(index[x], index[end]) for x in graph['links'] for end in graph['links'][x]]
+  arrays['edges'] = np.array(edges, dtype=np.int32).reshape(-1, 2)
+  simplices = defaultdict(list)
+  for simplex in graph['simplices']:
+    if len(simplex) > 2:
+      simplices[len(simplex) - 1].append([index[node_id] for node_id in simplex])
+  for dimension, simplex_list in simplices.items():
+    arrays['simplices_%d' % dimension] = np.array(simplex_list, dtype=np.int32)
+
+  # per node means as a product with the row normalized membership matrix
+  mean_op = sparse.diags(1. / np.maximum(size, 1)).dot(members)
+  if lens is not None:
+    lens = np.asarray(lens, dtype=np.float32)
+    arrays['lens_mean'] = mean_op.dot(lens).astype(np.float32)
+    arrays['lens_std'] = np.sqrt(np.maximum(mean_op.dot(lens ** 2) - arrays['lens_mean'] ** 2, 0.)).astype(np.float32)
+  if X is not None:
+    arrays['x_mean'] = np.asarray(mean_op.dot(np.asarray(X, dtype=np.float32)), dtype=np.float32)
+
+  for name, array in arrays.items():
+    np.save(os.path.join(directory, name + '.npy'), array)
+  meta = {'node_ids': node_ids, 'n_samples': int(n_samples), 'arrays': sorted(arrays),
+          'meta_data': graph.get('meta_data', {}), 'lens': lens_meta or {}}
+  with open(os.path.join(directory, 'meta.json'), 'w') as f:
+    json.dump(meta, f, default=str)
+
+
+def load_graph(directory):
+  """GraphBundle of a graph written by save_graph."""
+  return GraphBundle(directory)
+
+
+class GraphBundle(object):
+  """Lazy view of a graph written by save_graph.
+
+  Only meta.json is read when the bundle is opened, every array is
+  memory-mapped on first use.
+
+  Args:
+    directory: directory written by save_graph
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    with open(os.path.join(directory, 'meta.json')) as f:
+      self.meta = json.load(f)
+    self.node_ids = self.meta['node_ids']
+    self._arrays = {}
+
+  def __len__(self):
+    return len(self.node_ids)
+
+  def __contains__(self, name):
+    return name in self.meta['arrays']
+
+  def __getitem__(self, name):
+    """Array name of the bundle, as a read-only memmap."""
+    if name not in self._arrays:
+      if name not in self:
+        raise KeyError('%s has no array %r' % (self.directory, name))
+      self._arrays[name] = np.load(os.path.join(self.directory, name + '.npy'), mmap_mode='r')
+    return self._arrays[name]
+
+  def members(self, iNode):
+    """Sample ids of the node with index iNode."""
+    indptr = self['indptr']
+    return self['indices'][indptr[iNode]:indptr[iNode + 1]]
+
+  def to_graph(self, node_indices=None, max_members=None, seed=0):
+    """Graph dict as consumed by KeplerMapper.visualize.
+
+    Args:
+      node_indices: optional subset of the nodes, links are kept between
+        nodes of the subset only
+      max_members: optional number of members kept per node, sampled at
+        random, for a lighter view of large nodes
+      seed: seed of the member sampling
+    """
+    node_indices = np.arange(len(self)) if node_indices is None else np.asarray(node_indices)
+    kept = np.zeros(len(self), dtype=bool)
+    kept[node_indices] = True
+    rng = np.random.default_rng(seed)
+    nodes = {}
+    for iNode in node_indices:
+      members = np.asarray(self.members(iNode))
+      if max_members is not None and len(members) > max_members:
+        members = np.sort(rng.choice(members, max_members, replace=False))
+      nodes[self.node_ids[iNode]] = members.tolist()
+
+    links = defaultdict(list)
+    for iFirst, iSecond in np.asarray(self['edges']):
+      if kept[iFirst] and kept[iSecond]:
+        links[self.node_ids[iFirst]].append(self.node_ids[iSecond])
+    simplices = [[node_id] for node_id in nodes] + [[x, end] for x in links for end in links[x]]
+    for name in self.meta['arrays']:
+      if name.startswith('simplices_'):
+        for simplex in np.asarray(self[name]):
+          if kept[simplex].all():
+            simplices.append([self.node_ids[iNode] for iNode in simplex])
+    return {'nodes': nodes, 'links': links, 'simplices': simplices,
+            'meta_data': self.meta['meta_data'], 'meta_nodes': defaultdict(list)}
+
+  def visualize(self, path_html, max_nodes=200, max_members=50, seed=0, **visualize_kwargs):
+    """Write a light html view of the largest max_nodes nodes.
+
+    The kmapper page embeds the member ids of every node, so nodes are
+    capped at max_members sampled members; node sizes and colors are those
+    of the sampled members. The exact statistics stay in the bundle.
+
+    Args:
+      path_html: output html file
+      max_nodes: number of nodes shown, the largest ones
+      max_members: number of members kept per node
+      seed: seed of the member sampling
+      visualize_kwargs: passed to KeplerMapper.visualize
+    """
+    with tracing.span('visualize'):
+      node_indices = np.sort(np.argsort(-np.asarray(self['size']), kind='stable')[:max_nodes])
+      graph = self.to_graph(node_indices, max_members=max_members, seed=seed)
+      return KeplerMapper().visualize(graph, path_html=path_html, **visualize_kwargs)
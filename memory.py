@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""memory
+
+Resident memory of the current process, for sizing batches against a
+memory budget. On linux the peak is the high water mark of
+/proc/self/status, which can be reset, so the peak of a single block of
+code is measured exactly. Elsewhere the peak is the one of the whole
+process, an upper bound.
+
+  with PeakMemory() as peak:
+    ...
+  print(peak.peak, peak.increase)
+"""
+
+import sys
+import resource
+
+_PROC = '/proc/self/'
+# high water marks from before the last reset, for max_rss_bytes
+_state = {'max_before_reset': 0}
+
+
+def _proc_status_bytes(field):
+  try:
+    with open(_PROC + 'status') as f:
+      for line in f:
+        if line.startswith(field + ':'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return None
+
+def _ru_maxrss_bytes():
+  # kilobytes on linux, bytes on macos
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def rss_bytes():
+  """Current resident size of the process."""
+  rss = _proc_status_bytes('VmRSS')
+  return rss if rss is not None else _ru_maxrss_bytes()
+
+def peak_rss_bytes():
+  """Peak resident size since the last reset_peak, or since the process started."""
+  peak = _proc_status_bytes('VmHWM')
+  return peak if peak is not None else _ru_maxrss_bytes()
+
+def max_rss_bytes():
+  """Peak resident size since the process started, across reset_peak calls."""
+  return max(_state['max_before_reset'], peak_rss_bytes(), _ru_maxrss_bytes())
+
+def reset_peak():
+  """Reset the peak of peak_rss_bytes to the current resident size.
+
+  It also resets ru_maxrss on linux, max_rss_bytes keeps the earlier peak.
+
+  Returns:
+    True if the peak was reset, False where it is not supported
+  """
+  peak = max_rss_bytes()
+  try:
+    with open(_PROC + 'clear_refs', 'w') as f:
+      f.write('5')
+  except OSError:
+    return False
+  _state['max_before_reset'] = peak
+  return True
+
+
+class PeakMemory(object):
+  """Context manager measuring the peak resident size of a block.
+
+  Attributes, once the block has run:
+    start: resident size when the block started
+    peak: peak resident size during the block, or of the whole process
+      when the peak could not be reset
+    increase: peak - start
+  """
+
+  def __enter__(self):
+    self.exact = reset_peak()
+    self.start = rss_bytes()
+    return self
+
+  def __exit__(self, *exc):
+    self.peak = peak_rss_bytes()
+    self.increase = max(self.peak - self.start, 0)
+    return False
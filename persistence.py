@@ -0,0 +1,629 @@
+# -*- coding: utf-8 -*-
+"""persistence
+
+Numpy / gudhi kernels behind the persistence layers of pllay, and a pool
+running them over a whole batch. Kept free of tensorflow so that process
+workers stay light.
+"""
+
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import gudhi
+
+import tracing
+
+
+def available_cpus():
+  """Number of cpus this process may run on, honouring its affinity mask."""
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return os.cpu_count() or 1
+
+
+def np_cubical_persistence(fun_value, grid_size):
+  """Cubical persistence pairs together with their critical cells.
+
+  Args:
+    fun_value: numpy array of shape [N]
+    grid_size: list of grid dimensions with prod(grid_size) == N
+
+  Returns:
+    pairDim: numpy array of shape [P], homology dimension of each pair
+    birth: numpy array of shape [P], float64 birth values
+    death: numpy array of shape [P], float64 death values (inf if essential)
+    locationBirth: numpy array of shape [P], index of the birth cell
+    locationDeath: numpy array of shape [P], index of the death cell (-1 if essential)
+    Pairs are ordered by decreasing dimension, then decreasing persistence,
+    as gudhi orders them.
+  """
+  with tracing.span('cubical_complex'):
+    cubCpx = gudhi.CubicalComplex(dimensions=grid_size, top_dimensional_cells=fun_value)
+  with tracing.span('persistence'):
+    cubCpx.persistence(homology_coeff_field=2, min_persistence=0)
+    location = cubCpx.cofaces_of_persistence_pairs()
+  regular = [np.reshape(loc, (-1, 2)) for loc in location[0]]
+  essential = [np.reshape(loc, (-1,)) for loc in location[1]]
+
+  locationRegular = np.concatenate(regular + [np.zeros((0, 2), dtype=np.int32)]).astype(np.int32)
+  locationEssential = np.concatenate(essential + [np.zeros((0,), dtype=np.int32)]).astype(np.int32)
+  locationBirth = np.concatenate((locationRegular[:, 0], locationEssential))
+  locationDeath = np.concatenate((locationRegular[:, 1], np.full(len(locationEssential), -1, dtype=np.int32)))
+  pairDim = np.concatenate([np.repeat(ldim, len(loc)) for ldim, loc in enumerate(regular)] +
+                           [np.repeat(ldim, len(loc)) for ldim, loc in enumerate(essential)] +
+                           [np.zeros((0,), dtype=np.int64)]).astype(np.int32)
+
+  fun_birth = fun_value[locationBirth]
+  fun_death = np.where(locationDeath >= 0, fun_value[locationDeath], np.inf).astype(fun_value.dtype)
+  order = np.lexsort((-(fun_death - fun_birth), -pairDim))
+  return (pairDim[order], fun_birth[order].astype(np.float64), fun_death[order].astype(np.float64),
+          locationBirth[order], locationDeath[order])
+
+@tracing.traced('landscape')
+def np_landscape(pairDim, birth, death, tseq, KK, dimensions, dtype='float32'):
+  """Persistence landscape and its derivative with respect to the pairs.
+
+  Args:
+    pairDim: numpy array of shape [P]
+    birth: numpy array of shape [P]
+    death: numpy array of shape [P]
+    tseq: numpy array of shape [len(tseq)]
+    KK: numpy array of shape [len(KK)]
+    dimensions: list of homology dimensions
+
+  Returns:
+    land: numpy array of shape [len(dims), len(tseq), len(KK)]
+    landIndex: numpy array of shape [len(dims), len(tseq), len(KK)], pair
+      attaining each landscape value (-1 if none)
+    landDiffBirth: numpy array of shape [len(dims), len(tseq), len(KK)]
+    landDiffDeath: numpy array of shape [len(dims), len(tseq), len(KK)]
+  """
+  len_dim = len(dimensions)
+  len_tseq = len(tseq)
+  len_KK = len(KK)
+  tcol = np.expand_dims(tseq, -1)  # [len(tseq), 1]
+
+  land = np.zeros((len_dim, len_tseq, len_KK), dtype=dtype)
+  landIndex = np.full((len_dim, len_tseq, len_KK), -1, dtype=np.int32)
+  landDiffBirth = np.zeros((len_dim, len_tseq, len_KK), dtype=dtype)
+  landDiffDeath = np.zeros((len_dim, len_tseq, len_KK), dtype=dtype)
+
+  for iDim, dim in enumerate(dimensions):
+    pDiagDimIds = np.flatnonzero(pairDim == dim).astype(np.int32)
+    len_pDiagDim = len(pDiagDimIds)
+    pBirth = birth[pDiagDimIds]
+    pDeath = death[pDiagDimIds]
+
+    # tent functions, padded with zeros up to the largest requested order
+    fab = np.zeros((len_tseq, max(len_pDiagDim, np.max(KK)+1)), dtype=dtype)
+    fab[:, :len_pDiagDim] = np.maximum(np.minimum(tcol - pBirth, pDeath - tcol), 0)
+    fabIndex = np.argsort(-fab, axis=-1)[:, KK]  # [len(tseq), len(KK)]
+    land[iDim] = np.take_along_axis(fab, fabIndex, -1)
+    if len_pDiagDim == 0:
+      continue
+
+    fabDiffBirth = np.where((tcol > pBirth) & (2 * tcol < pBirth + pDeath), -1., 0.)  # [len(tseq), len_pDiagDim]
+    fabDiffDeath = np.where((tcol < pDeath) & (2 * tcol > pBirth + pDeath), 1., 0.)
+    valid = fabIndex < len_pDiagDim
+    fabIndex = np.minimum(fabIndex, len_pDiagDim - 1)
+    landIndex[iDim] = np.where(valid, pDiagDimIds[fabIndex], -1)
+    landDiffBirth[iDim] = np.where(valid, np.take_along_axis(fabDiffBirth, fabIndex, -1), 0.)
+    landDiffDeath[iDim] = np.where(valid, np.take_along_axis(fabDiffDeath, fabIndex, -1), 0.)
+
+  return land, landIndex, landDiffBirth, landDiffDeath
+
+
+def np_landscape_op(fun_value, grid_size, tseq, KK, dimensions, dtype='float32'):
+  """Landscape of a filtration and its sparse derivative.
+
+  Args:
+    fun_value: numpy array of shape [N]
+    grid_size: list of grid dimensions with prod(grid_size) == N
+    tseq: numpy array of shape [len(tseq)]
+    KK: numpy array of shape [len(KK)]
+    dimensions: list of homology dimensions
+
+  Returns:
+    land: numpy array of shape [len(dims), len(tseq), len(KK)]
+    diffIndex: numpy array of shape [len(dims), len(tseq), len(KK), 2],
+      birth and death cell of the pair attaining each landscape value
+    diffValue: numpy array of shape [len(dims), len(tseq), len(KK), 2],
+      derivative of each landscape value at those cells
+  """
+  return _landscape_outputs(np_cubical_persistence(fun_value, grid_size), tseq, KK, dimensions, dtype)
+
+def _landscape_outputs(persistence, tseq, KK, dimensions, dtype):
+  pairDim, birth, death, locationBirth, locationDeath = persistence
+  land, landIndex, landDiffBirth, landDiffDeath = np_landscape(
+      pairDim, birth, death, tseq, KK, dimensions, dtype=dtype)
+
+  # each landscape entry depends on the birth and death cell of one pair;
+  # entries without a pair or without a death cell point at cell 0 with value 0
+  hasPair = landIndex >= 0
+  pairIndex = np.where(hasPair, landIndex, 0)
+  hasDeath = hasPair & (locationDeath[pairIndex] >= 0)
+  diffIndex = np.stack((np.where(hasPair, locationBirth[pairIndex], 0),
+                        np.where(hasDeath, locationDeath[pairIndex], 0)), -1).astype(np.int32)
+  diffValue = np.stack((landDiffBirth, np.where(hasDeath, landDiffDeath, 0)), -1).astype(dtype)
+  return land, diffIndex, diffValue
+
+def np_diagram_pairs(fun_value, grid_size, dimensions, nmax_diag=None, dtype='float32'):
+  """Persistence diagram of a filtration as flat pairs, without padding.
+
+  Args:
+    fun_value: numpy array of shape [N]
+    grid_size: list of grid dimensions with prod(grid_size) == N
+    dimensions: list of homology dimensions
+    nmax_diag: optional maximum number of pairs kept per dimension
+
+  Returns:
+    pairs: numpy array of shape [P, 2], (birth, death) grouped by dimension
+      in the order of dimensions, each group by decreasing persistence
+    lengths: int64 numpy array of shape [len(dims)], number of pairs per
+      dimension
+  """
+  return _diagram_pairs(np_cubical_persistence(fun_value, grid_size), dimensions, nmax_diag, dtype)
+
+@tracing.traced('diagram')
+def _diagram_pairs(persistence, dimensions, nmax_diag, dtype):
+  pairDim, birth, death, _, _ = persistence
+  pDiagIds = [np.flatnonzero(pairDim == dim)[:nmax_diag] for dim in dimensions]
+  pDiagIds = np.concatenate(pDiagIds + [np.zeros((0,), dtype=np.int64)]).astype(np.int64)
+  pairs = np.stack((birth[pDiagIds], death[pDiagIds]), -1).astype(dtype)
+  lengths = np.array([np.count_nonzero(pairDim == dim) for dim in dimensions], dtype=np.int64)
+  if nmax_diag is not None:
+    lengths = np.minimum(lengths, nmax_diag)
+  return pairs, lengths
+
+def np_diagram_op(fun_value, grid_size, dimensions, nmax_diag, dtype='float32'):
+  """Persistence diagram of a filtration, padded to nmax_diag pairs.
+
+  Args:
+    fun_value: numpy array of shape [N]
+    grid_size: list of grid dimensions with prod(grid_size) == N
+    dimensions: list of homology dimensions
+    nmax_diag: maximum number of pairs kept per dimension
+
+  Returns:
+    diag: numpy array of shape [len(dims), nmax_diag, 2]
+  """
+  return _padded_diagram(np_cubical_persistence(fun_value, grid_size), dimensions, nmax_diag, dtype)
+
+def _padded_diagram(persistence, dimensions, nmax_diag, dtype):
+  # pairs are sorted by persistence, so the first nmax_diag are kept
+  pairs, lengths = _diagram_pairs(persistence, dimensions, nmax_diag, dtype)
+  splits = np.concatenate(([0], np.cumsum(lengths)))
+  diag = np.zeros((len(dimensions), nmax_diag, 2), dtype=dtype)
+  for iDim in range(len(dimensions)):
+    diag[iDim, :lengths[iDim]] = pairs[splits[iDim]:splits[iDim + 1]]
+  return diag
+
+def np_topo_op(fun_value, grid_size, tseq, KK, dimensions, nmax_diag, dtype='float32'):
+  """Padded diagram, landscape and its sparse derivative from one complex.
+
+  The same as np_diagram_op and np_landscape_op together, but the cubical
+  persistence of fun_value is only computed once.
+
+  Returns:
+    diag: numpy array of shape [len(dims), nmax_diag, 2]
+    land, diffIndex, diffValue: as np_landscape_op
+  """
+  persistence = np_cubical_persistence(fun_value, grid_size)
+  return (_padded_diagram(persistence, dimensions, nmax_diag, dtype),) + \
+    _landscape_outputs(persistence, tseq, KK, dimensions, dtype)
+
+
+def _run_rows(op, fun_values, outputs, start, stop, op_kwargs):
+  for iRow in range(start, stop):
+    results = op(fun_values[iRow], **op_kwargs)
+    if not isinstance(results, tuple):
+      results = (results,)
+    for output, result in zip(outputs, results):
+      output[iRow] = result
+
+def _map_rows(op, fun_values, op_kwargs):
+  return [op(fun_value, **op_kwargs) for fun_value in fun_values]
+
+def _attach_shared(spec):
+  name, shape, dtype = spec
+  # spawned workers share the parent's resource tracker, which unlinks the
+  # block once the parent is done with it
+  block = shared_memory.SharedMemory(name=name)
+  return block, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+def _run_rows_shared(op, input_spec, output_specs, start, stop, op_kwargs):
+  input_block, fun_values = _attach_shared(input_spec)
+  output_blocks, outputs = zip(*[_attach_shared(spec) for spec in output_specs])
+  try:
+    _run_rows(op, fun_values, outputs, start, stop, op_kwargs)
+  finally:
+    del fun_values, outputs
+    input_block.close()
+    for block in output_blocks:
+      block.close()
+
+
+class PersistencePool(object):
+  """Computes a persistence op over a batch of filtrations in parallel.
+
+  Args:
+    backend: 'serial', 'thread' or 'process'. gudhi releases the GIL while
+      computing persistence, so threads already scale across cores;
+      processes additionally parallelize the numpy post-processing and
+      exchange the batch through shared memory.
+    n_workers: number of workers, defaults to available_cpus()
+  """
+
+  def __init__(self, backend='thread', n_workers=None):
+    if backend not in ('serial', 'thread', 'process'):
+      raise ValueError("backend must be 'serial', 'thread' or 'process', got %r" % (backend,))
+    self.backend = backend
+    self.n_workers = n_workers or available_cpus()
+    self._executor = None
+
+  def _get_executor(self):
+    if self._executor is None:
+      if self.backend == 'thread':
+        self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+      else:
+        # spawn, as forking a process that already runs tensorflow threads is unsafe
+        self._executor = ProcessPoolExecutor(max_workers=self.n_workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+    return self._executor
+
+  def _chunks(self, nRow):
+    bounds = np.linspace(0, nRow, min(self.n_workers, nRow) + 1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+  def run(self, op, fun_values, output_specs, cache=None, **op_kwargs):
+    """Apply op to every row of fun_values and stack the results.
+
+    Args:
+      op: module level function fun_value -> array or tuple of arrays
+      fun_values: numpy array of shape [B, N]
+      output_specs: list of (shape, dtype), one per output of op
+      cache: optional PersistenceCache, only rows missing from it are computed
+      **op_kwargs: keyword arguments passed to op
+
+    Returns:
+      outputs: list of numpy arrays of shape [B] + shape
+    """
+    if cache is None:
+      return self._run(op, fun_values, output_specs, op_kwargs)
+
+    keys = [cache.key(op, fun_value, op_kwargs) for fun_value in fun_values]
+    cached = [cache.get(key) for key in keys]
+    missing = [iRow for iRow, values in enumerate(cached) if values is None]
+    computed = self._run(op, fun_values[missing], output_specs, op_kwargs)
+    for iMissing, iRow in enumerate(missing):
+      cached[iRow] = tuple(output[iMissing] for output in computed)
+      cache.put(keys[iRow], cached[iRow])
+    outputs = [np.zeros((len(fun_values),) + tuple(shape), dtype=dtype) for shape, dtype in output_specs]
+    for iRow, values in enumerate(cached):
+      for output, value in zip(outputs, values):
+        output[iRow] = value
+    return outputs
+
+  def _run(self, op, fun_values, output_specs, op_kwargs):
+    nRow = len(fun_values)
+    if self.backend == 'serial' or nRow <= 1:
+      outputs = [np.zeros((nRow,) + tuple(shape), dtype=dtype) for shape, dtype in output_specs]
+      _run_rows(op, fun_values, outputs, 0, nRow, op_kwargs)
+      return outputs
+
+    executor = self._get_executor()
+    if self.backend == 'thread':
+      outputs = [np.zeros((nRow,) + tuple(shape), dtype=dtype) for shape, dtype in output_specs]
+      futures = [executor.submit(_run_rows, op, fun_values, outputs, start, stop, op_kwargs)
+                 for start, stop in self._chunks(nRow)]
+      for future in futures:
+        future.result()
+      return outputs
+
+    # numpy views are kept in views only, so they can be dropped before the
+    # blocks are closed, even when a worker failed
+    blocks, views = [], []
+    def shared_array(shape, dtype):
+      block = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+      blocks.append(block)
+      views.append(np.ndarray(shape, dtype=dtype, buffer=block.buf))
+      return (block.name, tuple(shape), np.dtype(dtype).str)
+    try:
+      input_spec = shared_array(fun_values.shape, fun_values.dtype)
+      views[0][:] = fun_values
+      output_specs = [shared_array((nRow,) + tuple(shape), dtype) for shape, dtype in output_specs]
+      futures = [executor.submit(tracing.call_collecting, tracing.is_enabled(), _run_rows_shared,
+                                 op, input_spec, output_specs, start, stop, op_kwargs)
+                 for start, stop in self._chunks(nRow)]
+      for future in futures:
+        tracing.merge(future.result()[1])
+      outputs = [np.array(view) for view in views[1:]]
+    finally:
+      del views[:]
+      for block in blocks:
+        block.close()
+        block.unlink()
+    return outputs
+
+  def map(self, op, fun_values, cache=None, **op_kwargs):
+    """Apply op to every row of fun_values, for outputs of varying shape.
+
+    Unlike run, results are not stacked, so rows are sent to process
+    workers by pickling rather than through shared memory.
+
+    Args:
+      op: module level function fun_value -> array or tuple of arrays
+      fun_values: numpy array of shape [B, N]
+      cache: optional PersistenceCache, only rows missing from it are computed
+      **op_kwargs: keyword arguments passed to op
+
+    Returns:
+      results: list of the B results of op
+    """
+    if cache is None:
+      return self._map(op, fun_values, op_kwargs)
+
+    keys = [cache.key(op, fun_value, op_kwargs) for fun_value in fun_values]
+    results = [cache.get(key) for key in keys]
+    missing = [iRow for iRow, values in enumerate(results) if values is None]
+    for iRow, values in zip(missing, self._map(op, fun_values[missing], op_kwargs)):
+      cache.put(keys[iRow], values if isinstance(values, tuple) else (values,))
+      results[iRow] = values
+    return [values[0] if isinstance(values, tuple) and len(values) == 1 else values for values in results]
+
+  def _map(self, op, fun_values, op_kwargs):
+    nRow = len(fun_values)
+    if self.backend == 'serial' or nRow <= 1:
+      return _map_rows(op, fun_values, op_kwargs)
+    executor = self._get_executor()
+    if self.backend == 'thread':
+      futures = [executor.submit(_map_rows, op, fun_values[start:stop], op_kwargs)
+                 for start, stop in self._chunks(nRow)]
+      return [result for future in futures for result in future.result()]
+    futures = [executor.submit(tracing.call_collecting, tracing.is_enabled(), _map_rows, op, fun_values[start:stop], op_kwargs)
+               for start, stop in self._chunks(nRow)]
+    results = []
+    for future in futures:
+      chunk_results, events = future.result()
+      tracing.merge(events)
+      results.extend(chunk_results)
+    return results
+
+  def close(self):
+    if self._executor is not None:
+      self._executor.shutdown()
+      self._executor = None
+
+
+class PersistenceCache(object):
+  """Content addressed cache of persistence op results.
+
+  Results are keyed by a hash of the filtration values, the op and its
+  configuration (grid_size, dimensions, tseq, KK, nmax_diag, ...), so one
+  cache can be shared between layers. Recently used results are kept in
+  memory up to max_bytes; when a directory is given every result is also
+  written there as .npz and survives across runs.
+
+  Args:
+    max_bytes: memory budget of the in-memory tier
+    directory: optional directory of the on-disk tier
+  """
+
+  def __init__(self, max_bytes=256 * 2**20, directory=None):
+    self.max_bytes = max_bytes
+    self.directory = directory
+    self.memory_hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._nbytes = 0
+    self._lock = threading.Lock()
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+
+  def key(self, op, fun_value, op_kwargs):
+    fun_value = np.ascontiguousarray(fun_value)
+    config = sorted((name, np.asarray(value).tolist()) for name, value in op_kwargs.items())
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((op.__name__, fun_value.dtype.str, fun_value.shape, config)).encode())
+    digest.update(fun_value.tobytes())
+    return digest.hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key[:2], key + '.npz')
+
+  def get(self, key):
+    """Cached tuple of arrays for key, or None."""
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.memory_hits += 1
+        return self._entries[key]
+    if self.directory is not None and os.path.exists(self._path(key)):
+      with np.load(self._path(key)) as stored:
+        values = tuple(stored['arr_%d' % i] for i in range(len(stored.files)))
+      with self._lock:
+        self.disk_hits += 1
+      self._remember(key, values)
+      return values
+    with self._lock:
+      self.misses += 1
+    return None
+
+  def put(self, key, values):
+    values = tuple(np.array(value) for value in values)
+    self._remember(key, values)
+    if self.directory is not None and not os.path.exists(self._path(key)):
+      os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+      tmp_path = '%s.%d.%d.tmp' % (self._path(key), os.getpid(), threading.get_ident())
+      with open(tmp_path, 'wb') as f:
+        np.savez(f, *values)
+      os.replace(tmp_path, self._path(key))
+
+  def _remember(self, key, values):
+    nbytes = sum(value.nbytes for value in values)
+    if nbytes > self.max_bytes:
+      return
+    with self._lock:
+      if key in self._entries:
+        return
+      self._entries[key] = values
+      self._nbytes += nbytes
+      while self._nbytes > self.max_bytes:
+        _, evicted = self._entries.popitem(last=False)
+        self._nbytes -= sum(value.nbytes for value in evicted)
+
+  def stats(self):
+    """Hit and miss counters and memory usage."""
+    with self._lock:
+      lookups = self.memory_hits + self.disk_hits + self.misses
+      return {'memory_hits': self.memory_hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+              'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.,
+              'entries': len(self._entries), 'nbytes': self._nbytes}
+
+  def clear(self):
+    """Drop the in-memory tier and reset the counters."""
+    with self._lock:
+      self._entries.clear()
+      self._nbytes = 0
+      self.memory_hits = self.disk_hits = self.misses = 0
+
+def cached_op(cache, op, fun_value, **op_kwargs):
+  """op(fun_value, **op_kwargs), looked up in cache first when one is given."""
+  if cache is None:
+    return op(fun_value, **op_kwargs)
+  key = cache.key(op, fun_value, op_kwargs)
+  values = cache.get(key)
+  if values is None:
+    values = op(fun_value, **op_kwargs)
+    cache.put(key, values if isinstance(values, tuple) else (values,))
+  elif len(values) == 1:
+    values = values[0]
+  return values
+
+
+class RaggedDiagrams(object):
+  """Persistence diagrams of N samples as flat pairs and row splits.
+
+  The diagram of sample i in the j-th homology dimension is
+  pairs[row_splits[i*n_dims + j]:row_splits[i*n_dims + j + 1]], so storage
+  grows with the number of pairs instead of N * n_dims * nmax_diag.
+
+  Args:
+    pairs: array of shape [P, 2], e.g. a np.memmap
+    row_splits: int64 array of shape [N*n_dims + 1]
+    dimensions: list of homology dimensions
+  """
+
+  def __init__(self, pairs, row_splits, dimensions):
+    self.pairs = pairs
+    self.row_splits = row_splits
+    self.dimensions = list(dimensions)
+
+  def __len__(self):
+    return (len(self.row_splits) - 1) // len(self.dimensions)
+
+  def lengths(self):
+    """Number of pairs of every diagram, int64 array of shape [N, n_dims]."""
+    return np.diff(self.row_splits).reshape(-1, len(self.dimensions))
+
+  def rows(self, start=0, stop=None):
+    """Pairs and row splits of samples start to stop, the splits starting at 0."""
+    stop = len(self) if stop is None else stop
+    nDim = len(self.dimensions)
+    row_splits = np.asarray(self.row_splits[start * nDim:stop * nDim + 1])
+    return np.asarray(self.pairs[row_splits[0]:row_splits[-1]]), row_splits - row_splits[0]
+
+  def diagram(self, iX, iDim=0):
+    """Pairs of sample iX in the iDim-th homology dimension, shape [n_pairs, 2]."""
+    iRow = iX * len(self.dimensions) + iDim
+    return np.asarray(self.pairs[self.row_splits[iRow]:self.row_splits[iRow + 1]])
+
+  def to_padded(self, nmax_diag=None, start=0, stop=None):
+    """Zero padded array [stop - start, n_dims, nmax_diag, 2] as compute_diagram_* returns.
+
+    nmax_diag defaults to the largest diagram, longer diagrams are truncated.
+    """
+    pairs, row_splits = self.rows(start, stop)
+    lengths = np.diff(row_splits)
+    if nmax_diag is None:
+      nmax_diag = int(lengths.max()) if len(lengths) else 0
+    diag = np.zeros((len(lengths), nmax_diag, 2), dtype=pairs.dtype)
+    for iRow, length in enumerate(lengths):
+      length = min(length, nmax_diag)
+      diag[iRow, :length] = pairs[row_splits[iRow]:row_splits[iRow] + length]
+    return diag.reshape(-1, len(self.dimensions), nmax_diag, 2)
+
+  @classmethod
+  def load(cls, directory, mmap_mode='r'):
+    """Diagrams written by RaggedDiagramWriter, as memmaps."""
+    with open(os.path.join(directory, 'meta.json')) as f:
+      meta = json.load(f)
+    return cls(np.load(os.path.join(directory, 'pairs.npy'), mmap_mode=mmap_mode),
+               np.load(os.path.join(directory, 'row_splits.npy'), mmap_mode=mmap_mode), meta['dimensions'])
+
+
+class RaggedDiagramWriter(object):
+  """Collects batches of ragged diagrams into RaggedDiagrams.
+
+  With a directory, pairs are appended to a file as they come, and
+  pairs.npy, row_splits.npy and meta.json are written by close; otherwise
+  they are kept in memory.
+
+  Args:
+    dimensions: list of homology dimensions
+    directory: optional output directory
+  """
+
+  def __init__(self, dimensions, directory=None):
+    self.dimensions = list(dimensions)
+    self.directory = directory
+    self._lengths = []
+    self._pairs = []
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+      self._tmp_path = os.path.join(directory, 'pairs.%d.tmp' % os.getpid())
+      self._file = open(self._tmp_path, 'wb')
+
+  def append(self, pairs, lengths):
+    """Add diagrams, pairs [P, 2] with lengths [b*n_dims] as np_diagram_pairs."""
+    pairs = np.ascontiguousarray(pairs, dtype=np.float32)
+    if self.directory is None:
+      self._pairs.append(pairs)
+    else:
+      pairs.tofile(self._file)
+    self._lengths.append(np.asarray(lengths, dtype=np.int64))
+
+  def close(self):
+    row_splits = np.concatenate([[0], np.cumsum(np.concatenate(self._lengths + [np.zeros((0,), dtype=np.int64)]))]).astype(np.int64)
+    if self.directory is None:
+      pairs = np.concatenate(self._pairs + [np.zeros((0, 2), dtype=np.float32)])
+      return RaggedDiagrams(pairs, row_splits, self.dimensions)
+    self._file.close()
+    pairs = np.memmap(self._tmp_path, dtype=np.float32, mode='r', shape=(int(row_splits[-1]), 2)) \
+      if row_splits[-1] > 0 else np.zeros((0, 2), dtype=np.float32)
+    np.save(os.path.join(self.directory, 'pairs.npy'), pairs)
+    del pairs
+    os.remove(self._tmp_path)
+    np.save(os.path.join(self.directory, 'row_splits.npy'), row_splits)
+    # written last, its presence marks complete diagrams
+    with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+      json.dump({'dimensions': self.dimensions, 'n_samples': (len(row_splits) - 1) // len(self.dimensions),
+                 'n_pairs': int(row_splits[-1])}, f, indent=2)
+    return RaggedDiagrams.load(self.directory)
+
+
+_pools = {}
+
+def get_persistence_pool(backend='thread', n_workers=None):
+  """Pool shared by all layers using the same backend and worker count."""
+  key = (backend, n_workers)
+  if key not in _pools:
+    _pools[key] = PersistencePool(backend=backend, n_workers=n_workers)
+  return _pools[key]
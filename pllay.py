@@ -6,10 +6,13 @@ Automatically generated by Colaboratory.
 
 import numpy as np
 import tensorflow.compat.v2 as tf
-import gudhi
+from persistence import np_landscape_op, np_diagram_op, np_diagram_pairs, np_topo_op, get_persistence_pool, cached_op, RaggedDiagramWriter
+import tracing
+import memory
 from sklearn.neighbors import NearestNeighbors
 from sklearn.model_selection import ParameterGrid
 import time
+import contextlib
 
 tf.enable_v2_behavior()
 #tf.compat.v1.flags.DEFINE_string('f', '', 'kernel')
@@ -112,6 +115,7 @@ def tf_dtmFromKnnDistanceWeight(knnDistance, knnIndex, weight, weightBound, r=2.
     dtmValue = tf.math.pow(dtmValue/weightBound, 1/r)
   return tf.squeeze(dtmValue, -1)
 
+@tracing.traced('knn')
 def tf_knn(X, Y, k, r=2.):
   """TF Brute Force KNN.
 
@@ -119,6 +123,7 @@ def tf_knn(X, Y, k, r=2.):
     X: Tensor of shape [..., M, D]
     Y: Tensor of shape [N, D]
     k: Int representing number of neighbors
+    r: Float r-Norm, np.inf for the max norm
 
   Returns:
     distance: Tensor of shape [..., N, k]
@@ -139,6 +144,10 @@ def tf_knn(X, Y, k, r=2.):
     Yr = tf.reshape(Y, (1, -1, d))
     XY = tf.reduce_sum(tf.abs(Xr - Yr), -1)
     neg_dist = - XY
+  elif r == np.inf:
+    Xr = tf.reshape(X, (-1, 1, d))
+    Yr = tf.reshape(Y, (1, -1, d))
+    neg_dist = - tf.reduce_max(tf.abs(Xr - Yr), -1)
   else:
     Xr = tf.reshape(X, (-1, 1, d))
     Yr = tf.reshape(Y, (1, -1, d))
@@ -149,6 +158,143 @@ def tf_knn(X, Y, k, r=2.):
   distance, index = tf.math.top_k(neg_dist, k)  # [..., N, k]
   return -distance, index
 
+@tracing.traced('knn')
+def tf_knn_tiled(X, Y, k, r=2., max_bytes=64 * 2**20):
+  """TF Brute Force KNN computed over tiles of bounded size.
+
+  Gives the same neighbors as tf_knn, but never materializes more than
+  about max_bytes of distances at once: Y is processed in blocks of rows
+  and X in blocks of points whose partial top-k are merged. The bound
+  holds for the whole batch when its size is static, per sample otherwise.
+  For r other than 1 and 2, tf.pow may round differently from tf_knn in
+  the last ulp, which can only reorder exactly tied neighbors.
+
+  Args:
+    X: Tensor of shape [..., M, D]
+    Y: Tensor of shape [N, D]
+    k: Int representing number of neighbors
+    r: Float r-Norm, np.inf for the max norm
+    max_bytes: Int memory cap of one distance tile
+
+  Returns:
+    distance: Tensor of shape [..., N, k]
+    index: Tensor of shape [..., N, k]
+  """
+  assert X.shape[-1] == Y.shape[1]
+  d = X.shape[-1]
+  M = X.shape[-2]
+  N = Y.shape[0]
+  B = int(np.prod(X.shape[:-2])) if X.shape[:-2].is_fully_defined() else 1
+  Xr = tf.reshape(X, (-1, M, d))  # [B, M, d]
+  tile_bytes = 4 if r == 2.0 else 4 * d
+  nBlock = int(min(N, max(1, max_bytes // (tile_bytes * B * M))))
+  mBlock = int(min(M, max(1, max_bytes // (tile_bytes * B * nBlock))))
+
+  distances, indices = [], []
+  for iN in range(0, N, nBlock):
+    Yb = Y[iN:(iN + nBlock)]
+    best_neg_dist, best_index = None, None
+    for iM in range(0, M, mBlock):
+      Xb = Xr[:, iM:(iM + mBlock)]
+      mb = Xb.shape[1]
+      if r == 2.0:
+        Xbr = tf.reshape(Xb, (-1, d))
+        XY = tf.einsum('ik,jk->ij', Xbr, Yb)
+        X2 = tf.reduce_sum(tf.square(Xbr), 1, keepdims=True)
+        Y2 = tf.expand_dims(tf.reduce_sum(tf.square(Yb), 1), 0)
+        neg_dist = - tf.sqrt(tf.maximum(X2 + Y2 - 2.0 * XY, 0.))
+      elif r == 1.0:
+        XY = tf.reduce_sum(tf.abs(tf.reshape(Xb, (-1, 1, d)) - tf.expand_dims(Yb, 0)), -1)
+        neg_dist = - XY
+      elif r == np.inf:
+        neg_dist = - tf.reduce_max(tf.abs(tf.reshape(Xb, (-1, 1, d)) - tf.expand_dims(Yb, 0)), -1)
+      else:
+        XY = tf.reduce_sum(tf.pow(tf.abs(tf.reshape(Xb, (-1, 1, d)) - tf.expand_dims(Yb, 0)), r), -1)
+        neg_dist = - tf.math.pow(XY, 1/r)
+      neg_dist = tf.transpose(tf.reshape(neg_dist, (-1, mb, Yb.shape[0])), [0, 2, 1])  # [B, nBlock, mBlock]
+      neg_dist, index = tf.math.top_k(neg_dist, tf.minimum(k, mb))
+      index += iM
+      if best_neg_dist is not None:
+        # earlier blocks come first, so ties keep the lower index as in tf_knn
+        neg_dist = tf.concat((best_neg_dist, neg_dist), -1)
+        index = tf.concat((best_index, index), -1)
+        neg_dist, position = tf.math.top_k(neg_dist, tf.minimum(k, neg_dist.shape[-1]))
+        index = tf.gather(index, position, batch_dims=2)
+      best_neg_dist, best_index = neg_dist, index
+    distances.append(best_neg_dist)
+    indices.append(best_index)
+
+  out_shape = tf.concat((tf.shape(X)[:-2], [N, -1]), 0)
+  distance = tf.reshape(tf.concat(distances, 1), out_shape)  # [..., N, k]
+  index = tf.reshape(tf.concat(indices, 1), out_shape)
+  return -distance, index
+
+def tf_scatter_add(indices, updates, M):
+  """Sum updates into M slots, a segment-sum inverse of tf.gather.
+
+  Unlike tf_scatter, duplicated indices are summed and batch shapes may be
+  dynamic.
+
+  Args:
+    indices: Tensor of shape [..., L], with values in [0, M)
+    updates: Tensor of shape [..., L, ...]
+    M: Int or scalar Tensor, number of slots
+
+  Returns:
+    params: Tensor of shape [..., M, ...]
+  """
+  batch_rank = len(indices.shape) - 1
+  batch_shape = tf.shape(indices)[:-1]
+  inner_shape = tf.shape(updates)[batch_rank+1:]
+  B = tf.reduce_prod(batch_shape)
+  segments = tf.reshape(indices, [B, -1]) + tf.expand_dims(tf.range(B) * M, -1)
+  flatten_updates = tf.reshape(updates, tf.concat(([-1], inner_shape), 0))
+  flatten_params = tf.math.unsorted_segment_sum(flatten_updates, tf.reshape(segments, [-1]), B * M)
+  return tf.reshape(flatten_params, tf.concat((batch_shape, [M], inner_shape), 0))
+
+def tf_dtmGradFromKnn(inputs, grid, knnIndex, coefficient, dtmValue, weightBound, r=2.):
+  """TF Gradient of Distance to measure with respect to the k neighbors.
+
+  Args:
+    inputs: Tensor of shape [..., M, d]
+    grid: Tensor of shape [N, d]
+    knnIndex: Tensor of shape [..., N, k]
+    coefficient: Tensor of shape [..., N, k], weight of each neighbor in the DTM sum
+    dtmValue: Tensor of shape [..., N]
+    weightBound: Tensor of shape [] or [..., 1]
+    r: Int r-Norm
+
+  Returns:
+    dtmDiff: Tensor of shape [..., N, k, d], derivative of dtmValue with
+      respect to the neighbors inputs[knnIndex]
+  """
+  Xa = tf.gather(inputs, knnIndex, batch_dims=len(knnIndex.shape)-2)
+  unweightDtmDiff = Xa - tf.expand_dims(grid, 1)  # [..., N, k, d]
+  if r != 2.0:
+    distance = tf.norm(unweightDtmDiff, axis=-1)
+    coefficient *= tf.where(distance > 0, tf.math.pow(tf.maximum(distance, 1e-30), r - 2), 0.)
+  denominator = tf.expand_dims(weightBound * tf.math.pow(dtmValue, r - 1), -1)  # [..., N, 1]
+  return tf.expand_dims(tf.math.divide_no_nan(coefficient, denominator), -1) * unweightDtmDiff
+
+@tracing.traced('landscape_grad')
+def tf_landscape_grad(dy, diffIndex, diffValue, inputs_shape):
+  """Apply the sparse landscape derivative to an upstream gradient.
+
+  Args:
+    dy: Tensor of shape [..., len(dims), len(tseq), len(KK)]
+    diffIndex: Tensor of shape [..., len(dims), len(tseq), len(KK), 2]
+    diffValue: Tensor of shape [..., len(dims), len(tseq), len(KK), 2]
+    inputs_shape: 1-D Tensor, shape [..., N] of the landscape inputs
+
+  Returns:
+    dx: Tensor of shape [..., N]
+  """
+  flat_shape = tf.concat((inputs_shape[:-1], [-1]), 0)
+  updates = tf.reshape(tf.expand_dims(dy, -1) * diffValue, flat_shape)
+  dx = tf_scatter_add(tf.reshape(diffIndex, flat_shape), updates, inputs_shape[-1])
+  return tf.reshape(dx, inputs_shape)
+
+
 def tf_gridBy(lims, by):
   if np.ndim(by) == 0:
     by = np.repeat(by, repeats=len(lims))
@@ -166,13 +312,31 @@ class DTMLayer(tf.keras.layers.Layer):
                lims=[[-1., 1.], [-1., 1.]], 
                by=1, 
                r=2.0, 
+               knn_max_bytes=None,
+               custom_grad=True,
                name='dtmlayer', 
                **kwargs):
+    """.
+
+    Args:
+      knn_max_bytes: if set, neighbors are searched with tf_knn_tiled under
+        this memory cap instead of tf_knn
+      custom_grad: use the sparse gradient of dtm_grad instead of autodiff
+        through the kNN search
+    """
     super(DTMLayer, self).__init__(name=name)
     self.m0 = m0
     self.r = r
+    self.knn_max_bytes = knn_max_bytes
+    self.custom_grad = custom_grad
     self.grid, self.grid_size = tf_gridBy(lims, by)
 
+  def knn(self, inputs, k):
+    if self.knn_max_bytes is None:
+      return tf_knn(inputs, self.grid, k)
+    return tf_knn_tiled(inputs, self.grid, k, max_bytes=self.knn_max_bytes)
+
+  @tracing.traced('dtm')
   def dtm(self, inputs):
     """TF Without Weighted Distance to measure using KNN.
 
@@ -186,9 +350,10 @@ class DTMLayer(tf.keras.layers.Layer):
     """
     weightBound = self.m0 * inputs.shape[-2]
     weightBoundCeil = tf.math.ceil(weightBound)
-    knnDistance, knnIndex = tf_knn(inputs, self.grid, tf.cast(weightBoundCeil, tf.int32))
+    knnDistance, knnIndex = self.knn(inputs, tf.cast(weightBoundCeil, tf.int32))
     return tf_dtmFromKnnDistance(knnDistance, weightBound, self.r), knnIndex, weightBound
 
+  @tracing.traced('dtm_grad')
   def dtm_grad(self, inputs, dtmValue, knnIndex, weightBound):
     """TF Graident of Without Weighted Distance to measure using KNN.
 
@@ -199,35 +364,15 @@ class DTMLayer(tf.keras.layers.Layer):
       weightBound: Tensor of shape []
 
     Returns:
-      dtmDiff: Tensor of shape [..., N, M, d]
+      dtmDiff: Tensor of shape [..., N, k, d], derivative of dtmValue with
+        respect to the neighbors inputs[knnIndex]
     """
     weightBoundCeil = tf.math.ceil(weightBound)
-
-    Xa = tf.gather(inputs, knnIndex, batch_dims=len(knnIndex.shape)-2)
-    dtmDiff = Xa - tf.expand_dims(self.grid, 1)  # [..., N, k, d]
-    dtmLastValue = dtmDiff[..., -1:, :] * (1. + weightBound - weightBoundCeil)
-    sparse_dtmDiff = tf.concat((dtmDiff[..., :-1, :], dtmLastValue), -2)
-
-    dtmDiff = tf_scatter(knnIndex, sparse_dtmDiff, knnIndex.shape[:-1] + inputs.shape[-2:], batch_dims=len(knnIndex.shape)-1)
-    dtmDiff /= (weightBound * tf.reshape(dtmValue, dtmValue.shape + [1, 1]))
-    return dtmDiff
-
-  # @tf.custom_gradient
-  # def call(self, inputs):
-  #   """.
-
-  #   Args:
-  #     inputs: tensor of shape [..., M, d]
-
-  #   Returns:
-  #     outputs: tensor of shape [..., N]
-  #   """
-  #   dtmValue, knnIndex, weightBound = self.dtm(inputs)
-  #   def grad(dy):
-  #     """"dy: [..., N]."""
-  #     dtmDiff = self.dtm_grad(inputs, dtmValue, knnIndex, weightBound)
-  #     return tf.einsum('...i,...ijk->...jk', dy, dtmDiff)
-  #   return dtmValue, grad
+    k = tf.shape(knnIndex)[-1]
+    # every neighbor counts once, the last one only for the fractional part
+    coefficient = 1. - tf.one_hot(k - 1, k, dtype=inputs.dtype) * (weightBoundCeil - weightBound)
+    coefficient = tf.broadcast_to(coefficient, tf.shape(knnIndex))
+    return tf_dtmGradFromKnn(inputs, self.grid, knnIndex, coefficient, dtmValue, weightBound, self.r)
 
   def call(self, inputs, weights=None):
     """.
@@ -238,8 +383,23 @@ class DTMLayer(tf.keras.layers.Layer):
     Returns:
       outputs: tensor of shape [..., N]
     """
-    dtmValue, knnIndex, weightBound = self.dtm(inputs)
-    return dtmValue
+    if not self.custom_grad:
+      dtmValue, knnIndex, weightBound = self.dtm(inputs)
+      return dtmValue
+
+    @tf.custom_gradient
+    def dtm_fn(inputs):
+      dtmValue, knnIndex, weightBound = self.dtm(inputs)
+      def grad(dy):
+        """"dy: [..., N]."""
+        dtmDiff = self.dtm_grad(inputs, dtmValue, knnIndex, weightBound)  # [..., N, k, d]
+        updates = tf.expand_dims(tf.expand_dims(dy, -1), -1) * dtmDiff
+        flat_shape = tf.concat((tf.shape(knnIndex)[:-2], [-1]), 0)
+        return tf_scatter_add(tf.reshape(knnIndex, flat_shape),
+                              tf.reshape(updates, tf.concat((flat_shape, tf.shape(inputs)[-1:]), 0)),
+                              tf.shape(inputs)[-2])
+      return dtmValue, grad
+    return dtm_fn(inputs)
 
 
 
@@ -250,13 +410,31 @@ class DTMWeightLayer(tf.keras.layers.Layer):
                lims=[[-1., 1.], [-1., 1.]], 
                by=1, 
                r=2.0, 
+               knn_max_bytes=None,
+               custom_grad=True,
                name='dtmweightlayer', 
                **kwargs):
+    """.
+
+    Args:
+      knn_max_bytes: if set, neighbors are searched with tf_knn_tiled under
+        this memory cap instead of tf_knn
+      custom_grad: use the sparse gradients of dtm_grad_x and dtm_grad_w
+        instead of autodiff through the kNN search
+    """
     super(DTMWeightLayer, self).__init__(name=name)
     self.m0 = m0
     self.r = r
+    self.knn_max_bytes = knn_max_bytes
+    self.custom_grad = custom_grad
     self.grid, self.grid_size = tf_gridBy(lims, by)
 
+  def knn(self, inputs, k):
+    if self.knn_max_bytes is None:
+      return tf_knn(inputs, self.grid, k)
+    return tf_knn_tiled(inputs, self.grid, k, max_bytes=self.knn_max_bytes)
+
+  @tracing.traced('dtm')
   def dtm(self, inputs, weight):
     """TF Weighted Distance to measure using KNN.
 
@@ -282,94 +460,114 @@ class DTMWeightLayer(tf.keras.layers.Layer):
     #   print("weight:")
     #   print(weight)
 
-    knnDistance, knnIndex = tf_knn(inputs, self.grid, tf.cast(max_index_int, tf.int32))
+    knnDistance, knnIndex = self.knn(inputs, tf.cast(max_index_int, tf.int32))
 
     return tf_dtmFromKnnDistanceWeight(knnDistance, knnIndex, weight, weightBound, self.r), knnIndex, weightBound
 
-  def dtm_grad_x(self, inputs, weight, dtmValue, knnIndex, weightBound):
-    """TF Graident of With Weighted Distance to measure using KNN.
+  def neighbor_distance(self, inputs, knnIndex):
+    """Distance of every grid point to its neighbors inputs[knnIndex], [..., N, k]."""
+    Xa = tf.gather(inputs, knnIndex, batch_dims=len(knnIndex.shape)-2)
+    return tf.norm(Xa - tf.expand_dims(self.grid, 1), axis=-1)
+
+  def dtm_coefficient(self, weight, knnIndex, weightBound):
+    """Weight of each neighbor in the weighted DTM sum.
 
     Args:
-      inputs: Tensor of shape [..., M, d]
       weight: Tensor of shape [..., M]
-      dtmValue: Tensor of shape [..., N]
       knnIndex: Tensor of shape [..., N, k]
       weightBound: Tensor of shape [..., 1]
 
     Returns:
-      dtmDiff: Tensor of shape [..., N, M, d]
-      index_int: Tensor of shape [..., N, 1]
-      mask: Tensor of shape [..., N, k-1]
+      coefficient: Tensor of shape [..., N, k]
+      mask: Tensor of shape [..., N, k], 1 for the neighbors before index_int
+      last: Tensor of shape [..., N, k], one hot of index_int, the neighbor
+        where the weights reach weightBound
     """
     weightBound = tf.expand_dims(weightBound, -1) # [..., 1, 1]
     weightTemp = tf.gather(weight, knnIndex, batch_dims=len(weight.shape)-1)  # [..., N, k]
     weightSumTemp = tf.math.cumsum(weightTemp, -1)
     index_int = tf.searchsorted(weightSumTemp, tf.repeat(weightBound, knnIndex.shape[-2], -2))  # [..., N, 1]
-    mask = tf.sequence_mask(tf.squeeze(index_int, -1), dtype=tf.float32)  # [..., N, k]
-
-    weightBound = tf.expand_dims(weightBound, -1)  # [..., 1, 1, 1]
-    weightSumTemp = tf.expand_dims(weightSumTemp, -1)  # [..., N, k, 1] 
-    Xa = tf.gather(inputs, knnIndex, batch_dims=len(knnIndex.shape)-2)
-    unweightDtmDiff = (Xa - tf.expand_dims(self.grid, 1))  # [..., N, k, d]
-    dtmDiff = tf.expand_dims(weightTemp, -1) * unweightDtmDiff
-    dtmLastValue = tf.gather(dtmDiff + unweightDtmDiff * (weightBound - weightSumTemp), index_int, batch_dims=len(knnIndex.shape)-1)
-    mask_dtmDiff = dtmDiff[..., :-1, :] * tf.expand_dims(mask, -1)
-    sparse_dtmDiff = tf.concat((mask_dtmDiff, dtmLastValue), -2)
+    k = tf.shape(knnIndex)[-1]
+    mask = tf.sequence_mask(tf.squeeze(index_int, -1), k, dtype=weight.dtype)  # [..., N, k]
+    last = tf.one_hot(tf.squeeze(index_int, -1), k, dtype=weight.dtype)  # [..., N, k]
+    coefficient = mask * weightTemp + last * (weightBound - weightSumTemp + weightTemp)
+    return coefficient, mask, last
+
+  @tracing.traced('dtm_grad')
+  def dtm_grad_x(self, inputs, weight, dtmValue, knnIndex, weightBound, coefficients=None):
+    """TF Graident of With Weighted Distance to measure using KNN.
 
-    knnLastIndex = tf.gather(knnIndex, index_int, batch_dims=len(knnIndex.shape)-1)
-    sparse_knnIndex = tf.concat((knnIndex[..., :-1], knnLastIndex), -1)
+    Args:
+      inputs: Tensor of shape [..., M, d]
+      weight: Tensor of shape [..., M]
+      dtmValue: Tensor of shape [..., N]
+      knnIndex: Tensor of shape [..., N, k]
+      weightBound: Tensor of shape [..., 1]
+      coefficients: optional output of dtm_coefficient, to share it with dtm_grad_w
 
-    dtmDiff = tf_scatter(sparse_knnIndex, sparse_dtmDiff, knnIndex.shape[:-1] + inputs.shape[-2:], batch_dims=len(knnIndex.shape)-1)
-    dtmDiff /= (weightBound * tf.reshape(dtmValue, dtmValue.shape + [1, 1]))
-    return dtmDiff, index_int, mask
+    Returns:
+      dtmDiff: Tensor of shape [..., N, k, d], derivative of dtmValue with
+        respect to the neighbors inputs[knnIndex]
+    """
+    coefficient, _, _ = coefficients or self.dtm_coefficient(weight, knnIndex, weightBound)
+    return tf_dtmGradFromKnn(inputs, self.grid, knnIndex, coefficient, dtmValue, weightBound, self.r)
 
-  def dtm_grad_w(self, inputs, dtmValue, knnIndex, weightBound, index_int, mask):
+  @tracing.traced('dtm_grad')
+  def dtm_grad_w(self, inputs, weight, dtmValue, knnIndex, weightBound, coefficients=None):
     """TF Graident of With Weighted Distance to measure using KNN.
 
     Args:
       inputs: Tensor of shape [..., M, d]
+      weight: Tensor of shape [..., M]
       dtmValue: Tensor of shape [..., N]
       knnIndex: Tensor of shape [..., N, k]
       weightBound: Tensor of shape [..., 1]
-      index_int: Tensor of shape [..., N, 1]
-      mask: Tensor of shape [..., N, k-1]
+      coefficients: optional output of dtm_coefficient, to share it with dtm_grad_x
 
     Returns:
-      dtmDiff: Tensor of shape [..., N, M]
+      dtmDiff: Tensor of shape [..., N, k], derivative of dtmValue with
+        respect to the neighbor weights weight[knnIndex]
+      dtmDiffAll: Tensor of shape [..., N, 1], derivative of dtmValue with
+        respect to every weight, through weightBound
     """
-    Xa = tf.gather(inputs, knnIndex, batch_dims=len(knnIndex.shape)-2)
-    unweightDtmDiff = tf.square(Xa - tf.expand_dims(self.grid, 1))  # [..., N, k, d]
-    unweightDtmDiff = tf.reduce_sum(unweightDtmDiff, -1)  # [..., N, k]
-
-    # dtmDiff: [..., N, k]
-    last_dtmDiff = tf.gather(unweightDtmDiff, index_int, batch_dims=len(knnIndex.shape)-1)  # [..., N, 1]
-    mask_dtmDiff = (unweightDtmDiff[..., :-1] - last_dtmDiff)* mask  # [..., N, k-1]
-    dtmDiff = tf_scatter(knnIndex[..., :-1], mask_dtmDiff, knnIndex.shape[:-1] + inputs.shape[-2:-1], batch_dims=len(knnIndex.shape)-1)
+    _, mask, last = coefficients or self.dtm_coefficient(weight, knnIndex, weightBound)
+    unweightDtmDiff = tf.math.pow(self.neighbor_distance(inputs, knnIndex), self.r)  # [..., N, k]
+    last_dtmDiff = tf.reduce_sum(unweightDtmDiff * last, -1, keepdims=True)  # [..., N, 1]
 
-    # dtmDiff: [..., N, M]
     dtmValue = tf.expand_dims(dtmValue, -1)  # [..., N, 1]
     weightBound = tf.expand_dims(weightBound, -1)  # [..., 1, 1]
-    dtmDiff = (dtmDiff + self.m0 * last_dtmDiff - self.m0 * tf.square(dtmValue)) / (2 * weightBound * dtmValue)
-    return dtmDiff
-
-  # @tf.custom_gradient
-  # def call(self, inputs, weight):
-  #   """.
-
-  #   Args:
-  #     inputs: tensor of shape [..., M, d]
-  #     weight: tensor of shape [..., M]
-
-  #   Returns:
-  #     outputs: tensor of shape [..., N]
-  #   """
-  #   dtmValue, knnIndex, weightBound = self.dtm(inputs, weight)
-  #   def grad(dy):
-  #     """"dy: [..., N]."""
-  #     dtmDiff_x, index_int, mask = self.dtm_grad_x(inputs, weight, dtmValue, knnIndex, weightBound)
-  #     dtmDiff_w = self.dtm_grad_w(inputs, dtmValue, knnIndex, weightBound, index_int, mask)
-  #     return tf.einsum('...i,...ijk->...jk', dy, dtmDiff_x), tf.einsum('...i,...ij->...j', dy, dtmDiff_w)
-  #   return dtmValue, grad
+    denominator = self.r * weightBound * tf.math.pow(dtmValue, self.r - 1)
+    dtmDiff = tf.math.divide_no_nan((unweightDtmDiff - last_dtmDiff) * mask, denominator)
+    dtmDiffAll = tf.math.divide_no_nan(self.m0 * (last_dtmDiff - tf.math.pow(dtmValue, self.r)), denominator)
+    return dtmDiff, dtmDiffAll
+
+  def dtm_fn(self, inputs, weight, dtm):
+    """Wrap dtm(inputs, weight) with the sparse custom gradient."""
+
+    @tf.custom_gradient
+    def dtm_fn(inputs, weight):
+      dtmValue, knnIndex, weightBound = dtm(inputs, weight)
+      def grad(dy):
+        """"dy: [..., N]."""
+        flat_shape = tf.concat((tf.shape(knnIndex)[:-2], [-1]), 0)
+        flat_knnIndex = tf.reshape(knnIndex, flat_shape)
+        coefficients = self.dtm_coefficient(weight, knnIndex, weightBound)
+        dtmDiff_x = self.dtm_grad_x(inputs, weight, dtmValue, knnIndex, weightBound, coefficients)  # [..., N, k, d]
+        updates_x = tf.expand_dims(tf.expand_dims(dy, -1), -1) * dtmDiff_x
+        grad_x = tf_scatter_add(flat_knnIndex, tf.reshape(updates_x, tf.concat((flat_shape, tf.shape(inputs)[-1:]), 0)),
+                                tf.shape(inputs)[-2])
+        grad_w = self.weight_grad(dy, inputs, weight, dtmValue, knnIndex, weightBound, coefficients)
+        return grad_x, grad_w
+      return dtmValue, grad
+    return dtm_fn(inputs, weight)
+
+  def weight_grad(self, dy, inputs, weight, dtmValue, knnIndex, weightBound, coefficients):
+    """Upstream gradient dy [..., N] of the DTM pulled back to the weights [..., M]."""
+    flat_shape = tf.concat((tf.shape(knnIndex)[:-2], [-1]), 0)
+    dtmDiff_w, dtmDiffAll_w = self.dtm_grad_w(inputs, weight, dtmValue, knnIndex, weightBound, coefficients)
+    grad_w = tf_scatter_add(tf.reshape(knnIndex, flat_shape), tf.reshape(tf.expand_dims(dy, -1) * dtmDiff_w, flat_shape),
+                            tf.shape(weight)[-1])
+    return grad_w + tf.reduce_sum(tf.expand_dims(dy, -1) * dtmDiffAll_w, -2)  # [..., 1]
 
   def call(self, inputs, weight):
     """.
@@ -381,11 +579,126 @@ class DTMWeightLayer(tf.keras.layers.Layer):
     Returns:
       outputs: tensor of shape [..., N]
     """
+    if self.custom_grad:
+      return self.dtm_fn(inputs, weight, self.dtm)
     dtmValue, knnIndex, weightBound = self.dtm(inputs, weight)
     return dtmValue
 
 
 
+class GridDTMWeightLayer(DTMWeightLayer):
+  """DTMWeightLayer for weights given on the layer's own grid.
+
+  When the points are the grid itself, as for images, the neighbors of
+  every grid point do not depend on the weights. They are sorted once at
+  construction into a [N, max_neighbors] table, and each batch only
+  gathers its weights along that table. The grid and the table are
+  constants, the custom gradient is only taken with respect to the weights.
+  """
+
+  def __init__(self, 
+               m0=0.3,
+               lims=[[-1., 1.], [-1., 1.]], 
+               by=1, 
+               r=2.0, 
+               max_neighbors=None,
+               max_table_bytes=64 * 2**20,
+               name='griddtmweightlayer', 
+               **kwargs):
+    """.
+
+    Args:
+      max_neighbors: width of the neighbor table. A batch needs as many
+        neighbors as its largest index_int: ceil(m0 * N) for uniform
+        weights, more when the weight is concentrated, up to the whole grid
+        for mostly zero images, whose zero weights sort first. Batches
+        needing more fall back to the kNN search. Defaults to N, i.e. never
+        falling back, as long as the table fits in max_table_bytes
+      max_table_bytes: Int memory cap of the default table, which holds
+        N * max_neighbors distances and indices, 8 bytes each: 784 * 784 for
+        a 28x28 grid is about 5 MB, the 64 MB default keeps the whole table
+        up to about 2900 grid points
+    """
+    super(GridDTMWeightLayer, self).__init__(m0=m0, lims=lims, by=by, r=r, name=name, **kwargs)
+    nGrid = self.grid.shape[0]
+    if max_neighbors is None:
+      max_neighbors = max_table_bytes // (8 * nGrid)
+    self.max_neighbors = max(1, min(max_neighbors, nGrid))
+    self.gridDistance, self.gridIndex = self.knn(self.grid, self.max_neighbors)  # [N, max_neighbors]
+
+  @tracing.traced('dtm')
+  def dtm_grid(self, weight):
+    """TF Weighted Distance to measure of the grid using the neighbor table.
+
+    Args:
+      weight: Tensor of shape [..., M]
+
+    Returns:
+      dtmValue: Tensor of shape [..., N]
+      knnIndex: Tensor of shape [..., N, k]
+      weightBound: Tensor of shape [..., 1]
+    """
+    weightsort = tf.sort(weight)  # [..., M]
+    weightBound = self.m0 * tf.reduce_sum(weight, -1, keepdims=True)  # [..., 1]
+    weightSumTemp = tf.math.cumsum(weightsort, -1)  # [..., M]
+    index_int = tf.searchsorted(weightSumTemp, weightBound) # [..., 1]
+    max_index_int = tf.cast(tf.reduce_max(index_int) + 1, tf.int32)
+
+    def from_table():
+      knn_shape = tf.concat((tf.shape(weight)[:-1], [self.grid.shape[0], max_index_int]), 0)
+      knnDistance = tf.broadcast_to(self.gridDistance[:, :max_index_int], knn_shape)
+      knnIndex = tf.broadcast_to(self.gridIndex[:, :max_index_int], knn_shape)
+      return tf_dtmFromKnnDistanceWeight(knnDistance, knnIndex, weight, weightBound, self.r), knnIndex
+
+    def from_knn():
+      X = tf.broadcast_to(self.grid, tf.concat((tf.shape(weight), self.grid.shape[-1:]), 0))
+      knnDistance, knnIndex = self.knn(X, max_index_int)
+      return tf_dtmFromKnnDistanceWeight(knnDistance, knnIndex, weight, weightBound, self.r), knnIndex
+
+    if self.max_neighbors == self.grid.shape[0]:
+      dtmValue, knnIndex = from_table()
+    else:
+      dtmValue, knnIndex = tf.cond(max_index_int <= self.max_neighbors, from_table, from_knn)
+    return dtmValue, knnIndex, weightBound
+
+  def neighbor_distance(self, inputs, knnIndex):
+    """Distance of every grid point to its neighbors, from the table when it is wide enough."""
+    k = tf.shape(knnIndex)[-1]
+    from_table = lambda: tf.broadcast_to(self.gridDistance[:, :k], tf.shape(knnIndex))
+    from_grid = lambda: tf.norm(tf.gather(self.grid, knnIndex) - tf.expand_dims(self.grid, 1), axis=-1)
+    if self.max_neighbors == self.grid.shape[0]:
+      return from_table()
+    return tf.cond(k <= self.max_neighbors, from_table, from_grid)
+
+  def dtm_grid_fn(self, weight):
+    """Wrap dtm_grid(weight) with the sparse custom gradient of the weights."""
+
+    @tf.custom_gradient
+    def dtm_fn(weight):
+      dtmValue, knnIndex, weightBound = self.dtm_grid(weight)
+      def grad(dy):
+        """"dy: [..., N]."""
+        coefficients = self.dtm_coefficient(weight, knnIndex, weightBound)
+        return self.weight_grad(dy, None, weight, dtmValue, knnIndex, weightBound, coefficients)
+      return dtmValue, grad
+    return dtm_fn(weight)
+
+  def call(self, weight):
+    """.
+
+    Args:
+      weight: tensor of shape [..., M], weights of the grid points
+
+    Returns:
+      outputs: tensor of shape [..., N]
+    """
+    if self.custom_grad:
+      return self.dtm_grid_fn(weight)
+    dtmValue, knnIndex, weightBound = self.dtm_grid(weight)
+    return dtmValue
+
+
+
 class PersistenceLandscapeLayer(tf.keras.layers.Layer):
 
   def __init__(self, 
@@ -394,14 +707,28 @@ class PersistenceLandscapeLayer(tf.keras.layers.Layer):
                grid_size=[3, 3],
                dimensions=[0, 1], 
                dtype='float32',
+               backend='thread',
+               n_workers=None,
+               cache=None,
                name='persistencelandscapelayer', 
                **kwargs):
+    """.
+
+    Args:
+      backend: 'map_fn' to enter python once per sample, or 'serial',
+        'thread', 'process' to hand the whole batch to a PersistencePool
+      n_workers: number of pool workers, defaults to the number of cpus
+      cache: optional PersistenceCache reusing results of filtrations seen before
+    """
     super(PersistenceLandscapeLayer, self).__init__(name=name)
     self.dtype == dtype
     self.tseq = np.array(tseq, dtype=dtype)
     self.KK = np.array(KK, dtype=np.int32)
     self.grid_size = grid_size
     self.dimensions = dimensions
+    self.backend = backend
+    self.n_workers = n_workers
+    self.cache = cache
 
   def python_op_diag_landscape(self, fun_value):
     """Python domain function to compute landscape.
@@ -413,86 +740,33 @@ class PersistenceLandscapeLayer(tf.keras.layers.Layer):
 
     Returns:
       land: numpy array of shape [len(dims), len(tseq), len(KK)]
-      diff: numpy array of shape [N, len(dims), len(tseq), len(KK)]
-    """
-    # Use gudhi to compute persistence diagram
-    # print('fun_value', fun_value.shape, repr(fun_value))
-    cubCpx = gudhi.CubicalComplex(dimensions=self.grid_size, top_dimensional_cells=fun_value)
-    pDiag = cubCpx.persistence(homology_coeff_field=2, min_persistence=0)
-    # print('pDiag', pDiag)
-    location = cubCpx.cofaces_of_persistence_pairs()
-    if location[0]:
-      locationVstack = [np.vstack(location[0]), np.vstack(location[1])]
-    else:
-      locationVstack = [np.zeros((0, 2), dtype=np.int32), np.vstack(location[1])]
-    locationBirth = np.concatenate((locationVstack[0][:, 0], locationVstack[1][:, 0])).astype(np.int32)
-    # locationBirth = np.concatenate((np.vstack(location[0])[:, 0], 
-    #                                 np.vstack(location[1])[:, 0])).astype(np.int32)
-    locationDeath = locationVstack[0][:, 1].astype(np.int32)
-
-    # lengths
-    len_dim = len(self.dimensions)
-    len_tseq = len(self.tseq)
-    len_KK = len(self.KK)
-    len_pDiag = len(pDiag)
-
-    land = np.zeros((len_dim, len_tseq, len_KK), dtype=self.dtype)
-    landDiffBirth = np.zeros((len_dim, len_tseq, len_KK, len_pDiag), dtype=self.dtype)
-    landDiffDeath = np.zeros((len_dim, len_tseq, len_KK, len_pDiag), dtype=self.dtype)
-
-    for iDim, dim in enumerate(self.dimensions):
-      # select 0 dimension feature
-      pDiagDim = [pair for pair in pDiag if pair[0] == dim]
-      pDiagDimIds = np.array([iDiag for iDiag, pair in enumerate(pDiag) if pair[0] == dim], dtype=np.int32)
-
-      # local lengths
-      len_pDiagDim = len(pDiagDim)
-
-      # Arrange it
-      # print(len_pDiag, len_pDiagDim, len_tseq, len_KK)
-      fab = np.zeros((len_tseq, max(len_pDiagDim, np.max(self.KK)+1)), dtype=self.dtype)
-      for iDiagDim in range(len_pDiagDim):
-        for iT in range(len_tseq):
-          fab[iT, iDiagDim] = max(min(self.tseq[iT] - pDiagDim[iDiagDim][1][0], pDiagDim[iDiagDim][1][1] - self.tseq[iT]), 0)
-
-      # return
-      land[iDim] = -np.sort(-fab, axis=-1)[:, self.KK]
-      landIndex = np.argsort(-fab, axis = -1)[:, self.KK]
-
-      fabDiffBirth = np.zeros((len_tseq, len_pDiagDim), dtype=self.dtype)
-      for iDiagDim in range(len_pDiagDim):
-          fabDiffBirth[:, iDiagDim] = np.where((self.tseq > pDiagDim[iDiagDim][1][0]) & (2 * self.tseq < pDiagDim[iDiagDim][1][0] + pDiagDim[iDiagDim][1][1]), -1., 0.)
-      fabDiffDeath = np.zeros((len_tseq, len_pDiagDim), dtype=self.dtype)
-      for iDiagDim in range(len_pDiagDim):
-          fabDiffDeath[:, iDiagDim] = np.where((self.tseq < pDiagDim[iDiagDim][1][1]) & (2 * self.tseq > pDiagDim[iDiagDim][1][0] + pDiagDim[iDiagDim][1][1]), 1., 0.)
-
-      for iDiagDim in range(len_pDiagDim):
-          landDiffBirth[iDim, :, :, pDiagDimIds[iDiagDim]] = np.where(iDiagDim == landIndex, np.repeat(np.expand_dims(fabDiffBirth[:, iDiagDim], -1), len_KK, -1), 0)
-      for iDiagDim in range(len_pDiagDim):
-          landDiffDeath[iDim, :, :, pDiagDimIds[iDiagDim]] = np.where(iDiagDim == landIndex, np.repeat(np.expand_dims(fabDiffDeath[:, iDiagDim], -1), len_KK, -1), 0)
-
-    DiagFUNDiffBirth = np.zeros((len_pDiag, len(fun_value)), dtype=self.dtype)
-    for iBirth in range(len(locationBirth)):
-        DiagFUNDiffBirth[iBirth, locationBirth[iBirth]] = 1
-    DiagFUNDiffDeath = np.zeros((len_pDiag, len(fun_value)), dtype=self.dtype)
-    for iDeath in range(len(locationDeath)):
-        DiagFUNDiffDeath[iDeath, locationDeath[iDeath]] = 1	
-
-    if location[0]:
-      dimension = np.concatenate((np.hstack([np.repeat(ldim, len(location[0][ldim])) for ldim in range(len(location[0]))]),
-                                  np.hstack([np.repeat(ldim, len(location[1][ldim])) for ldim in range(len(location[1]))])))
-    else:
-      dimension = np.hstack([np.repeat(ldim, len(location[1][ldim])) for ldim in range(len(location[1]))])
-    if len(locationDeath) > 0:
-      persistence = np.concatenate((fun_value[locationDeath], np.repeat(np.infty, len(np.vstack(location[1]))))) - fun_value[locationBirth]
-    else:
-      persistence = np.repeat(np.infty, len(np.vstack(location[1])))
-    order = np.lexsort((-persistence, -dimension))
-    
-    diff = np.dot(landDiffBirth, DiagFUNDiffBirth[order, :]) + np.dot(landDiffDeath, DiagFUNDiffDeath[order, :])
-    # print(landDiffBirth.dtype, DiagFUNDiffBirth.dtype, landDiffDeath.dtype, DiagFUNDiffDeath.dtype)
-    # print(land.shape, landDiffBirth.shape, DiagFUNDiffBirth[order, :].shape, landDiffDeath.shape, DiagFUNDiffDeath[order, :].shape, diff.shape)
-    return land, diff
+      diffIndex: numpy array of shape [len(dims), len(tseq), len(KK), 2],
+        birth and death cell of the pair attaining each landscape value
+      diffValue: numpy array of shape [len(dims), len(tseq), len(KK), 2],
+        derivative of each landscape value at those cells
+    """
+    return cached_op(self.cache, np_landscape_op, fun_value, grid_size=list(self.grid_size), tseq=self.tseq,
+                     KK=self.KK, dimensions=list(self.dimensions), dtype=self.dtype)
+
+  def python_op_diag_landscape_batch(self, fun_values):
+    """Python domain function to compute landscapes of a whole batch.
+
+    Args:
+      fun_values: numpy array of shape [B, N]
+
+    Returns:
+      land: numpy array of shape [B, len(dims), len(tseq), len(KK)]
+      diffIndex: numpy array of shape [B, len(dims), len(tseq), len(KK), 2]
+      diffValue: numpy array of shape [B, len(dims), len(tseq), len(KK), 2]
+    """
+    land_shape = (len(self.dimensions), len(self.tseq), len(self.KK))
+    # keras wraps list attributes into tracked lists, pass plain ones to the pool
+    pool = get_persistence_pool(self.backend, self.n_workers)
+    land, diffIndex, diffValue = pool.run(
+        np_landscape_op, fun_values,
+        [(land_shape, self.dtype), (land_shape + (2,), np.int32), (land_shape + (2,), self.dtype)], cache=self.cache,
+        grid_size=list(self.grid_size), tseq=self.tseq, KK=self.KK, dimensions=list(self.dimensions), dtype=self.dtype)
+    return land, diffIndex, diffValue
 
   @tf.custom_gradient
   def call(self, inputs):
@@ -502,26 +776,102 @@ class PersistenceLandscapeLayer(tf.keras.layers.Layer):
       inputs: tensor of shape [..., N]
 
     Returns:
-      outputs: tensor of shape [..., len(tseq), len(KK)]
-    """
-    land, dLdf = tf.map_fn(
-        lambda x: tf.compat.v1.py_func(self.python_op_diag_landscape, 
-                                       [x], [tf.float32, tf.float32], stateful=False), 
-                     inputs, [tf.float32, tf.float32], parallel_iterations=10, back_prop=False)
-    # aa = [tf.compat.v1.py_func(self.python_op_diag_landscape, 
-    #                                    [x], [tf.float32, tf.float32], stateful=False) for x in tf.unstack(inputs)]
-    # land, dLdf = zip(*aa)
-    # land = tf.stack(land)
-    # dLdf = tf.stack(dLdf)
-    # land, dLdf = tf.vectorized_map(lambda x: tf.compat.v1.py_func(self.python_op_diag_landscape, 
-    #                                    [x], [tf.float32, tf.float32], stateful=False), 
-    #                  inputs,)
-    land.set_shape(inputs.shape[:-1] + [len(self.dimensions), len(self.tseq), len(self.KK)])
-    dLdf.set_shape(inputs.shape[:-1] + [len(self.dimensions), len(self.tseq), len(self.KK)] + inputs.shape[-1:])
+      outputs: tensor of shape [..., len(dims), len(tseq), len(KK)]
+    """
+    land_shape = [len(self.dimensions), len(self.tseq), len(self.KK)]
+    if self.backend == 'map_fn':
+      land, diffIndex, diffValue = tf.map_fn(
+          lambda x: tf.compat.v1.py_func(self.python_op_diag_landscape, 
+                                         [x], [tf.float32, tf.int32, tf.float32], stateful=False), 
+                       inputs, [tf.float32, tf.int32, tf.float32], parallel_iterations=10, back_prop=False)
+    else:
+      land, diffIndex, diffValue = tf.compat.v1.py_func(
+          self.python_op_diag_landscape_batch, [tf.reshape(inputs, [-1, inputs.shape[-1]])],
+          [tf.float32, tf.int32, tf.float32], stateful=False)
+      batch_shape = tf.shape(inputs)[:-1]
+      land = tf.reshape(land, tf.concat((batch_shape, land_shape), 0))
+      diffIndex = tf.reshape(diffIndex, tf.concat((batch_shape, land_shape + [2]), 0))
+      diffValue = tf.reshape(diffValue, tf.concat((batch_shape, land_shape + [2]), 0))
+    land.set_shape(inputs.shape[:-1] + land_shape)
+    diffIndex.set_shape(inputs.shape[:-1] + land_shape + [2])
+    diffValue.set_shape(inputs.shape[:-1] + land_shape + [2])
     def grad(dy):
-      return tf.einsum('...ijk,...ijkl->...l', dy, dLdf)
+      return tf_landscape_grad(dy, diffIndex, diffValue, tf.shape(inputs))
     return land, grad
 
+  def python_op_diag_topo(self, fun_value, nmax_diag):
+    """Python domain function to compute diagram and landscape together.
+
+    Args:
+      fun_value: numpy array of shape [N]
+      nmax_diag: number of diagram pairs kept per dimension
+
+    Returns:
+      diag: numpy array of shape [len(dims), nmax_diag, 2]
+      land, diffIndex, diffValue: as python_op_diag_landscape
+    """
+    return cached_op(self.cache, np_topo_op, fun_value, grid_size=list(self.grid_size), tseq=self.tseq,
+                     KK=self.KK, dimensions=list(self.dimensions), nmax_diag=nmax_diag, dtype=self.dtype)
+
+  def python_op_diag_topo_batch(self, fun_values, nmax_diag):
+    """Python domain function to compute diagrams and landscapes of a whole batch."""
+    land_shape = (len(self.dimensions), len(self.tseq), len(self.KK))
+    pool = get_persistence_pool(self.backend, self.n_workers)
+    return tuple(pool.run(
+        np_topo_op, fun_values,
+        [((len(self.dimensions), nmax_diag, 2), self.dtype), (land_shape, self.dtype),
+         (land_shape + (2,), np.int32), (land_shape + (2,), self.dtype)], cache=self.cache,
+        grid_size=list(self.grid_size), tseq=self.tseq, KK=self.KK, dimensions=list(self.dimensions),
+        nmax_diag=nmax_diag, dtype=self.dtype))
+
+  def diagram_landscape(self, inputs, nmax_diag=100, return_grad=False):
+    """Diagram and landscape of inputs from a single persistence computation.
+
+    Args:
+      inputs: tensor of shape [..., N]
+      nmax_diag: number of diagram pairs kept per dimension
+      return_grad: also return the sparse derivative of the landscape
+
+    Returns:
+      diag: tensor of shape [..., len(dims), nmax_diag, 2]
+      land: tensor of shape [..., len(dims), len(tseq), len(KK)], with the
+        same gradient as call
+      diffIndex, diffValue: when return_grad, tensors of shape
+        [..., len(dims), len(tseq), len(KK), 2], the cells each landscape
+        value depends on and its derivative at those cells
+    """
+    land_shape = [len(self.dimensions), len(self.tseq), len(self.KK)]
+    diag_shape = [len(self.dimensions), nmax_diag, 2]
+    Tout = [tf.float32, tf.float32, tf.int32, tf.float32]
+    if self.backend == 'map_fn':
+      diag, land, diffIndex, diffValue = tf.map_fn(
+          lambda x: tf.compat.v1.py_func(lambda fun_value: self.python_op_diag_topo(fun_value, nmax_diag),
+                                         [x], Tout, stateful=False),
+                       inputs, Tout, parallel_iterations=10, back_prop=False)
+    else:
+      diag, land, diffIndex, diffValue = tf.compat.v1.py_func(
+          lambda fun_values: self.python_op_diag_topo_batch(fun_values, nmax_diag),
+          [tf.reshape(inputs, [-1, inputs.shape[-1]])], Tout, stateful=False)
+      batch_shape = tf.shape(inputs)[:-1]
+      diag = tf.reshape(diag, tf.concat((batch_shape, diag_shape), 0))
+      land = tf.reshape(land, tf.concat((batch_shape, land_shape), 0))
+      diffIndex = tf.reshape(diffIndex, tf.concat((batch_shape, land_shape + [2]), 0))
+      diffValue = tf.reshape(diffValue, tf.concat((batch_shape, land_shape + [2]), 0))
+    diag.set_shape(inputs.shape[:-1] + diag_shape)
+    land.set_shape(inputs.shape[:-1] + land_shape)
+    diffIndex.set_shape(inputs.shape[:-1] + land_shape + [2])
+    diffValue.set_shape(inputs.shape[:-1] + land_shape + [2])
+
+    @tf.custom_gradient
+    def landscape(inputs):
+      def grad(dy):
+        return tf_landscape_grad(dy, diffIndex, diffValue, tf.shape(inputs))
+      return tf.identity(land), grad
+    land = landscape(inputs)
+    if return_grad:
+      return diag, land, diffIndex, diffValue
+    return diag, land
+
 
 
 class PersistenceDiagramLayer(tf.keras.layers.Layer):
@@ -531,43 +881,51 @@ class PersistenceDiagramLayer(tf.keras.layers.Layer):
                dimensions=[0, 1], 
                nmax_diag=100,
                dtype='float32',
+               backend='thread',
+               n_workers=None,
+               cache=None,
                name='persistencediagramlayer', 
                **kwargs):
+    """.
+
+    Args:
+      backend: 'map_fn' to enter python once per sample, or 'serial',
+        'thread', 'process' to hand the whole batch to a PersistencePool
+      n_workers: number of pool workers, defaults to the number of cpus
+      cache: optional PersistenceCache reusing results of filtrations seen before
+    """
     super(PersistenceDiagramLayer, self).__init__(name=name)
     self.dtype == dtype
     self.grid_size = grid_size
     self.dimensions = dimensions
     self.nmax_diag = nmax_diag
+    self.backend = backend
+    self.n_workers = n_workers
+    self.cache = cache
   def python_op_diag(self, fun_value):
-    """Python domain function to compute landscape.
+    """Python domain function to compute persistence diagram.
     
-    It also computes things needed for gradient, as we don't want to enter
-    python multiple times.
     Args:
       FUNvalue: numpy array of shape [N]
 
     Returns:
+      diag: numpy array of shape [len(dims), nmax_diag, 2]
     """
-    # Use gudhi to compute persistence diagram
-    # print('fun_value', fun_value.shape, repr(fun_value))
+    return cached_op(self.cache, np_diagram_op, fun_value, grid_size=list(self.grid_size),
+                     dimensions=list(self.dimensions), nmax_diag=self.nmax_diag)
 
-    cubCpx = gudhi.CubicalComplex(dimensions=self.grid_size, top_dimensional_cells=fun_value)
-    pDiag = cubCpx.persistence(homology_coeff_field=2, min_persistence=0)
+  def python_op_diag_batch(self, fun_values):
+    """Python domain function to compute persistence diagrams of a whole batch.
 
-    pDiagList = [None] * len(self.dimensions)
-    for iDim, dim in enumerate(self.dimensions):
-      # select 0 dimension feature
-      pDiagDim = [pair[1] for pair in pDiag if pair[0] == dim]
-      pDiagList[iDim] = pDiagDim
-    
-    diag = np.zeros((len(self.dimensions), self.nmax_diag, 2), dtype='float32')
-    for iDim in range(len(self.dimensions)):
-      nDimDiag = min(len(pDiagList[iDim]), self.nmax_diag)
-      if (nDimDiag > 0):
-        diag[iDim][0:nDimDiag] = pDiagList[iDim][0:nDimDiag]
-
-    # return pDiagList
-    # return np.pad(pDiagList[0], ((0, 30-len(pDiagList[0])), (0, 0))).astype('float32'), np.pad(pDiagList[1], ((0, 30-len(pDiagList[0])), (0, 0))).astype('float32')
+    Args:
+      fun_values: numpy array of shape [B, N]
+
+    Returns:
+      diag: numpy array of shape [B, len(dims), nmax_diag, 2]
+    """
+    pool = get_persistence_pool(self.backend, self.n_workers)
+    diag, = pool.run(np_diagram_op, fun_values, [((len(self.dimensions), self.nmax_diag, 2), np.float32)],
+                     cache=self.cache, grid_size=list(self.grid_size), dimensions=list(self.dimensions), nmax_diag=self.nmax_diag)
     return diag
 
 
@@ -578,32 +936,77 @@ class PersistenceDiagramLayer(tf.keras.layers.Layer):
       inputs: tensor of shape [..., N]
 
     Returns:
-      outputs: tensor of shape [..., len(tseq), len(KK)]
-    """
-    diag = tf.map_fn(
-        lambda x: tf.compat.v1.py_func(self.python_op_diag, 
-                                       [x], tf.float32, stateful=False), 
-                     inputs, tf.float32, parallel_iterations=10, back_prop=False)
-    # aa = [tf.compat.v1.py_func(self.python_op_diag_landscape, 
-    #                                    [x], [tf.float32, tf.float32], stateful=False) for x in tf.unstack(inputs)]
-    # land, dLdf = zip(*aa)
-    # land = tf.stack(land)
-    # dLdf = tf.stack(dLdf)
-    # land, dLdf = tf.vectorized_map(lambda x: tf.compat.v1.py_func(self.python_op_diag_landscape, 
-    #                                    [x], [tf.float32, tf.float32], stateful=False), 
-    #                  inputs,)
-    # land.set_shape(inputs.shape[:-1] + [len(self.dimensions), len(self.tseq), len(self.KK)])
-    # dLdf.set_shape(inputs.shape[:-1] + [len(self.dimensions), len(self.tseq), len(self.KK)] + inputs.shape[-1:])
+      outputs: tensor of shape [..., len(dims), nmax_diag, 2]
+    """
+    if self.backend == 'map_fn':
+      diag = tf.map_fn(
+          lambda x: tf.compat.v1.py_func(self.python_op_diag, 
+                                         [x], tf.float32, stateful=False), 
+                       inputs, tf.float32, parallel_iterations=10, back_prop=False)
+    else:
+      diag = tf.compat.v1.py_func(self.python_op_diag_batch, [tf.reshape(inputs, [-1, inputs.shape[-1]])],
+                                  tf.float32, stateful=False)
+      diag = tf.reshape(diag, tf.concat((tf.shape(inputs)[:-1], [len(self.dimensions), self.nmax_diag, 2]), 0))
     diag.set_shape(inputs.shape[:-1] + [len(self.dimensions), self.nmax_diag, 2])
     return diag
 
+  def python_op_diag_pairs_batch(self, fun_values):
+    """Python domain function to compute unpadded diagrams of a whole batch.
+
+    Args:
+      fun_values: numpy array of shape [B, N]
+
+    Returns:
+      pairs: numpy array of shape [P, 2]
+      lengths: numpy array of shape [B*len(dims)], number of pairs per
+        sample and dimension
+    """
+    pool = get_persistence_pool('serial' if self.backend == 'map_fn' else self.backend, self.n_workers)
+    results = pool.map(np_diagram_pairs, fun_values, cache=self.cache, grid_size=list(self.grid_size),
+                       dimensions=list(self.dimensions))
+    pairs = np.concatenate([pairs for pairs, _ in results] + [np.zeros((0, 2), dtype=np.float32)])
+    lengths = np.concatenate([lengths for _, lengths in results] + [np.zeros((0,), dtype=np.int64)])
+    return pairs, lengths
+
+  def ragged_diagram(self, inputs):
+    """Persistence diagrams without padding, every pair is kept.
+
+    Args:
+      inputs: tensor of shape [B, N]
+
+    Returns:
+      outputs: tf.RaggedTensor of shape [B, len(dims), (n_pairs), 2]
+    """
+    pairs, lengths = tf.compat.v1.py_func(self.python_op_diag_pairs_batch, [inputs],
+                                          [tf.float32, tf.int64], stateful=False)
+    pairs.set_shape([None, 2])
+    lengths.set_shape([None])
+    diag = tf.RaggedTensor.from_row_lengths(pairs, lengths)
+    return tf.RaggedTensor.from_uniform_row_length(diag, len(self.dimensions))
+
 
 
 class DTMWeightWrapperLayer(tf.keras.layers.Layer):
 
-  def __init__(self, name='dtmweightwrapperlayer', **kwargs):
+  def __init__(self, grid_knn=False, name='dtmweightwrapperlayer', **kwargs):
+    """.
+
+    Args:
+      grid_knn: use a GridDTMWeightLayer, sorting the grid neighbors once
+    """
     super(DTMWeightWrapperLayer, self).__init__(name=name)
-    self.dtm_layer = DTMWeightLayer(**kwargs) #DTMWeightLayer(**kwargs)
+    self.grid_knn = grid_knn
+    if grid_knn:
+      self.dtm_layer = GridDTMWeightLayer(**kwargs)
+    else:
+      self.dtm_layer = DTMWeightLayer(**kwargs) #DTMWeightLayer(**kwargs)
+
+  def dtm(self, inputs):
+    """Distance to measure of the grid weighted by inputs of shape [..., M]."""
+    if self.grid_knn:
+      return self.dtm_layer(inputs)
+    X = tf.broadcast_to(self.dtm_layer.grid, inputs.shape + self.dtm_layer.grid.shape[-1])
+    return self.dtm_layer(inputs=X, weight=inputs)
 
   def call(self, inputs, weight=None):
     """.
@@ -614,11 +1017,8 @@ class DTMWeightWrapperLayer(tf.keras.layers.Layer):
     Returns:
       outputs: tensor of shape [..., units]
     """
-    # print(inputs.shape, self.dtm_layer.grid.shape, inputs.shape + self.dtm_layer.grid.shape[-1])
-    X = tf.broadcast_to(self.dtm_layer.grid, inputs.shape + self.dtm_layer.grid.shape[-1])
-    # print(X.shape, inputs.shape)
     # step 0 compute distance to measure
-    dtmVal = self.dtm_layer(inputs=X, weight=inputs)
+    dtmVal = self.dtm(inputs)
     outputs = dtmVal
     
     return outputs
@@ -667,7 +1067,7 @@ class TopoFunLayer(tf.keras.layers.Layer):
     # step 1 compute persistence diagram and landscape lambda together
     land = self.landscape_layer(inputs)
     # step 2 compute differential map g_theta: combine dim, tseq, KK axis
-    g_theta = self.g_layer(tf.reshape(land, land.shape[:-3] + land.shape[-3]*land.shape[-2]*land.shape[-1]))
+    g_theta = self.g_layer(tf.reshape(land, tf.concat((tf.shape(land)[:-3], [land.shape[-3]*land.shape[-2]*land.shape[-1]]), 0)))
     outputs = g_theta
     # outputs = tf.concat((tf.reshape(inputs, inputs.shape[:-2] + inputs.shape[-2] * inputs.shape[-1]), g_theta), -1)
 
@@ -692,6 +1092,14 @@ class TopoLayer(tf.keras.layers.Layer):
 
     return diag
 
+  def compute_ragged_diagram(self, inputs):
+    # step 0 compute distance to measure
+    dtmVal = self.dtm_layer(inputs)
+    # step 1 compute persistence diagram, without padding
+    diag = self.diagram_layer.ragged_diagram(dtmVal)
+
+    return diag
+
   def compute_landscape(self, inputs):
     # step 0 compute distance to measure
     dtmVal = self.dtm_layer(inputs)
@@ -700,6 +1108,18 @@ class TopoLayer(tf.keras.layers.Layer):
 
     return land
 
+  def compute_diagram_landscape(self, inputs, return_grad=False):
+    """Diagram and landscape, computing the DTM and the persistence once.
+
+    Returns:
+      diag, land, and with return_grad the sparse landscape derivative
+      diffIndex, diffValue, as PersistenceLandscapeLayer.diagram_landscape
+    """
+    # step 0 compute distance to measure
+    dtmVal = self.dtm_layer(inputs)
+    # step 1 compute persistence diagram and landscape from one complex
+    return self.landscape_layer.diagram_landscape(dtmVal, self.diagram_layer.nmax_diag, return_grad)
+
   def call(self, inputs, weight=None):
     """.
 
@@ -714,7 +1134,7 @@ class TopoLayer(tf.keras.layers.Layer):
     # step 1 compute persistence diagram and landscape lambda together
     land = self.landscape_layer(dtmVal)
     # step 2 compute differential map g_theta: combine dim, tseq, KK axis
-    g_theta = self.g_layer(tf.reshape(land, land.shape[:-3] + land.shape[-3]*land.shape[-2]*land.shape[-1]))
+    g_theta = self.g_layer(tf.reshape(land, tf.concat((tf.shape(land)[:-3], [land.shape[-3]*land.shape[-2]*land.shape[-1]]), 0)))
     outputs = g_theta
     # outputs = tf.concat((tf.reshape(inputs, inputs.shape[:-2] + inputs.shape[-2] * inputs.shape[-1]), g_theta), -1)
 
@@ -724,31 +1144,65 @@ class TopoLayer(tf.keras.layers.Layer):
 
 class TopoWeightLayer(tf.keras.layers.Layer):
 
-  def __init__(self, units=10, name='topoWlayer', **kwargs):
+  def __init__(self, units=10, grid_knn=False, name='topoWlayer', **kwargs):
+    """.
+
+    Args:
+      grid_knn: use a GridDTMWeightLayer, sorting the grid neighbors once
+    """
     super(TopoWeightLayer, self).__init__(name=name)
-    self.dtm_layer = DTMWeightLayer(**kwargs) #DTMWeightLayer(**kwargs)
+    self.grid_knn = grid_knn
+    if grid_knn:
+      self.dtm_layer = GridDTMWeightLayer(**kwargs)
+    else:
+      self.dtm_layer = DTMWeightLayer(**kwargs) #DTMWeightLayer(**kwargs)
     self.diagram_layer = PersistenceDiagramLayer(grid_size=self.dtm_layer.grid_size, **kwargs)
     self.landscape_layer = PersistenceLandscapeLayer(grid_size=self.dtm_layer.grid_size, **kwargs)
     self.g_layer = tf.keras.layers.Dense(units)
 
-  def compute_diagram(self, inputs):
+  def dtm(self, inputs):
+    """Distance to measure of the grid weighted by inputs of shape [..., M]."""
+    if self.grid_knn:
+      return self.dtm_layer(inputs)
     X = tf.broadcast_to(self.dtm_layer.grid, inputs.shape + self.dtm_layer.grid.shape[-1])
+    return self.dtm_layer(inputs=X, weight=inputs)
+
+  def compute_diagram(self, inputs):
     # step 0 compute distance to measure
-    dtmVal = self.dtm_layer(inputs=X, weight=inputs)
+    dtmVal = self.dtm(inputs)
     # step 1 compute persistence diagram
     diag = self.diagram_layer(dtmVal)
 
     return diag
 
+  def compute_ragged_diagram(self, inputs):
+    # step 0 compute distance to measure
+    dtmVal = self.dtm(inputs)
+    # step 1 compute persistence diagram, without padding
+    diag = self.diagram_layer.ragged_diagram(dtmVal)
+
+    return diag
+
   def compute_landscape(self, inputs):
-    X = tf.broadcast_to(self.dtm_layer.grid, inputs.shape + self.dtm_layer.grid.shape[-1])
     # step 0 compute distance to measure
-    dtmVal = self.dtm_layer(inputs=X, weight=inputs)
+    dtmVal = self.dtm(inputs)
     # step 1 compute persistence diagram and landscape lambda together
     land = self.landscape_layer(dtmVal)
 
     return land
 
+  def compute_diagram_landscape(self, inputs, return_grad=False):
+    """Diagram and landscape, computing the DTM and the persistence once.
+
+    Returns:
+      diag, land, and with return_grad the sparse landscape derivative
+      diffIndex, diffValue, as PersistenceLandscapeLayer.diagram_landscape
+    """
+    # step 0 compute distance to measure
+    dtmVal = self.dtm(inputs)
+    # step 1 compute persistence diagram and landscape from one complex
+    return self.landscape_layer.diagram_landscape(dtmVal, self.diagram_layer.nmax_diag, return_grad)
+
   def call(self, inputs, weight=None):
     """.
 
@@ -758,16 +1212,13 @@ class TopoWeightLayer(tf.keras.layers.Layer):
     Returns:
       outputs: tensor of shape [..., units]
     """
-    # print(inputs.shape, self.dtm_layer.grid.shape, inputs.shape + self.dtm_layer.grid.shape[-1])
-    X = tf.broadcast_to(self.dtm_layer.grid, inputs.shape + self.dtm_layer.grid.shape[-1])
-    # print(X.shape, inputs.shape)
     # step 0 compute distance to measure
-    dtmVal = self.dtm_layer(inputs=X, weight=inputs)
+    dtmVal = self.dtm(inputs)
     # dtmVal = self.dtm_layer(inputs, weight)
     # step 1 compute persistence diagram and landscape lambda together
     land = self.landscape_layer(dtmVal)
     # step 2 compute differential map g_theta: combine dim, tseq, KK axis
-    g_theta = self.g_layer(tf.reshape(land, land.shape[:-3] + land.shape[-3]*land.shape[-2]*land.shape[-1]))
+    g_theta = self.g_layer(tf.reshape(land, tf.concat((tf.shape(land)[:-3], [land.shape[-3]*land.shape[-2]*land.shape[-1]]), 0)))
     outputs = g_theta
     # outputs = tf.concat((inputs, g_theta), -1)
     
@@ -775,108 +1226,472 @@ class TopoWeightLayer(tf.keras.layers.Layer):
 
 
 
-def compute_diagram_dtm(X, m0, lims, by, r, tseq, KK, dimensions, maxscale, nmax_diag, batch_size=16):
-  start_time = time.time()
-  print ("Computing Diagrams")
+def _output_array(shape, path=None):
+  if path is None:
+    return np.zeros(shape, dtype='float32')
+  return np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=shape)
 
-  topo_layer = TopoLayer(m0=m0, nmax_diag=nmax_diag, lims=lims, by=by, r=r, tseq=tseq, KK=KK, dimensions=dimensions)
-  nX = len(X)
-  diag = np.zeros((nX, len(topo_layer.diagram_layer.dimensions), nmax_diag, 2), dtype='float32')
+def iterate_batches(fn, X, batch_size=16, sample_shape=None, compiled=True):
+  """Apply fn to X batch by batch, as a generator.
 
-  for iX in range(nX // batch_size):
-    inputs = tf.constant(X[(batch_size * iX):(batch_size * (iX+1))], dtype='float32')
-    diag[(batch_size * iX):(batch_size * (iX+1))] = np.array(topo_layer.compute_diagram(inputs))
-  if ((nX // batch_size) * batch_size < nX):
-    inputs = tf.constant(X[((nX // batch_size) * batch_size):nX], dtype='float32')
-    diag[((nX // batch_size) * batch_size):nX] = np.array(topo_layer.compute_diagram(inputs))
+  Batches are read by make_tf_dataset, which prepares the next batches
+  while fn runs. The last batch is padded, so that a compiled fn sees a
+  single input shape and is traced only once.
 
-  diag[diag == np.inf] = maxscale
+  Args:
+    fn: function from a float32 tensor [batch_size] + sample_shape to a
+      tensor [batch_size, ...], a tf.RaggedTensor, or a tuple of those
+    X: array of shape [N, ...], e.g. a np.memmap
+    batch_size: number of samples per call of fn
+    sample_shape: shape a sample is reshaped to, defaults to X.shape[1:]
+    compiled: run fn as a tf.function
+
+  Yields:
+    start, stop, outputs: the rows X[start:stop] and fn of them as numpy,
+      or as a tf.RaggedTensor, with the structure of the outputs of fn
+  """
+  sample_shape = list(X.shape[1:] if sample_shape is None else sample_shape)
+  def step(inputs, mask):
+    # padding rows repeat the first row, an all zero weight gives a
+    # degenerate filtration
+    inputs = tf.reshape(inputs, [batch_size, -1])
+    inputs = tf.where(mask[:, None] > 0, inputs, inputs[:1])
+    return fn(tf.reshape(inputs, [batch_size] + sample_shape))
+  if compiled:
+    step = tf.function(step, input_signature=[tf.TensorSpec([batch_size] + list(X.shape[1:]), tf.float32),
+                                              tf.TensorSpec([batch_size], tf.float32)])
+  start = 0
+  for inputs, mask in make_tf_dataset(X, batch_size=batch_size, remainder='pad'):
+    stop = start + int(tf.reduce_sum(mask))
+    outputs = tf.nest.map_structure(lambda output: output[:stop - start], step(inputs, mask))
+    yield start, stop, tf.nest.map_structure(
+        lambda output: output if isinstance(output, tf.RaggedTensor) else np.asarray(output), outputs)
+    start = stop
+
+def run_batches(fn, X, output_shape, batch_size=16, sample_shape=None, path=None, compiled=True, on_batch=None):
+  """Apply fn to X batch by batch, into one output array.
 
-  print("--- %s seconds ---" % (time.time() - start_time))
+  Args:
+    fn, X, batch_size, sample_shape, compiled: as in iterate_batches
+    output_shape: shape of the output of a single sample
+    path: optional .npy file the output is written to through a memmap, so
+      it never has to fit in memory
+    on_batch: optional function called with every batch of outputs, e.g.
+      to reduce them on the fly
+
+  Returns:
+    out: float32 array (np.memmap if path is given) of shape [N] + output_shape
+  """
+  out = _output_array((len(X),) + tuple(output_shape), path)
+  for start, stop, outputs in iterate_batches(fn, X, batch_size, sample_shape, compiled):
+    out[start:stop] = outputs
+    if on_batch is not None:
+      on_batch(outputs)
+  if path is not None:
+    out.flush()
+  return out
+
+def estimate_sample_bytes(topo_layer, sample_shape, outputs=('landscape',)):
+  """Estimated memory of one sample in a batch of a TopoLayer or TopoWeightLayer.
+
+  Counts the float32 and int32 tensors alive at the same time while a
+  sample goes through the DTM and the persistence op: the inputs, the
+  [M, N] distances of the kNN search, the [N, k] neighbor tensors of the
+  DTM and the outputs. k is ceil(m0 * M) for a DTMLayer; for the weighted
+  layers it is the largest index_int of the batch, which depends on the
+  weights, and is bounded by M.
+
+  Args:
+    topo_layer: TopoLayer or TopoWeightLayer
+    sample_shape: shape of a sample, [M, d] points or grid weights
+    outputs: outputs of the batch, among 'diagram' and 'landscape'
+
+  Returns:
+    bytes of one sample
+  """
+  dtm_layer = topo_layer.dtm_layer
+  nGrid, d = dtm_layer.grid.shape
+  if isinstance(topo_layer, TopoWeightLayer):
+    M = nGrid
+    k = M
+    inputs = M * (d + 1)  # weights and the grid broadcast to the batch
+  else:
+    M = sample_shape[-2]
+    k = int(np.ceil(dtm_layer.m0 * M))
+    inputs = M * d
+  if isinstance(dtm_layer, GridDTMWeightLayer) and dtm_layer.max_neighbors == nGrid:
+    knn = 0  # neighbors are gathered from the table
+  elif dtm_layer.knn_max_bytes is not None:
+    knn = 0  # tiles are bounded for the whole batch, left to the probe
+  else:
+    knn = 4 * M * nGrid  # products, squared distances and their transpose
+  dtm = 7 * nGrid * k  # neighbor distances and indices, gathered weights, cumulative sums and powers
+  # the padded batch, its masked copy and the reshape, then the DTM values and the outputs
+  values = 3 * inputs + knn + dtm + nGrid + _sample_output_values(topo_layer, outputs, with_grad=True)
+  return 4 * values
+
+def _sample_output_values(topo_layer, outputs, with_grad=False):
+  nDim = len(topo_layer.diagram_layer.dimensions)
+  land = nDim * len(topo_layer.landscape_layer.tseq) * len(topo_layer.landscape_layer.KK)
+  values = 0
+  if 'diagram' in outputs:
+    values += nDim * topo_layer.diagram_layer.nmax_diag * 2
+  if 'landscape' in outputs:
+    # with diffIndex and diffValue next to the landscape
+    values += 5 * land if with_grad else land
+  return values
+
+def auto_batch_size(fn, X, memory_budget, sample_bytes, sample_shape=None, output_bytes=0, probe_size=16, compiled=True):
+  """Largest batch size keeping the memory of fn over X within memory_budget.
+
+  The estimate sample_bytes is calibrated by running fn on a probe batch
+  of the first rows of X: when the probe takes more memory per sample than
+  estimated, the measured footprint is used. The probe includes the costs
+  paid once per batch, e.g. the tracing of fn and the persistence workers,
+  and spreads them over its samples, so the choice errs on the safe side.
+
+  Args:
+    fn, X, sample_shape, compiled: as in iterate_batches
+    memory_budget: bytes the resident size of the process may reach
+    sample_bytes: estimated memory of one sample in a batch, e.g. from
+      estimate_sample_bytes
+    output_bytes: memory of the outputs of one sample kept until the end,
+      for outputs that are not written to a memmap
+    probe_size: number of rows of the probe batch
+
+  Returns:
+    batch_size: between 1 and len(X), as even as possible over the batches
+    report: dict of the estimate, the measurement and the choice, in bytes
+  """
+  probe_size = int(min(probe_size, len(X)))
+  probe = np.asarray(X[:probe_size], dtype=np.float32)
+  with memory.PeakMemory() as peak:
+    for _ in iterate_batches(fn, probe, probe_size, sample_shape, compiled):
+      pass
+  measured = peak.increase / probe_size
+  calibrated = max(sample_bytes, measured)
+  available = memory_budget - peak.start - len(X) * output_bytes
+  batch_size = int(min(max(available // calibrated, 1), len(X)))
+  if available < calibrated:
+    print('Memory budget of %.1f MB leaves no room for a batch, using batch_size=1' % (memory_budget / 2**20))
+  # the same number of batches, with the least padding
+  batch_size = int(np.ceil(len(X) / np.ceil(len(X) / batch_size)))
+  report = {'batch_size': batch_size, 'memory_budget': memory_budget, 'estimated_sample_bytes': sample_bytes,
+            'measured_sample_bytes': measured, 'probe_size': probe_size, 'probe_peak_bytes': peak.peak,
+            'start_bytes': peak.start, 'output_bytes': len(X) * output_bytes}
+  return batch_size, report
+
+class _BudgetPeak(memory.PeakMemory):
+  """PeakMemory printing the peak of a compute_* run against its budget."""
+
+  def __init__(self, memory_budget):
+    self.memory_budget = memory_budget
+
+  def __exit__(self, *exc):
+    super(_BudgetPeak, self).__exit__(*exc)
+    print('Peak memory: %.1f MB of a %.1f MB budget' % (self.peak / 2**20, self.memory_budget / 2**20))
+    return False
+
+def _resolve_batch_size(batch_size, memory_budget, topo_layer, fn, X, sample_shape, compiled, outputs, kept_outputs):
+  # batch_size, and a context reporting the peak memory when it is 'auto';
+  # kept_outputs are the outputs held in memory rather than in a memmap
+  if batch_size != 'auto':
+    return batch_size, contextlib.nullcontext()
+  if memory_budget is None:
+    raise ValueError("batch_size='auto' needs a memory_budget")
+  sample_bytes = estimate_sample_bytes(topo_layer, list(X.shape[1:]), outputs)
+  output_bytes = 4 * _sample_output_values(topo_layer, kept_outputs)
+  batch_size, report = auto_batch_size(fn, X, memory_budget, sample_bytes, sample_shape, output_bytes, compiled=compiled)
+  print('Batch size %d for a %.1f MB budget: %.3f MB per sample estimated, %.3f MB measured on %d samples' % (
+      batch_size, memory_budget / 2**20, sample_bytes / 2**20, report['measured_sample_bytes'] / 2**20, report['probe_size']))
+  return batch_size, _BudgetPeak(memory_budget)
+
+def _replace_inf(diag, maxscale):
+  return tf.where(tf.equal(diag, np.inf), tf.constant(maxscale, diag.dtype), diag)
+
+def _run_diagram(compute_diagram, X, maxscale, nmax_diag, nDim, batch_size, sample_shape, path, compiled):
+  # maximum over the batches of the deepest diagram point, instead of a
+  # second pass over the whole output
+  nonzero = np.zeros(nmax_diag, dtype=bool)
+  def on_batch(diag):
+    nonzero[:] |= np.amax(diag, axis=(0, 1, 3)) != 0
+  fn = lambda inputs: _replace_inf(compute_diagram(inputs), maxscale)
+  diag = run_batches(fn, X, [nDim, nmax_diag, 2], batch_size, sample_shape, path, compiled, on_batch)
+  _print_diagram_fill(nonzero, nmax_diag)
+  return diag
 
-  iDiag_zero = np.where(np.amax(diag, axis=(0, 1, 3)) == 0)[0]
+def _print_diagram_fill(nonzero, nmax_diag):
+  iDiag_zero = np.where(~nonzero)[0]
   if iDiag_zero.size > 0:
     print('Maximum number of points in a diagram: ', iDiag_zero[0])
   else:
     print('Maximum number of points in a diagram is greater or equal to nmax_diag (which is ', nmax_diag, ').')
 
+def _run_diagram_landscape(compute_diagram_landscape, X, maxscale, nmax_diag, nDim, land_shape, batch_size, sample_shape,
+                           diagram_path, landscape_path, compiled):
+  def fn(inputs):
+    diag, land = compute_diagram_landscape(inputs)
+    return _replace_inf(diag, maxscale), land
+  diag = _output_array((len(X), nDim, nmax_diag, 2), diagram_path)
+  land = _output_array((len(X),) + tuple(land_shape), landscape_path)
+  nonzero = np.zeros(nmax_diag, dtype=bool)
+  for start, stop, (diag_batch, land_batch) in iterate_batches(fn, X, batch_size, sample_shape, compiled):
+    diag[start:stop] = diag_batch
+    land[start:stop] = land_batch
+    nonzero |= np.amax(diag_batch, axis=(0, 1, 3)) != 0
+  for out, path in [(diag, diagram_path), (land, landscape_path)]:
+    if path is not None:
+      out.flush()
+  _print_diagram_fill(nonzero, nmax_diag)
+  return diag, land
+
+def _run_ragged_diagram(compute_ragged_diagram, X, maxscale, dimensions, batch_size, sample_shape, path, compiled):
+  def fn(inputs):
+    return tf.ragged.map_flat_values(lambda pairs: tf.where(tf.equal(pairs, np.inf), tf.constant(maxscale, pairs.dtype), pairs),
+                                     compute_ragged_diagram(inputs))
+  writer = RaggedDiagramWriter(dimensions, path)
+  for start, stop, diag in iterate_batches(fn, X, batch_size, sample_shape, compiled):
+    writer.append(diag.flat_values.numpy(), diag.values.row_lengths().numpy())
+  diag = writer.close()
+
+  print('Maximum number of points in a diagram: ', int(diag.lengths().max()) if len(diag) else 0)
   return diag
 
 
-def compute_diagram_dtmweight(X, m0, lims, by, r, tseq, KK, dimensions, maxscale, nmax_diag, batch_size=16):
+@tracing.traced('compute_diagram_dtm')
+def compute_diagram_dtm(X, m0, lims, by, r, tseq, KK, dimensions, maxscale, nmax_diag, batch_size=16, path=None, compiled=True, ragged=False,
+                        memory_budget=None):
+  """Persistence diagrams of point clouds X [N, M, d].
+
+  Returns a [N, len(dims), nmax_diag, 2] array, or RaggedDiagrams holding
+  every pair when ragged is set, written to the directory path if given.
+  batch_size='auto' picks the largest batch keeping the process within
+  memory_budget bytes, see auto_batch_size.
+  """
   start_time = time.time()
   print ("Computing Diagrams")
 
-  topo_weight_layer = TopoWeightLayer(m0=m0, nmax_diag=nmax_diag, lims=lims, by=by, r=r, tseq=tseq, KK=KK, dimensions=dimensions)
-  nX = len(X)
-  diag = np.zeros((nX, len(topo_weight_layer.diagram_layer.dimensions), nmax_diag, 2), dtype='float32')
-  dim_Xvec = np.prod(X.shape[1:])
+  topo_layer = TopoLayer(m0=m0, nmax_diag=nmax_diag, lims=lims, by=by, r=r, tseq=tseq, KK=KK, dimensions=dimensions)
+  compute = topo_layer.compute_ragged_diagram if ragged else topo_layer.compute_diagram
+  batch_size, budget = _resolve_batch_size(batch_size, memory_budget, topo_layer, compute, X, None, compiled,
+                                           ['diagram'], ['diagram'] * (path is None))
+  with budget:
+    if ragged:
+      diag = _run_ragged_diagram(compute, X, maxscale, topo_layer.diagram_layer.dimensions,
+                                 batch_size, None, path, compiled)
+    else:
+      diag = _run_diagram(compute, X, maxscale, nmax_diag, len(topo_layer.diagram_layer.dimensions),
+                          batch_size, None, path, compiled)
 
-  for iX in range(nX // batch_size):
-    inputs = tf.constant(X[(batch_size * iX):(batch_size * (iX+1))].reshape(batch_size, dim_Xvec), dtype='float32')
-    diag[(batch_size * iX):(batch_size * (iX+1))] = np.array(topo_weight_layer.compute_diagram(inputs))
-  if ((nX // batch_size) * batch_size < nX):
-    inputs = tf.constant(X[((nX//batch_size) * batch_size):nX].reshape(nX - (nX // batch_size) * batch_size, dim_Xvec), dtype='float32')
-    diag[((nX // batch_size) * batch_size):nX] = np.array(topo_weight_layer.compute_diagram(inputs))
+  print("--- %s seconds ---" % (time.time() - start_time))
 
-  diag[diag == np.inf] = maxscale
+  return diag
 
-  print("--- %s seconds ---" % (time.time() - start_time))
 
-  iDiag_zero = np.where(np.amax(diag, axis=(0, 1, 3)) == 0)[0]
-  if iDiag_zero.size > 0:
-    print('Maximum number of points in a diagram: ', iDiag_zero[0])
-  else:
-    print('Maximum number of points in a diagram is greater or equal to nmax_diag (which is ', nmax_diag, ').')
+@tracing.traced('compute_diagram_dtmweight')
+def compute_diagram_dtmweight(X, m0, lims, by, r, tseq, KK, dimensions, maxscale, nmax_diag, batch_size=16, grid_knn=True, path=None, compiled=True, ragged=False,
+                              memory_budget=None):
+  """Persistence diagrams of images X [N, ...] used as grid weights.
+
+  Returns a [N, len(dims), nmax_diag, 2] array, or RaggedDiagrams holding
+  every pair when ragged is set, written to the directory path if given.
+  batch_size='auto' picks the largest batch keeping the process within
+  memory_budget bytes, see auto_batch_size.
+  """
+  start_time = time.time()
+  print ("Computing Diagrams")
+
+  topo_weight_layer = TopoWeightLayer(m0=m0, nmax_diag=nmax_diag, lims=lims, by=by, r=r, tseq=tseq, KK=KK, dimensions=dimensions, grid_knn=grid_knn)
+  dim_Xvec = np.prod(X.shape[1:])
+  compute = topo_weight_layer.compute_ragged_diagram if ragged else topo_weight_layer.compute_diagram
+  batch_size, budget = _resolve_batch_size(batch_size, memory_budget, topo_weight_layer, compute, X, [dim_Xvec], compiled,
+                                           ['diagram'], ['diagram'] * (path is None))
+  with budget:
+    if ragged:
+      diag = _run_ragged_diagram(compute, X, maxscale, topo_weight_layer.diagram_layer.dimensions,
+                                 batch_size, [dim_Xvec], path, compiled)
+    else:
+      diag = _run_diagram(compute, X, maxscale, nmax_diag, len(topo_weight_layer.diagram_layer.dimensions),
+                          batch_size, [dim_Xvec], path, compiled)
+
+  print("--- %s seconds ---" % (time.time() - start_time))
 
   return diag
 
-def compute_landscape_dtm(X, m0, lims, by, r, tseq, KK, dimensions, batch_size=16):
+@tracing.traced('compute_landscape_dtm')
+def compute_landscape_dtm(X, m0, lims, by, r, tseq, KK, dimensions, batch_size=16, path=None, compiled=True, memory_budget=None):
   start_time = time.time()
   print ("Computing Landscape functions")
 
   topo_layer = TopoLayer(m0=m0, lims=lims, by=by, r=r, tseq=tseq, KK=KK, dimensions=dimensions)
-  nX = len(X)
-  land = np.zeros((nX, len(dimensions), len(tseq), len(KK)), dtype='float32')
-
-  for iX in range(nX // batch_size):
-    inputs = tf.constant(X[(batch_size * iX):(batch_size * (iX+1))], dtype='float32')
-    land[(batch_size * iX):(batch_size * (iX+1))] = topo_layer.compute_landscape(inputs)
-  if ((nX // batch_size) * batch_size < nX):
-    inputs = tf.constant(X[((nX // batch_size) * batch_size):nX], dtype='float32')
-    land[((nX // batch_size) * batch_size):nX] = topo_layer.compute_landscape(inputs)
+  batch_size, budget = _resolve_batch_size(batch_size, memory_budget, topo_layer, topo_layer.compute_landscape, X, None, compiled,
+                                           ['landscape'], ['landscape'] * (path is None))
+  with budget:
+    land = run_batches(topo_layer.compute_landscape, X, [len(dimensions), len(tseq), len(KK)], batch_size,
+                       path=path, compiled=compiled)
 
   print("--- %s seconds ---" % (time.time() - start_time))
 
   return land
 
 
-def compute_landscape_dtmweight(X, m0, lims, by, r, tseq, KK, dimensions, batch_size=16):
+@tracing.traced('compute_landscape_dtmweight')
+def compute_landscape_dtmweight(X, m0, lims, by, r, tseq, KK, dimensions, batch_size=16, grid_knn=True, path=None, compiled=True,
+                                memory_budget=None):
   start_time = time.time()
   print ("Computing Landscape functions")
 
-  topo_weight_layer = TopoWeightLayer(m0=m0, lims=lims, by=by, r=r, tseq=tseq, KK=KK, dimensions=dimensions)
-  nX = len(X)
-  land = np.zeros((nX, len(dimensions), len(tseq), len(KK)), dtype='float32')
+  topo_weight_layer = TopoWeightLayer(m0=m0, lims=lims, by=by, r=r, tseq=tseq, KK=KK, dimensions=dimensions, grid_knn=grid_knn)
   dim_Xvec = np.prod(X.shape[1:])
-
-  for iX in range(nX // batch_size):
-    inputs = tf.constant(X[(batch_size * iX):(batch_size * (iX+1))].reshape(batch_size, dim_Xvec), dtype='float32')
-    land[(batch_size * iX):(batch_size * (iX+1))] = topo_weight_layer.compute_landscape(inputs)
-  if ((nX // batch_size) * batch_size < nX):
-    inputs = tf.constant(X[((nX // batch_size) * batch_size):nX].reshape(nX - (nX // batch_size) * batch_size, dim_Xvec), dtype='float32')
-    land[((nX // batch_size) * batch_size):nX] = topo_weight_layer.compute_landscape(inputs)
+  batch_size, budget = _resolve_batch_size(batch_size, memory_budget, topo_weight_layer, topo_weight_layer.compute_landscape, X,
+                                           [dim_Xvec], compiled, ['landscape'], ['landscape'] * (path is None))
+  with budget:
+    land = run_batches(topo_weight_layer.compute_landscape, X, [len(dimensions), len(tseq), len(KK)], batch_size,
+                       sample_shape=[dim_Xvec], path=path, compiled=compiled)
 
   print("--- %s seconds ---" % (time.time() - start_time))
 
   return land
 
-def to_tf_dataset(x, y, batch_size=16):
-  nY = (len(y) // batch_size) * batch_size
-  dataset = tf.data.Dataset.from_tensor_slices((x[:nY], y[:nY]))
-  dataset = dataset.batch(batch_size)
+
+@tracing.traced('compute_diagram_landscape_dtm')
+def compute_diagram_landscape_dtm(X, m0, lims, by, r, tseq, KK, dimensions, maxscale, nmax_diag, batch_size=16,
+                                  diagram_path=None, landscape_path=None, compiled=True, memory_budget=None):
+  """compute_diagram_dtm and compute_landscape_dtm in one pass over X.
+
+  Returns:
+    diag, land: as compute_diagram_dtm and compute_landscape_dtm, memmaps of
+      diagram_path and landscape_path when given
+  """
+  start_time = time.time()
+  print ("Computing Diagrams and Landscape functions")
+
+  topo_layer = TopoLayer(m0=m0, nmax_diag=nmax_diag, lims=lims, by=by, r=r, tseq=tseq, KK=KK, dimensions=dimensions)
+  kept_outputs = ['diagram'] * (diagram_path is None) + ['landscape'] * (landscape_path is None)
+  batch_size, budget = _resolve_batch_size(batch_size, memory_budget, topo_layer, topo_layer.compute_diagram_landscape, X, None,
+                                           compiled, ['diagram', 'landscape'], kept_outputs)
+  with budget:
+    diag, land = _run_diagram_landscape(topo_layer.compute_diagram_landscape, X, maxscale, nmax_diag, len(dimensions),
+                                        [len(dimensions), len(tseq), len(KK)], batch_size, None,
+                                        diagram_path, landscape_path, compiled)
+
+  print("--- %s seconds ---" % (time.time() - start_time))
+
+  return diag, land
+
+
+@tracing.traced('compute_diagram_landscape_dtmweight')
+def compute_diagram_landscape_dtmweight(X, m0, lims, by, r, tseq, KK, dimensions, maxscale, nmax_diag, batch_size=16, grid_knn=True,
+                                        diagram_path=None, landscape_path=None, compiled=True, memory_budget=None):
+  """compute_diagram_dtmweight and compute_landscape_dtmweight in one pass over X."""
+  start_time = time.time()
+  print ("Computing Diagrams and Landscape functions")
+
+  topo_weight_layer = TopoWeightLayer(m0=m0, nmax_diag=nmax_diag, lims=lims, by=by, r=r, tseq=tseq, KK=KK, dimensions=dimensions, grid_knn=grid_knn)
+  dim_Xvec = np.prod(X.shape[1:])
+  kept_outputs = ['diagram'] * (diagram_path is None) + ['landscape'] * (landscape_path is None)
+  batch_size, budget = _resolve_batch_size(batch_size, memory_budget, topo_weight_layer, topo_weight_layer.compute_diagram_landscape, X,
+                                           [dim_Xvec], compiled, ['diagram', 'landscape'], kept_outputs)
+  with budget:
+    diag, land = _run_diagram_landscape(topo_weight_layer.compute_diagram_landscape, X, maxscale, nmax_diag, len(dimensions),
+                                        [len(dimensions), len(tseq), len(KK)], batch_size, [dim_Xvec],
+                                        diagram_path, landscape_path, compiled)
+
+  print("--- %s seconds ---" % (time.time() - start_time))
+
+  return diag, land
+
+def make_tf_dataset(x, y=None, batch_size=16, remainder='pad', shuffle=False, seed=None, cache=None,
+                    split_sizes=None, num_parallel_calls=tf.data.AUTOTUNE, prefetch=tf.data.AUTOTUNE):
+  """tf.data pipeline over the rows of x (and y), reading only the rows of each batch.
+
+  Batches of row indices are turned into batches of rows by a parallel map,
+  so x can be a np.memmap that is never loaded into memory as a whole.
+
+  Args:
+    x: array of shape [N, D], e.g. a np.memmap or a BlockRows
+    y: optional array of shape [N, ...]
+    batch_size: number of rows per batch
+    remainder: what to do with the last N % batch_size rows. 'pad' pads the
+      last batch with zero rows and adds a float mask [batch_size], 1 for
+      real rows, so every batch has the same shape. Keras takes the mask as
+      sample weights, metrics are exact when given as weighted_metrics but
+      the loss of the last batch is still averaged over batch_size rows;
+      'drop' drops them, as to_tf_dataset; 'keep' yields a shorter last
+      batch
+    shuffle: shuffle the rows, again at every epoch
+    seed: seed of the shuffling
+    cache: optional cache of the loaded batches, '' in memory or a file
+      name. Not supported with shuffle, the cache would freeze the order
+    split_sizes: optional sizes along the last axis x is split into, e.g.
+      [784, 100, 162, 8*nmax_diag] for (xg, xl1, xl2, xd)
+    num_parallel_calls: parallelism of the row loading
+    prefetch: number of batches prefetched, None for no prefetching
+
+  Returns:
+    dataset: of x, (x, mask), (x, y) or (x, y, mask) batches, where x is a
+      tuple of tensors when split_sizes is given
+  """
+  if remainder not in ('pad', 'drop', 'keep'):
+    raise ValueError("remainder must be 'pad', 'drop' or 'keep', got %r" % (remainder,))
+  if shuffle and cache is not None:
+    raise ValueError('cache is not supported with shuffle')
+  nX = len(x)
+  nUsed = (nX // batch_size) * batch_size if remainder == 'drop' else nX
+  pad = remainder == 'pad'
+  sources = [x] if y is None else [x, y]
+  dtypes = [tf.float32] + [tf.as_dtype(np.asarray(y[:1]).dtype) for _ in sources[1:]] + ([tf.float32] if pad else [])
+
+  def load(index):
+    # contiguous batches are sliced, a slice of a memmap only reads its rows
+    rows = slice(index[0], index[-1] + 1) if not shuffle else index
+    batches = [np.asarray(source[rows]) for source in sources]
+    batches[0] = batches[0].astype(np.float32, copy=False)
+    if pad:
+      nPad = batch_size - len(index)
+      batches = [np.concatenate((batch, np.zeros((nPad,) + batch.shape[1:], batch.dtype))) for batch in batches]
+      batches.append((np.arange(batch_size) < len(index)).astype(np.float32))
+    return batches
+
+  def load_batch(index):
+    batches = tf.numpy_function(load, [index], dtypes)
+    nRow = batch_size if pad else None
+    batches = [tf.ensure_shape(batch, [nRow] + list(source.shape[1:]))
+               for batch, source in zip(batches, sources)] + [tf.ensure_shape(mask, [nRow]) for mask in batches[len(sources):]]
+    if split_sizes is not None:
+      batches[0] = tuple(tf.split(batches[0], split_sizes, axis=-1))
+    return batches[0] if len(batches) == 1 else tuple(batches)
+
+  dataset = tf.data.Dataset.range(nUsed)
+  if shuffle:
+    dataset = dataset.shuffle(nUsed, seed=seed, reshuffle_each_iteration=True)
+  dataset = dataset.batch(batch_size).map(load_batch, num_parallel_calls=num_parallel_calls)
+  if cache is not None:
+    dataset = dataset.cache(cache)
+  if prefetch is not None:
+    dataset = dataset.prefetch(prefetch)
   return dataset
 
+def to_tf_dataset(x, y, batch_size=16):
+  return make_tf_dataset(x, y, batch_size=batch_size, remainder='drop', prefetch=None)
+
+def ragged_diagram_tensor(diagrams, start=0, stop=None, iDim=None):
+  """Rows of RaggedDiagrams as a tf.RaggedTensor.
+
+  Args:
+    diagrams: RaggedDiagrams, e.g. from compute_diagram_dtm with ragged=True
+    start, stop: range of samples
+    iDim: optional index of a homology dimension, to keep only that one
+
+  Returns:
+    diag: tf.RaggedTensor of shape [n, len(dims), (n_pairs), 2], or
+      [n, (n_pairs), 2] when iDim is given, e.g. the input of HoferLayer
+  """
+  pairs, row_splits = diagrams.rows(start, stop)
+  diag = tf.RaggedTensor.from_row_splits(tf.constant(pairs, tf.float32), row_splits)
+  diag = tf.RaggedTensor.from_uniform_row_length(diag, len(diagrams.dimensions))
+  return diag if iDim is None else diag[:, iDim]
+
 
 
 class HoferUnit(tf.keras.layers.Layer):
@@ -893,46 +1708,90 @@ class HoferUnit(tf.keras.layers.Layer):
   def call(self, inputs):
     """
     Args:
-      inputs: tensor of shape (N, n_pairs, 2)
+      inputs: tensor of shape (N, n_pairs, 2), or tf.RaggedTensor of shape
+      (N, (n_pairs), 2) as from ragged_diagram_tensor
       (N: number of data points
        n_pairs: number of (birth, death) pairs)
 
     Returns:
       outputs: tensor of shape (N,1)
     """
-    condition1 = tf.math.greater(inputs[:,:,1], self.nu)
-    condition2 = tf.math.greater(inputs[:,:,1], 0.0)
-    safe_op = tf.where(condition2, inputs[:,:,1], tf.zeros_like(inputs[:,:,1])+1)
+    if isinstance(inputs, tf.RaggedTensor):
+      s = inputs.with_flat_values(self.pair_values(inputs.flat_values))
+    else:
+      s = self.pair_values(inputs)
+    return tf.expand_dims(tf.math.reduce_sum(s, axis=1), axis=1)
+
+  def pair_values(self, inputs):
+    """Contribution of every pair of inputs of shape (..., 2), of shape (...)."""
+    condition1 = tf.math.greater(inputs[...,1], self.nu)
+    condition2 = tf.math.greater(inputs[...,1], 0.0)
+    safe_op = tf.where(condition2, inputs[...,1], tf.zeros_like(inputs[...,1])+1)
     s = tf.where(condition1, 
                  # if x1 > nu
-                 tf.exp(-tf.square(self.sigma0) * tf.square(inputs[:,:,0] - self.mu0) - tf.square(self.sigma1) * tf.square(inputs[:,:,1] - self.mu1)),
+                 tf.exp(-tf.square(self.sigma0) * tf.square(inputs[...,0] - self.mu0) - tf.square(self.sigma1) * tf.square(inputs[...,1] - self.mu1)),
                  tf.where(condition2,
                           # if 0 < x1 <= nu
-                          tf.exp(-tf.square(self.sigma0) * tf.square(inputs[:,:,0] - self.mu0) - tf.square(self.sigma1) * tf.square(tf.math.log(tf.math.truediv(safe_op, self.nu)) * self.nu + self.nu - self.mu1)),
+                          tf.exp(-tf.square(self.sigma0) * tf.square(inputs[...,0] - self.mu0) - tf.square(self.sigma1) * tf.square(tf.math.log(tf.math.truediv(safe_op, self.nu)) * self.nu + self.nu - self.mu1)),
                           # if x1 == 0
-                          tf.zeros_like(inputs[:,:,0])
+                          tf.zeros_like(inputs[...,0])
                           )
     )
-    return tf.expand_dims(tf.math.reduce_sum(s, axis=1), axis=1)
+    return s
 
 class HoferLayer(tf.keras.layers.Layer):
-  def __init__(self, num_units, nu, name='HoferLayer'):
+  def __init__(self, num_units, nu, mask_zeros=False, name='HoferLayer'):
+    """num_units HoferUnit evaluated together, with weights of shape (num_units,).
+
+    Args:
+      num_units: number of units
+      nu: threshold of the log transform of the death values
+      mask_zeros: skip the pairs of death 0, the padding of compute_diagram,
+        instead of evaluating them to 0
+    """
+    super(HoferLayer, self).__init__(name=name)
     self.num_units = num_units
     self.nu = nu
-    self.vals = []
-    for i in range(num_units):
-        hu = HoferUnit(self.nu)
-        self.vals.append(hu)
-    super(HoferLayer, self).__init__(name=name)
+    self.mask_zeros = mask_zeros
 
-  def call(self, inputs):
+  def build(self, input_shape):
+    self.mu0 = self.add_weight(shape=(self.num_units,), initializer=tf.random_uniform_initializer(minval=0, maxval=1), trainable=True)
+    self.mu1 = self.add_weight(shape=(self.num_units,), initializer=tf.random_uniform_initializer(minval=-1, maxval=1), trainable=True)
+    self.sigma0 = self.add_weight(shape=(self.num_units,), initializer=tf.constant_initializer(1.), trainable=True)
+    self.sigma1 = self.add_weight(shape=(self.num_units,), initializer=tf.constant_initializer(1.), trainable=True)
+
+  def call(self, inputs, pair_mask=None):
     """
     Args:
-      inputs: tensor of shape (N, n_pairs, 2)
+      inputs: tensor of shape (N, n_pairs, 2), or tf.RaggedTensor of shape
+      (N, (n_pairs), 2)
       (N: number of data points
        n_pairs: number of (birth, death) pairs)
+      pair_mask: optional boolean tensor of shape (N, n_pairs), pairs to use
 
     Returns:
       outputs: tensor of shape (N, num_units)
     """
-    return tf.concat([x(inputs) for x in self.vals], 1)
\ No newline at end of file
+    if pair_mask is None and self.mask_zeros and not isinstance(inputs, tf.RaggedTensor):
+      pair_mask = tf.math.greater(inputs[:,:,1], 0.0)
+    if pair_mask is not None:
+      inputs = tf.ragged.boolean_mask(inputs, pair_mask)
+    if isinstance(inputs, tf.RaggedTensor):
+      # only the pairs actually present are evaluated, (P, num_units)
+      s = inputs.with_flat_values(self.pair_values(inputs.flat_values))
+    else:
+      s = self.pair_values(inputs)  # (N, n_pairs, num_units)
+    return tf.math.reduce_sum(s, axis=1)
+
+  def pair_values(self, inputs):
+    """Values of every unit at every pair of inputs of shape (..., 2), of shape (..., num_units)."""
+    birth = inputs[...,0:1]
+    death = inputs[...,1:2]
+    condition1 = tf.math.greater(death, self.nu)
+    condition2 = tf.math.greater(death, 0.0)
+    safe_op = tf.where(condition2, death, tf.ones_like(death))
+    # death transformed once for all units, log-scaled below nu
+    death = tf.where(condition1, death, tf.math.log(tf.math.truediv(safe_op, self.nu)) * self.nu + self.nu)
+    s = tf.exp(-tf.square(self.sigma0) * tf.square(birth - self.mu0) - tf.square(self.sigma1) * tf.square(death - self.mu1))
+    # if x1 == 0
+    return tf.where(condition2, s, tf.zeros_like(s))
\ No newline at end of file
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""processed_data
+
+Memory-mapped storage of the processed mnist inputs. The pickled
+(x_train, x_test) / (y_train, y_test) .npy files are converted once into
+one raw .npy array per split and feature block, which load instantly and
+read only the rows that are used.
+"""
+
+import os
+import json
+import numpy as np
+
+from features import file_checksum
+
+
+def feature_blocks(nmax_diag):
+  """(name, width) of the blocks of a processed input row, in order."""
+  return [('xg', 784), ('xl1', 100), ('xl2', 162), ('xd', 8 * nmax_diag)]
+
+
+def convert_processed(x_file, y_file, directory, nmax_diag=32, splits=('train', 'test')):
+  """Split pickled processed inputs into memory-mappable arrays.
+
+  Writes directory/<split>/<block>.npy for every block of feature_blocks
+  and directory/<split>/y.npy, plus directory/meta.json with the blocks and
+  the checksum of the source files.
+
+  Args:
+    x_file: .npy file of the pickled (x_train, x_test) tuple
+    y_file: .npy file of the pickled (y_train, y_test) tuple
+    directory: output directory
+    nmax_diag: number of diagram points per dimension of the xd block
+    splits: names of the splits, in the order of the tuples
+  """
+  blocks = feature_blocks(nmax_diag)
+  bounds = np.cumsum([0] + [width for _, width in blocks])
+  xs = np.load(x_file, allow_pickle=True)
+  ys = np.load(y_file, allow_pickle=True)
+  meta = {'blocks': blocks, 'nmax_diag': nmax_diag, 'splits': {},
+          'source_checksum': file_checksum(x_file, y_file)}
+  for split, x, y in zip(splits, xs, ys):
+    x = np.asarray(x)
+    if x.shape[-1] != bounds[-1]:
+      raise ValueError('%s rows have %d values, the blocks of nmax_diag=%d need %d'
+                       % (split, x.shape[-1], nmax_diag, bounds[-1]))
+    os.makedirs(os.path.join(directory, split), exist_ok=True)
+    for (name, _), start, stop in zip(blocks, bounds[:-1], bounds[1:]):
+      np.save(os.path.join(directory, split, name + '.npy'), np.ascontiguousarray(x[:, start:stop]))
+    np.save(os.path.join(directory, split, 'y.npy'), np.asarray(y))
+    meta['splits'][split] = len(x)
+  # written last, its presence marks a complete conversion
+  with open(os.path.join(directory, 'meta.json'), 'w') as f:
+    json.dump(meta, f, indent=2)
+
+
+def load_meta(directory):
+  with open(os.path.join(directory, 'meta.json')) as f:
+    return json.load(f)
+
+
+def load_blocks(directory, split='test', blocks=None, mmap_mode='r'):
+  """Feature blocks of a split as a dict {name: memmap}.
+
+  Args:
+    directory: directory written by convert_processed
+    split: name of the split
+    blocks: optional names of the blocks to load, defaults to all of them
+    mmap_mode: mode of the memmaps
+  """
+  names = blocks or [name for name, _ in load_meta(directory)['blocks']]
+  return {name: np.load(os.path.join(directory, split, name + '.npy'), mmap_mode=mmap_mode) for name in names}
+
+
+def load_split(directory, split='test', blocks=None, mmap_mode='r'):
+  """Inputs and labels of a split, without reading them.
+
+  Returns:
+    x: BlockRows of the blocks, rows as in the original processed file
+    y: memmap of the labels
+  """
+  x = BlockRows(list(load_blocks(directory, split, blocks, mmap_mode).values()))
+  y = np.load(os.path.join(directory, split, 'y.npy'), mmap_mode=mmap_mode)
+  return x, y
+
+
+class BlockRows(object):
+  """Feature blocks side by side, indexed by rows as a single [N, D] array.
+
+  Only the requested rows of every block are read and concatenated, so it
+  can be passed to make_tf_dataset in place of the full array.
+
+  Args:
+    blocks: list of arrays of shape [N, D_i], e.g. memmaps
+  """
+
+  def __init__(self, blocks):
+    if len(set(len(block) for block in blocks)) != 1:
+      raise ValueError('blocks have different numbers of rows')
+    self.blocks = blocks
+    self.shape = (len(blocks[0]), sum(block.shape[1] for block in blocks))
+    self.dtype = np.result_type(*[block.dtype for block in blocks])
+    self.ndim = 2
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, rows):
+    return np.concatenate([np.asarray(block[rows], dtype=self.dtype) for block in self.blocks], axis=-1)
+
+  def __array__(self, dtype=None):
+    return np.asarray(self[:], dtype=dtype)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""scheduler
+
+Runs the configurations of an experiment as independent jobs on a local
+process pool. Every job writes to its own directory and leaves a job.json
+checkpoint there once it has finished, so a rerun after a crash or an
+interrupt only runs the jobs that are missing or failed.
+
+  jobs = expand_jobs(nTimes, corrupt_prob_list, noise_prob_list, x_files, y_file, {'cnn': cnn_files})
+  run_jobs(main.run_job, jobs, output_dir='experiments', n_workers=4, cpus_per_job=2)
+
+Kept free of tensorflow and numpy, so that the cpu and thread limits of a
+worker are in place before the job function imports them.
+"""
+
+import os
+import sys
+import json
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                   'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS')
+
+
+def job_name(corrupt_prob, noise_prob, iTime):
+  """Name of a job, following the file names of main.preprocess, e.g. 10_10_00."""
+  return '%s_%s_%s' % (str(int(corrupt_prob * 100)).zfill(2), str(int(noise_prob * 100)).zfill(2),
+                       str(iTime).zfill(2))
+
+
+def expand_jobs(nTimes, corrupt_prob_list, noise_prob_list, x_processed_file_list, y_file, model_file_arrays):
+  """One job per (corruption, noise) setting and repetition.
+
+  Args:
+    nTimes: number of repetitions of every setting
+    corrupt_prob_list, noise_prob_list: the settings, as in main.preprocess
+    x_processed_file_list: processed input file of every setting
+    y_file: label file shared by all settings
+    model_file_arrays: dict {model name: [setting][repetition] weight file},
+      e.g. {'cnn': model_cnn_file_array}
+
+  Returns:
+    jobs: list of json serializable dicts with job_id, iCn, iTime,
+      corrupt_prob, noise_prob, x_file, y_file and model_files
+  """
+  jobs = []
+  for iCn, (corrupt_prob, noise_prob) in enumerate(zip(corrupt_prob_list, noise_prob_list)):
+    for iTime in range(nTimes):
+      jobs.append({'job_id': job_name(corrupt_prob, noise_prob, iTime), 'iCn': iCn, 'iTime': iTime,
+                   'corrupt_prob': corrupt_prob, 'noise_prob': noise_prob,
+                   'x_file': x_processed_file_list[iCn], 'y_file': y_file,
+                   'model_files': {name: files[iCn][iTime] for name, files in model_file_arrays.items()}})
+  return jobs
+
+
+def _write_json(path, obj):
+  # through a temporary file, so an interrupted write never leaves a partial checkpoint
+  tmp_path = '%s.%d.tmp' % (path, os.getpid())
+  with open(tmp_path, 'w') as f:
+    json.dump(obj, f, indent=2, sort_keys=True)
+  os.replace(tmp_path, path)
+
+def _job_config(job, job_kwargs):
+  # as read back from a checkpoint, so tuples and lists compare equal
+  return json.loads(json.dumps({'job': job, 'kwargs': job_kwargs}, sort_keys=True))
+
+def load_checkpoint(output_dir, job_id):
+  """The job.json record of a finished job, or None."""
+  path = os.path.join(output_dir, job_id, 'job.json')
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return json.load(f)
+
+
+_thread_limits = None
+
+def _init_worker(slots, cpus_per_job, threads_per_job):
+  """Pin a worker to its own cpus and cap the threads of its libraries."""
+  global _thread_limits
+  if threads_per_job:
+    for name in THREAD_ENV_VARS:
+      os.environ[name] = str(threads_per_job)
+  if cpus_per_job and hasattr(os, 'sched_setaffinity'):
+    cpus = sorted(os.sched_getaffinity(0))
+    with slots.get_lock():
+      slot = slots.value
+      slots.value += 1
+    first = slot * cpus_per_job
+    os.sched_setaffinity(0, {cpus[(first + i) % len(cpus)] for i in range(min(cpus_per_job, len(cpus)))})
+  if threads_per_job:
+    # the environment only reaches libraries loaded from here on, the main
+    # module of the parent may have been imported already by spawn
+    try:
+      from threadpoolctl import threadpool_limits
+      _thread_limits = threadpool_limits(threads_per_job)
+    except ImportError:
+      pass
+    if 'tensorflow' in sys.modules:
+      tf = sys.modules['tensorflow']
+      try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads_per_job)
+        tf.config.threading.set_inter_op_parallelism_threads(threads_per_job)
+      except RuntimeError:
+        pass  # the runtime is already initialized
+
+
+def _run_job(job_fn, job, job_dir, job_kwargs, config):
+  """job_fn(job, job_dir, **job_kwargs), checkpointed in job_dir/job.json."""
+  os.makedirs(job_dir, exist_ok=True)
+  error_path = os.path.join(job_dir, 'error.json')
+  start = time.time()
+  try:
+    outputs = job_fn(job, job_dir, **job_kwargs)
+  except Exception:
+    error = traceback.format_exc()
+    _write_json(error_path, {'config': config, 'error': error})
+    return {'job_id': job['job_id'], 'status': 'failed', 'error': error, 'seconds': time.time() - start}
+  record = {'job_id': job['job_id'], 'status': 'done', 'config': config, 'outputs': outputs or {},
+            'seconds': time.time() - start, 'pid': os.getpid(),
+            'cpus': sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None}
+  if os.path.exists(error_path):
+    os.remove(error_path)
+  # written last, its presence marks a finished job
+  _write_json(os.path.join(job_dir, 'job.json'), record)
+  return record
+
+
+def run_jobs(job_fn, jobs, output_dir='experiments', n_workers=None, cpus_per_job=None, threads_per_job=None,
+             **job_kwargs):
+  """Run job_fn(job, output_dir/<job_id>, **job_kwargs) for every unfinished job.
+
+  A job is skipped when its directory holds a job.json of the same job and
+  job_kwargs; failed jobs leave an error.json instead and run again on the
+  next call.
+
+  Args:
+    job_fn: function of a module, so that it can be pickled to the workers,
+      returning an optional json serializable dict of its outputs
+    jobs: list of json serializable dicts with a job_id, e.g. from expand_jobs
+    output_dir: directory of the job directories
+    n_workers: number of worker processes, None runs the jobs one after
+      another in this process
+    cpus_per_job: number of cpus every worker is pinned to, workers get
+      consecutive cpus, wrapping around when there are fewer cpus than
+      n_workers * cpus_per_job
+    threads_per_job: cap on the threads of tensorflow, OpenMP and BLAS in
+      every worker, defaults to cpus_per_job
+    job_kwargs: json serializable keyword arguments of job_fn
+
+  Returns:
+    results: dict {job_id: record}, with status 'done', 'failed' or
+      'skipped' (finished by an earlier run)
+  """
+  if len(set(job['job_id'] for job in jobs)) != len(jobs):
+    raise ValueError('job ids are not unique')
+  threads_per_job = threads_per_job or cpus_per_job
+  os.makedirs(output_dir, exist_ok=True)
+
+  results = {}
+  pending = []
+  for job in jobs:
+    config = _job_config(job, job_kwargs)
+    checkpoint = load_checkpoint(output_dir, job['job_id'])
+    if checkpoint is not None and checkpoint.get('config') == config:
+      results[job['job_id']] = dict(checkpoint, status='skipped')
+    else:
+      pending.append((job, os.path.join(output_dir, job['job_id']), config))
+  print('%d jobs, %d finished by an earlier run' % (len(jobs), len(jobs) - len(pending)))
+
+  def report(record):
+    results[record['job_id']] = record
+    done = sum(result['status'] != 'skipped' for result in results.values())
+    print('[%d/%d] %s %s in %.1f s' % (done, len(pending), record['job_id'], record['status'], record['seconds']))
+
+  if n_workers is None:
+    for job, job_dir, config in pending:
+      report(_run_job(job_fn, job, job_dir, job_kwargs, config))
+    return results
+
+  # spawn, as forking a process that already runs tensorflow threads is unsafe
+  context = multiprocessing.get_context('spawn')
+  with ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=_init_worker,
+                           initargs=(context.Value('i', 0), cpus_per_job, threads_per_job)) as executor:
+    futures = {executor.submit(_run_job, job_fn, job, job_dir, job_kwargs, config): job
+               for job, job_dir, config in pending}
+    for future in as_completed(futures):
+      try:
+        record = future.result()
+      except Exception:
+        # e.g. BrokenProcessPool once a worker was killed, the job is retried on the next run
+        record = {'job_id': futures[future]['job_id'], 'status': 'failed', 'error': traceback.format_exc(),
+                  'seconds': 0.}
+      report(record)
+  return results
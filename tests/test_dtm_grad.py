@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Sparse custom gradients of the DTM layers against autodiff and finite differences.
+
+Tolerances, as max |error| / max |reference| over a jacobian:
+  custom_grad against autodiff through the kNN search: 1e-4, the two only
+  differ by float32 rounding (up to about 3e-5 for r=1)
+  custom_grad against central finite differences with delta=1e-3: 5e-3,
+  the float32 rounding of the differences (about 2e-3 on the grid layer)
+
+The DTM is only piecewise smooth: it has a kink wherever the neighbor set
+or the neighbor reaching the weight bound changes. Finite differences are
+compared on the input entries whose perturbations keep that structure,
+and at most a quarter of them may be left out.
+"""
+
+import numpy as np
+import pytest
+import tensorflow.compat.v2 as tf
+
+import pllay
+
+LIMS = [[-1., 1.], [-1., 1.]]
+DELTA = 1e-3
+AUTODIFF_TOL = 1e-4
+FINITE_DIFF_TOL = 5e-3
+
+
+def relative_error(value, reference):
+  return np.abs(value - reference).max() / np.abs(reference).max()
+
+def structure(layer, args):
+  """What the DTM of layer at args is smooth in: neighbors and the neighbor reaching the bound."""
+  return [value.numpy() for value in _structure(layer, *args)]
+
+@tf.function
+def _structure(layer, *args):
+  if isinstance(layer, pllay.GridDTMWeightLayer):
+    weight, = args
+    _, knnIndex, weightBound = layer.dtm_grid(weight)
+  elif isinstance(layer, pllay.DTMWeightLayer):
+    inputs, weight = args
+    _, knnIndex, weightBound = layer.dtm(inputs, weight)
+  else:
+    _, knnIndex, _ = layer.dtm(*args)
+    return [knnIndex]
+  _, mask, last = layer.dtm_coefficient(weight, knnIndex, weightBound)
+  return [knnIndex, mask, last]
+
+def smooth_entries(layer, args, iArg):
+  """Mask of the entries of args[iArg] whose +-DELTA perturbations keep the structure."""
+  reference = structure(layer, args)
+  x = args[iArg].numpy()
+  smooth = np.ones(x.size, dtype=bool)
+  for j in range(x.size):
+    for sign in (1., -1.):
+      perturbed = x.copy().reshape(-1)
+      perturbed[j] += sign * DELTA
+      args_j = list(args)
+      args_j[iArg] = tf.constant(perturbed.reshape(x.shape))
+      smooth[j] &= all(np.array_equal(a, b) for a, b in zip(structure(layer, args_j), reference))
+  return smooth
+
+
+def make_case(kind, r, batch, custom_grad, seed=0):
+  rng = np.random.default_rng(seed)
+  if kind == 'dtm':
+    layer = pllay.DTMLayer(m0=0.3, lims=LIMS, by=0.5, r=r, custom_grad=custom_grad)
+    args = [rng.uniform(-1, 1, batch + (15, 2))]
+    fn = lambda x: layer(x)
+  elif kind == 'weight':
+    layer = pllay.DTMWeightLayer(m0=0.3, lims=LIMS, by=0.5, r=r, custom_grad=custom_grad)
+    args = [rng.uniform(-1, 1, batch + (15, 2)), rng.uniform(0.1, 1, batch + (15,))]
+    fn = lambda x, w: layer(x, w)
+  else:
+    # the default table holds the whole grid, 'grid_knn' is too narrow for
+    # m0=0.3 and falls back to the kNN search
+    max_neighbors = 3 if kind == 'grid_knn' else None
+    layer = pllay.GridDTMWeightLayer(m0=0.3, lims=LIMS, by=0.5, r=r, max_neighbors=max_neighbors, custom_grad=custom_grad)
+    args = [rng.uniform(0.1, 1, batch + (25,))]
+    fn = lambda w: layer(w)
+  # compiled, so the many calls of the finite differences are traced once
+  return layer, tf.function(fn), [tf.constant(arg, dtype=tf.float32) for arg in args]
+
+
+CASES = [(kind, r, batch)
+         for kind in ('dtm', 'weight', 'grid', 'grid_knn')
+         for r in (1., 2., 3.)
+         for batch in ((), (2,))]
+
+
+@pytest.mark.parametrize('kind, r, batch', CASES)
+def test_custom_grad_matches_autodiff(kind, r, batch):
+  _, fn, args = make_case(kind, r, batch, custom_grad=True)
+  _, fn_autodiff, _ = make_case(kind, r, batch, custom_grad=False)
+  custom, _ = tf.test.compute_gradient(fn, args, delta=DELTA)
+  autodiff, _ = tf.test.compute_gradient(fn_autodiff, args, delta=DELTA)
+  for jacobian, reference in zip(custom, autodiff):
+    assert relative_error(jacobian, reference) < AUTODIFF_TOL
+
+
+@pytest.mark.parametrize('kind, r, batch', CASES)
+def test_custom_grad_matches_finite_differences(kind, r, batch):
+  layer, fn, args = make_case(kind, r, batch, custom_grad=True)
+  theoretical, numerical = tf.test.compute_gradient(fn, args, delta=DELTA)
+  for iArg, (jacobian, reference) in enumerate(zip(theoretical, numerical)):
+    smooth = smooth_entries(layer, args, iArg)
+    assert smooth.mean() >= 0.75
+    assert relative_error(jacobian[:, smooth], reference[:, smooth]) < FINITE_DIFF_TOL
+
+
+def test_default_table_holds_the_grid():
+  # a 28x28 image grid: sparse images need neighbors far beyond ceil(m0 * N)
+  layer = pllay.GridDTMWeightLayer(m0=0.05, lims=[[-13.5, 13.5], [-13.5, 13.5]], by=1)
+  assert layer.max_neighbors == layer.grid.shape[0] == 784
+  capped = pllay.GridDTMWeightLayer(m0=0.05, lims=[[-13.5, 13.5], [-13.5, 13.5]], by=1, max_table_bytes=784 * 8 * 100)
+  assert capped.max_neighbors == 100
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Brute force kNN, whole and tiled, against scipy for every r-norm."""
+
+import numpy as np
+import pytest
+import tensorflow.compat.v2 as tf
+from scipy.spatial.distance import cdist
+
+from pllay import tf_knn, tf_knn_tiled
+
+
+def reference_distance(X, Y, r):
+  """[..., N, M] r-norm distances from the grid Y to the points X."""
+  metric = {'metric': 'chebyshev'} if r == np.inf else {'metric': 'minkowski', 'p': r}
+  return np.stack([cdist(Y, x, **metric) for x in X])
+
+
+@pytest.mark.parametrize('r', [1., 2., 3., np.inf])
+@pytest.mark.parametrize('tiled', [False, True])
+def test_knn_matches_scipy(r, tiled):
+  rng = np.random.default_rng(0)
+  X = rng.random((3, 50, 2)).astype(np.float32)
+  Y = rng.random((40, 2)).astype(np.float32)
+  # tiles of a few points, so that partial top-k are merged
+  knn_fn = (lambda *args, **kwargs: tf_knn_tiled(*args, max_bytes=2000, **kwargs)) if tiled else tf_knn
+  distance, index = knn_fn(tf.constant(X), tf.constant(Y), 5, r=r)
+
+  reference = reference_distance(X, Y, r)
+  np.testing.assert_allclose(distance.numpy(), np.sort(reference, -1)[..., :5], rtol=0, atol=1e-5)
+  # the indices point to points at the returned distances
+  np.testing.assert_allclose(np.take_along_axis(reference, index.numpy(), -1), distance.numpy(), rtol=0, atol=1e-5)
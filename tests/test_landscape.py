@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Vectorized landscape kernel against the loop-based implementation it replaced."""
+
+import numpy as np
+import pytest
+import gudhi
+
+from persistence import np_landscape, np_landscape_op
+
+
+def reference_landscape(fun_value, grid_size, tseq, KK, dimensions, dtype='float32'):
+  """PersistenceLandscapeLayer.python_op_diag_landscape before vectorization.
+
+  Returns:
+    land: numpy array of shape [len(dims), len(tseq), len(KK)]
+    diff: numpy array of shape [len(dims), len(tseq), len(KK), N]
+    pDiag: the gudhi pairs, in the order of the last axis of the following
+    landDiffBirth: numpy array of shape [len(dims), len(tseq), len(KK), len(pDiag)]
+    landDiffDeath: numpy array of shape [len(dims), len(tseq), len(KK), len(pDiag)]
+  """
+  cubCpx = gudhi.CubicalComplex(dimensions=grid_size, top_dimensional_cells=fun_value)
+  pDiag = cubCpx.persistence(homology_coeff_field=2, min_persistence=0)
+  location = cubCpx.cofaces_of_persistence_pairs()
+  if location[0]:
+    locationVstack = [np.vstack(location[0]), np.vstack(location[1])]
+  else:
+    locationVstack = [np.zeros((0, 2), dtype=np.int32), np.vstack(location[1])]
+  locationBirth = np.concatenate((locationVstack[0][:, 0], locationVstack[1][:, 0])).astype(np.int32)
+  locationDeath = locationVstack[0][:, 1].astype(np.int32)
+
+  len_dim = len(dimensions)
+  len_tseq = len(tseq)
+  len_KK = len(KK)
+  len_pDiag = len(pDiag)
+
+  land = np.zeros((len_dim, len_tseq, len_KK), dtype=dtype)
+  landDiffBirth = np.zeros((len_dim, len_tseq, len_KK, len_pDiag), dtype=dtype)
+  landDiffDeath = np.zeros((len_dim, len_tseq, len_KK, len_pDiag), dtype=dtype)
+
+  for iDim, dim in enumerate(dimensions):
+    pDiagDim = [pair for pair in pDiag if pair[0] == dim]
+    pDiagDimIds = np.array([iDiag for iDiag, pair in enumerate(pDiag) if pair[0] == dim], dtype=np.int32)
+    len_pDiagDim = len(pDiagDim)
+
+    fab = np.zeros((len_tseq, max(len_pDiagDim, np.max(KK)+1)), dtype=dtype)
+    for iDiagDim in range(len_pDiagDim):
+      for iT in range(len_tseq):
+        fab[iT, iDiagDim] = max(min(tseq[iT] - pDiagDim[iDiagDim][1][0], pDiagDim[iDiagDim][1][1] - tseq[iT]), 0)
+
+    land[iDim] = -np.sort(-fab, axis=-1)[:, KK]
+    landIndex = np.argsort(-fab, axis=-1)[:, KK]
+
+    fabDiffBirth = np.zeros((len_tseq, len_pDiagDim), dtype=dtype)
+    for iDiagDim in range(len_pDiagDim):
+      fabDiffBirth[:, iDiagDim] = np.where((tseq > pDiagDim[iDiagDim][1][0]) & (2 * tseq < pDiagDim[iDiagDim][1][0] + pDiagDim[iDiagDim][1][1]), -1., 0.)
+    fabDiffDeath = np.zeros((len_tseq, len_pDiagDim), dtype=dtype)
+    for iDiagDim in range(len_pDiagDim):
+      fabDiffDeath[:, iDiagDim] = np.where((tseq < pDiagDim[iDiagDim][1][1]) & (2 * tseq > pDiagDim[iDiagDim][1][0] + pDiagDim[iDiagDim][1][1]), 1., 0.)
+
+    for iDiagDim in range(len_pDiagDim):
+      landDiffBirth[iDim, :, :, pDiagDimIds[iDiagDim]] = np.where(iDiagDim == landIndex, np.repeat(np.expand_dims(fabDiffBirth[:, iDiagDim], -1), len_KK, -1), 0)
+    for iDiagDim in range(len_pDiagDim):
+      landDiffDeath[iDim, :, :, pDiagDimIds[iDiagDim]] = np.where(iDiagDim == landIndex, np.repeat(np.expand_dims(fabDiffDeath[:, iDiagDim], -1), len_KK, -1), 0)
+
+  DiagFUNDiffBirth = np.zeros((len_pDiag, len(fun_value)), dtype=dtype)
+  for iBirth in range(len(locationBirth)):
+    DiagFUNDiffBirth[iBirth, locationBirth[iBirth]] = 1
+  DiagFUNDiffDeath = np.zeros((len_pDiag, len(fun_value)), dtype=dtype)
+  for iDeath in range(len(locationDeath)):
+    DiagFUNDiffDeath[iDeath, locationDeath[iDeath]] = 1
+
+  if location[0]:
+    dimension = np.concatenate((np.hstack([np.repeat(ldim, len(location[0][ldim])) for ldim in range(len(location[0]))]),
+                                np.hstack([np.repeat(ldim, len(location[1][ldim])) for ldim in range(len(location[1]))])))
+  else:
+    dimension = np.hstack([np.repeat(ldim, len(location[1][ldim])) for ldim in range(len(location[1]))])
+  if len(locationDeath) > 0:
+    persistence = np.concatenate((fun_value[locationDeath], np.repeat(np.inf, len(np.vstack(location[1]))))) - fun_value[locationBirth]
+  else:
+    persistence = np.repeat(np.inf, len(np.vstack(location[1])))
+  order = np.lexsort((-persistence, -dimension))
+
+  diff = np.dot(landDiffBirth, DiagFUNDiffBirth[order, :]) + np.dot(landDiffDeath, DiagFUNDiffDeath[order, :])
+  return land, diff, pDiag, landDiffBirth, landDiffDeath
+
+
+def dense_derivative(diffIndex, diffValue, N):
+  """[..., 2] cells and values of np_landscape_op as a dense [..., N] derivative."""
+  dense = np.zeros(diffIndex.shape[:-1] + (N,), dtype=diffValue.dtype)
+  index = tuple(np.indices(diffIndex.shape[:-1]))
+  for j in range(2):
+    np.add.at(dense, index + (diffIndex[..., j],), diffValue[..., j])
+  return dense
+
+def dense_pairs(landIndex, landDiff, P):
+  """Per entry derivatives of np_landscape spread over the P pairs."""
+  dense = np.zeros(landIndex.shape + (P,), dtype=landDiff.dtype)
+  index = tuple(np.indices(landIndex.shape))
+  hasPair = landIndex >= 0
+  dense[tuple(i[hasPair] for i in index) + (landIndex[hasPair],)] = landDiff[hasPair]
+  return dense
+
+def filtration(seed, grid_size, tied):
+  rng = np.random.default_rng(seed)
+  fun_value = rng.random(int(np.prod(grid_size)))
+  if tied:
+    # few distinct values, many pairs with equal births, deaths and persistence
+    fun_value = np.floor(fun_value * 4) / 4
+  return fun_value.astype(np.float32)
+
+
+CASES = [(grid_size, nT, KK, tied)
+         for grid_size in ([5, 5], [8, 6])
+         for nT, KK in ((1, [0]), (7, [0, 1, 2]), (18, [0, 2, 5]))
+         for tied in (False, True)]
+
+
+@pytest.mark.parametrize('grid_size, nT, KK, tied', CASES)
+@pytest.mark.parametrize('seed', range(3))
+def test_landscape_op_matches_reference(seed, grid_size, nT, KK, tied):
+  fun_value = filtration(seed, grid_size, tied)
+  tseq = np.linspace(0.05, 0.95, nT).astype(np.float32)
+  KK = np.array(KK, dtype=np.int32)
+  land_ref, diff_ref, _, _, _ = reference_landscape(fun_value, grid_size, tseq, KK, [0, 1])
+  land, diffIndex, diffValue = np_landscape_op(fun_value, grid_size, tseq, KK, [0, 1])
+
+  np.testing.assert_allclose(land, land_ref, rtol=0, atol=1e-6)
+  np.testing.assert_array_equal(dense_derivative(diffIndex, diffValue, len(fun_value)), diff_ref)
+
+
+@pytest.mark.parametrize('grid_size, nT, KK, tied', CASES)
+@pytest.mark.parametrize('seed', range(3))
+def test_landscape_pair_derivatives_match_reference(seed, grid_size, nT, KK, tied):
+  fun_value = filtration(seed, grid_size, tied)
+  tseq = np.linspace(0.05, 0.95, nT).astype(np.float32)
+  KK = np.array(KK, dtype=np.int32)
+  land_ref, _, pDiag, landDiffBirth_ref, landDiffDeath_ref = reference_landscape(fun_value, grid_size, tseq, KK, [0, 1])
+  # the pairs in the order of gudhi, as the reference indexes them
+  pairDim = np.array([pair[0] for pair in pDiag], dtype=np.int32)
+  birth = np.array([pair[1][0] for pair in pDiag])
+  death = np.array([pair[1][1] for pair in pDiag])
+  land, landIndex, landDiffBirth, landDiffDeath = np_landscape(pairDim, birth, death, tseq, KK, [0, 1])
+
+  np.testing.assert_allclose(land, land_ref, rtol=0, atol=1e-6)
+  np.testing.assert_array_equal(dense_pairs(landIndex, landDiffBirth, len(pDiag)), landDiffBirth_ref)
+  np.testing.assert_array_equal(dense_pairs(landIndex, landDiffDeath, len(pDiag)), landDiffDeath_ref)
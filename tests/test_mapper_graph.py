@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Parallel mapper graph against the sequential one."""
+
+import numpy as np
+import pytest
+from sklearn import cluster
+from kmapper import Cover
+
+from mapper_graph import build_graph, size_adaptive_clusterer
+
+
+def blobs(seed=0, n_points=600):
+  rng = np.random.default_rng(seed)
+  centers = rng.uniform(-5, 5, (6, 3))
+  X = centers[rng.integers(len(centers), size=n_points)] + rng.normal(0, 0.5, (n_points, 3))
+  return X.astype(np.float32)
+
+def graph_of(X, clusterer, backend):
+  graph = build_graph(X[:, :2], X, clusterer=clusterer, cover=Cover(n_cubes=6, perc_overlap=0.3),
+                      backend=backend, n_workers=2)
+  return dict(graph['nodes']), dict(graph['links'])
+
+
+CLUSTERERS = {
+  'kmeans': lambda: cluster.KMeans(n_clusters=3, n_init=3, random_state=0),
+  'dbscan': lambda: cluster.DBSCAN(eps=0.8, min_samples=3),
+  'size_adaptive': lambda: size_adaptive_clusterer(n_clusters=3, small_cube_size=40, large_cube_size=120),
+}
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+@pytest.mark.parametrize('name', sorted(CLUSTERERS))
+def test_parallel_graph_matches_serial(name, backend):
+  X = blobs()
+  nodes, links = graph_of(X, CLUSTERERS[name](), 'serial')
+  assert len(nodes) > 6
+  # repeated, the order the workers fit the cubes in varies between runs
+  for _ in range(3):
+    assert graph_of(X, CLUSTERERS[name](), backend) == (nodes, links)
+
+
+@pytest.mark.parametrize('backend', ['serial', 'thread'])
+def test_cubes_fit_copies_of_the_clusterer(backend):
+  clusterer = CLUSTERERS['kmeans']()
+  graph_of(blobs(), clusterer, backend)
+  assert not hasattr(clusterer, 'labels_')
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""tracing
+
+Named timing spans across pllay, the persistence kernels and the mapper
+pipeline. Tracing is off by default, and span then returns a shared no-op
+context, so instrumented code only pays for one flag check.
+
+  tracing.enable()
+  with tracing.span('lens'):
+    ...
+  tracing.save_json('trace.json')          # per span count and total ns
+  tracing.save_chrome_trace('chrome.json')  # open in chrome://tracing or perfetto
+
+Spans are recorded per thread, so the python functions behind py_func are
+covered as well; spans of PersistencePool process workers are sent back
+with their results. Around tensorflow ops, spans time eager execution, or
+only the tracing inside a tf.function; enable(profiler=True) also emits
+every span as a tf.profiler trace event, to line them up with the ops in
+a tf.profiler trace.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+
+
+class _State(object):
+  enabled = False
+  profiler = None
+  max_events = 1000000
+
+_state = _State()
+_lock = threading.Lock()
+_stats = defaultdict(lambda: [0, 0, None, 0])  # name: [count, total_ns, min_ns, max_ns]
+_events = []  # (name, start_ns, duration_ns, pid, tid)
+
+
+class _NullSpan(object):
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+  __slots__ = ('name', 'start', 'trace')
+
+  def __init__(self, name):
+    self.name = name
+    self.trace = _state.profiler(name) if _state.profiler is not None else None
+
+  def __enter__(self):
+    if self.trace is not None:
+      self.trace.__enter__()
+    self.start = time.perf_counter_ns()
+    return self
+
+  def __exit__(self, *exc):
+    duration = time.perf_counter_ns() - self.start
+    if self.trace is not None:
+      self.trace.__exit__(*exc)
+    record(self.name, self.start, duration)
+    return False
+
+
+def span(name):
+  """Context manager timing the enclosed block under name, when enabled."""
+  if not _state.enabled:
+    return _NULL_SPAN
+  return _Span(name)
+
+def traced(name):
+  """Decorator timing every call of a function under name, when enabled."""
+  def decorator(fn):
+    def wrapper(*args, **kwargs):
+      if not _state.enabled:
+        return fn(*args, **kwargs)
+      with _Span(name):
+        return fn(*args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    wrapper.__wrapped__ = fn
+    return wrapper
+  return decorator
+
+def record(name, start_ns, duration_ns, pid=None, tid=None):
+  """Add a finished span, e.g. one measured in another process."""
+  with _lock:
+    stats = _stats[name]
+    stats[0] += 1
+    stats[1] += duration_ns
+    stats[2] = duration_ns if stats[2] is None else min(stats[2], duration_ns)
+    stats[3] = max(stats[3], duration_ns)
+    if len(_events) < _state.max_events:
+      _events.append((name, start_ns, duration_ns, pid or os.getpid(), tid or threading.get_ident()))
+
+
+def enable(profiler=False, max_events=1000000):
+  """Start recording spans.
+
+  Args:
+    profiler: also emit every span as a tf.profiler.experimental.Trace
+      event, they show up when a tf.profiler trace is being collected
+    max_events: number of individual spans kept for save_chrome_trace,
+      counts and totals keep being updated beyond it
+  """
+  if profiler:
+    import tensorflow as tf
+    _state.profiler = tf.profiler.experimental.Trace
+  else:
+    _state.profiler = None
+  _state.max_events = max_events
+  _state.enabled = True
+
+def disable():
+  """Stop recording spans, recorded ones are kept until reset."""
+  _state.enabled = False
+  _state.profiler = None
+
+def is_enabled():
+  return _state.enabled
+
+def reset():
+  """Drop all recorded spans."""
+  with _lock:
+    _stats.clear()
+    del _events[:]
+
+
+def events():
+  """Recorded spans as a list of (name, start_ns, duration_ns, pid, tid)."""
+  with _lock:
+    return list(_events)
+
+def merge(events):
+  """Add spans returned by events() in another process."""
+  for name, start_ns, duration_ns, pid, tid in events:
+    record(name, start_ns, duration_ns, pid, tid)
+
+def call_collecting(enabled, fn, *args):
+  """fn(*args) in a worker process, as (result, events) for merge in the parent.
+
+  Args:
+    enabled: is_enabled() of the parent, nothing is recorded otherwise
+  """
+  if not enabled:
+    return fn(*args), []
+  reset()
+  enable()
+  try:
+    result = fn(*args)
+    return result, events()
+  finally:
+    disable()
+    reset()
+
+def summary():
+  """{name: {count, total_ns, mean_ns, min_ns, max_ns}}, by decreasing total time."""
+  with _lock:
+    items = sorted(_stats.items(), key=lambda item: -item[1][1])
+    return {name: {'count': count, 'total_ns': total, 'mean_ns': total // count, 'min_ns': low, 'max_ns': high}
+            for name, (count, total, low, high) in items}
+
+def print_summary():
+  for name, stats in summary().items():
+    print('%-24s %8d calls %12.3f ms total %10.3f ms mean' % (
+        name, stats['count'], stats['total_ns'] / 1e6, stats['mean_ns'] / 1e6))
+
+def save_json(path):
+  """Write summary() to path."""
+  with open(path, 'w') as f:
+    json.dump(summary(), f, indent=2)
+
+def save_chrome_trace(path):
+  """Write the recorded spans in the chrome trace event format."""
+  trace_events = [{'name': name, 'ph': 'X', 'ts': start / 1e3, 'dur': duration / 1e3, 'pid': pid, 'tid': tid}
+                  for name, start, duration, pid, tid in events()]
+  with open(path, 'w') as f:
+    json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ns'}, f)